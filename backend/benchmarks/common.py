@@ -0,0 +1,180 @@
+"""
+Shared helpers for the backend benchmark scripts.
+
+Benchmarks run the real FastAPI app in-process through an ASGI client against a
+local mongod. Call configure_environment() before importing the app so the
+routes module connects to the benchmark database, and keep this module imported
+first so the command listener is registered before any Mongo client exists.
+"""
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from pathlib import Path
+
+from pymongo import monitoring
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+RESULTS_DIR = Path(__file__).resolve().parent / "results"
+
+
+def configure_environment(mongo_url: str, db_name: str):
+    """Point the app at the benchmark database and make backend modules importable"""
+    os.environ["MONGO_URL"] = mongo_url
+    os.environ["DB_NAME"] = db_name
+    # Keep the nightly job from writing into the benchmark database mid-run
+    os.environ.setdefault("AUTO_ABSENT_ENABLED", "false")
+    if str(BACKEND_DIR) not in sys.path:
+        sys.path.insert(0, str(BACKEND_DIR))
+
+
+class CommandCounter(monitoring.CommandListener):
+    """Counts MongoDB commands (round trips) sent while enabled"""
+    def __init__(self):
+        self.counts = Counter()
+        self.enabled = False
+
+    def started(self, event):
+        if self.enabled:
+            self.counts[event.command_name] += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+    def reset(self):
+        self.counts = Counter()
+
+    @property
+    def total(self) -> int:
+        return sum(self.counts.values())
+
+
+command_counter = CommandCounter()
+monitoring.register(command_counter)
+
+
+def percentile(sorted_values: list, pct: float) -> float:
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(round(pct / 100 * len(sorted_values))))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def latency_summary(latencies_ms: list) -> dict:
+    values = sorted(latencies_ms)
+    return {
+        "count": len(values),
+        "mean_ms": round(sum(values) / len(values), 3) if values else 0.0,
+        "p50_ms": round(percentile(values, 50), 3),
+        "p95_ms": round(percentile(values, 95), 3),
+        "p99_ms": round(percentile(values, 99), 3),
+        "max_ms": round(values[-1], 3) if values else 0.0
+    }
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR, text=True
+        ).strip()
+    except Exception:
+        return "unknown"
+
+
+def write_results(scenario: str, config: dict, results: dict, output: str = None) -> Path:
+    """Write a benchmark run to JSON so runs can be compared across commits"""
+    commit = git_commit()
+    timestamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    if output:
+        path = Path(output)
+    else:
+        RESULTS_DIR.mkdir(parents=True, exist_ok=True)
+        path = RESULTS_DIR / f"{scenario}_{commit}_{timestamp}.json"
+
+    report = {
+        "scenario": scenario,
+        "commit": commit,
+        "timestamp": timestamp,
+        "config": config,
+        "results": results
+    }
+    path.write_text(json.dumps(report, indent=2))
+    return path
+
+
+class FakeWebSocket:
+    """Stands in for an admin/team lead browser socket with a configurable send latency"""
+    def __init__(self, latency_ms: float):
+        self.latency = latency_ms / 1000
+        self.messages_sent = 0
+
+    async def send_json(self, message: dict):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.messages_sent += 1
+
+
+class BroadcastTimer:
+    """Wraps ConnectionManager.broadcast_to_role to record how long each fan-out takes"""
+    def __init__(self, manager):
+        self.manager = manager
+        self.durations_ms = []
+        self._original = manager.broadcast_to_role
+
+        async def timed_broadcast(role, message):
+            start = time.perf_counter()
+            try:
+                await self._original(role, message)
+            finally:
+                self.durations_ms.append((time.perf_counter() - start) * 1000)
+
+        manager.broadcast_to_role = timed_broadcast
+
+    def restore(self):
+        self.manager.broadcast_to_role = self._original
+
+
+def attach_fake_sockets(manager, admins: int, teamleads: int, latency_ms: float) -> list:
+    sockets = []
+    for role, count in (("admin", admins), ("teamlead", teamleads)):
+        for i in range(count):
+            ws = FakeWebSocket(latency_ms)
+            manager.active_connections[f"BENCH_{role.upper()}_{i}"] = ws
+            manager.role_connections[role].append(ws)
+            sockets.append(ws)
+    return sockets
+
+
+async def reset_collections(db, names: list):
+    for name in names:
+        await db[name].delete_many({})
+
+
+async def seed_employees(db, count: int, salary: float = 30000, team_lead_id: str = None) -> list:
+    """Insert active employees BENCH0001.. and return their ids"""
+    docs = []
+    for i in range(1, count + 1):
+        docs.append({
+            "id": f"BENCH{i:04d}",
+            "name": f"Bench Employee {i}",
+            "email": f"bench{i}@example.com",
+            "role": "employee",
+            "department": ["Audit", "Operations", "Field"][i % 3],
+            "salary": salary,
+            "salary_type": "monthly",
+            "status": "active",
+            "team_lead_id": team_lead_id,
+            "team_members": [],
+            "password": "bench"
+        })
+    if docs:
+        await db.users.insert_many(docs)
+    return [d["id"] for d in docs]
@@ -0,0 +1,177 @@
+"""
+Leave approval benchmark.
+
+Seeds N employees with one pending leave of D days each (optionally with some
+attendance already recorded inside the leave range), then approves them through
+PUT /api/leaves/{id}/approve with a configurable concurrency, or through
+POST /api/leaves/bulk-approve in batches with --bulk. Reports request latency,
+DB round trips per approved leave and verifies that every leave day ended up as
+a leave attendance record. Writes the run to JSON.
+
+Usage (from backend/):
+    python -m benchmarks.leave_approval --leaves 100 --days 15
+    python -m benchmarks.leave_approval --leaves 50 --days 15 --bulk --batch-size 50
+"""
+import argparse
+import asyncio
+import random
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+
+from benchmarks.common import (
+    command_counter, configure_environment, latency_summary, write_results,
+    reset_collections, seed_employees
+)
+
+BENCH_COLLECTIONS = [
+    "users", "leaves", "attendance", "attendance_events", "attendance_daily_rollup", "attendance_rollup_stale",
+    "attendance_rollup_rebuilds", "counters", "notifications", "holidays", "leave_balances"
+]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Leave approval benchmark")
+    parser.add_argument("--mongo-url", default="mongodb://localhost:27017")
+    parser.add_argument("--db-name", default="audix_benchmark")
+    parser.add_argument("--leaves", type=int, default=100, help="Pending leaves to approve (one per employee)")
+    parser.add_argument("--days", type=int, default=15, help="Length of each leave in days")
+    parser.add_argument("--existing-ratio", type=float, default=0.3,
+                        help="Fraction of leave days that already have an attendance record")
+    parser.add_argument("--concurrency", type=int, default=1, help="Requests in flight at once")
+    parser.add_argument("--bulk", action="store_true", help="Approve through the bulk endpoint")
+    parser.add_argument("--batch-size", type=int, default=50, help="Leaves per bulk request")
+    parser.add_argument("--start-date", default="2025-11-03")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default=None, help="Result JSON path (default: benchmarks/results/)")
+    return parser.parse_args()
+
+
+async def seed_leaves(db, emp_ids: list, start: datetime, days: int, existing_ratio: float):
+    """Insert one pending leave per employee plus some pre-existing absent records"""
+    leaves = []
+    attendance = []
+    for index, emp_id in enumerate(emp_ids):
+        from_date = start + timedelta(days=index % 7)
+        to_date = from_date + timedelta(days=days - 1)
+        leaves.append({
+            "id": f"BENCHLEAVE{index:05d}",
+            "emp_id": emp_id,
+            "emp_name": emp_id,
+            "type": "Casual Leave",
+            "from_date": from_date.strftime("%Y-%m-%d"),
+            "to_date": to_date.strftime("%Y-%m-%d"),
+            "days": days,
+            "reason": "benchmark",
+            "status": "pending",
+            "applied_on": start.strftime("%Y-%m-%d")
+        })
+        for offset in range(days):
+            if random.random() < existing_ratio:
+                attendance.append({
+                    "id": f"BENCHATT{index:05d}{offset:03d}",
+                    "emp_id": emp_id,
+                    "date": (from_date + timedelta(days=offset)).strftime("%Y-%m-%d"),
+                    "status": "absent",
+                    "attendance_status": "absent",
+                    "conveyance_amount": 0,
+                    "daily_duty_amount": 0,
+                    "work_hours": 0
+                })
+    await db.leaves.insert_many(leaves)
+    if attendance:
+        await db.attendance.insert_many(attendance)
+    return [leave["id"] for leave in leaves], len(attendance)
+
+
+async def run(args):
+    configure_environment(args.mongo_url, args.db_name)
+    import httpx
+    from server import app
+    from routes import db, holiday_calendar
+
+    random.seed(args.seed)
+    await app.router.startup()
+    await reset_collections(db, BENCH_COLLECTIONS)
+    await holiday_calendar.refresh()
+    emp_ids = await seed_employees(db, args.leaves)
+    start = datetime.strptime(args.start_date, "%Y-%m-%d")
+    leave_ids, existing_records = await seed_leaves(db, emp_ids, start, args.days, args.existing_ratio)
+
+    latencies_ms = []
+    statuses = Counter()
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=60) as client:
+        async def approve(leave_id: str):
+            async with semaphore:
+                begin = time.perf_counter()
+                resp = await client.put(f"/api/leaves/{leave_id}/approve?approved_by=BENCHADMIN")
+                latencies_ms.append((time.perf_counter() - begin) * 1000)
+                statuses[resp.status_code] += 1
+
+        async def approve_batch(batch: list):
+            async with semaphore:
+                begin = time.perf_counter()
+                resp = await client.post("/api/leaves/bulk-approve", json={
+                    "ids": batch, "approved_by": "BENCHADMIN"
+                })
+                latencies_ms.append((time.perf_counter() - begin) * 1000)
+                statuses[resp.status_code] += 1
+
+        if args.bulk:
+            requests = [
+                approve_batch(leave_ids[i:i + args.batch_size])
+                for i in range(0, len(leave_ids), args.batch_size)
+            ]
+        else:
+            requests = [approve(leave_id) for leave_id in leave_ids]
+
+        command_counter.reset()
+        command_counter.enabled = True
+        run_start = time.perf_counter()
+        await asyncio.gather(*requests)
+        elapsed = time.perf_counter() - run_start
+        command_counter.enabled = False
+
+        # Let queued notifications finish before checking the results
+        await app.router.shutdown()
+
+    leave_records = await db.attendance.count_documents({"emp_id": {"$in": emp_ids}, "attendance_status": "leave"})
+    total = len(latencies_ms)
+    approved = await db.leaves.count_documents({"id": {"$in": leave_ids}, "status": "approved"})
+    return {
+        "mode": "bulk" if args.bulk else "single",
+        "requests": total,
+        "approvals": approved,
+        "status_codes": {str(k): v for k, v in statuses.items()},
+        "pre_existing_attendance": existing_records,
+        "elapsed_seconds": round(elapsed, 3),
+        "throughput_per_second": round(total / elapsed, 2) if elapsed else 0,
+        "latency": latency_summary(latencies_ms),
+        "db_round_trips": {
+            "total": command_counter.total,
+            "per_request": round(command_counter.total / total, 2) if total else 0,
+            "per_approval": round(command_counter.total / approved, 2) if approved else 0,
+            "by_command": dict(command_counter.counts)
+        },
+        "leave_attendance_records": leave_records,
+        "expected_leave_attendance_records": args.leaves * args.days
+    }
+
+
+def main():
+    args = parse_args()
+    results = asyncio.run(run(args))
+    path = write_results("leave_approval", vars(args), results, args.output)
+    latency = results["latency"]
+    print(f"{results['approvals']} approvals of {args.days}-day leaves in {results['elapsed_seconds']}s - "
+          f"p50 {latency['p50_ms']}ms p95 {latency['p95_ms']}ms, "
+          f"{results['db_round_trips']['per_approval']} DB round trips/approval, "
+          f"{results['leave_attendance_records']}/{results['expected_leave_attendance_records']} leave records")
+    print(f"Results written to {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+"""
+Shift-start punch-in surge benchmark.
+
+Reproduces the 09:30-10:30 punch-in storm: seeds N employees and M QR codes into
+a local mongod, then fires POST /api/attendance/punch-in through an ASGI client
+at a Poisson arrival rate, including duplicate taps. Reports throughput,
+p50/p95/p99 latency, DB round trips per punch and WebSocket broadcast time, and
+writes the run to JSON.
+
+Usage (from backend/):
+    python -m benchmarks.punch_in_surge --employees 500 --qr-codes 10 --rate 50
+"""
+import argparse
+import asyncio
+import random
+import time
+from collections import Counter
+from datetime import datetime, timezone
+
+from benchmarks.common import (
+    command_counter, configure_environment, latency_summary, write_results,
+    attach_fake_sockets, BroadcastTimer, reset_collections, seed_employees
+)
+
+BENCH_COLLECTIONS = [
+    "users", "qr_codes", "attendance", "attendance_events", "attendance_daily_rollup", "attendance_rollup_stale",
+    "attendance_rollup_rebuilds", "counters", "notifications"
+]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Punch-in surge benchmark")
+    parser.add_argument("--mongo-url", default="mongodb://localhost:27017")
+    parser.add_argument("--db-name", default="audix_benchmark")
+    parser.add_argument("--employees", type=int, default=300)
+    parser.add_argument("--qr-codes", type=int, default=10)
+    parser.add_argument("--rate", type=float, default=50, help="Mean punch-in arrivals per second")
+    parser.add_argument("--duplicate-ratio", type=float, default=0.1,
+                        help="Fraction of employees who tap the QR a second time")
+    parser.add_argument("--duplicate-delay-ms", type=float, default=300,
+                        help="Max delay before a duplicate tap")
+    parser.add_argument("--admins", type=int, default=3, help="Connected admin sockets")
+    parser.add_argument("--teamleads", type=int, default=10, help="Connected team lead sockets")
+    parser.add_argument("--ws-latency-ms", type=float, default=2, help="Send latency per socket")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default=None, help="Result JSON path (default: benchmarks/results/)")
+    return parser.parse_args()
+
+
+async def run(args):
+    configure_environment(args.mongo_url, args.db_name)
+    import httpx
+    from server import app
+    from routes import db, manager, event_queue
+
+    random.seed(args.seed)
+    await app.router.startup()
+    await reset_collections(db, BENCH_COLLECTIONS)
+    emp_ids = await seed_employees(db, args.employees)
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=60) as client:
+        today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+        qr_payloads = []
+        for i in range(args.qr_codes):
+            resp = await client.post("/api/qr-codes", json={
+                "location": f"Site {i + 1}",
+                "conveyance_amount": 200,
+                "date": today,
+                "created_by": "BENCHTL",
+                "shift_type": "day",
+                "shift_start": "10:00",
+                "shift_end": "19:00"
+            })
+            resp.raise_for_status()
+            qr_payloads.append(resp.json()["qr_data"])
+
+        attach_fake_sockets(manager, args.admins, args.teamleads, args.ws_latency_ms)
+        broadcast_timer = BroadcastTimer(manager)
+
+        latencies_ms = []
+        statuses = Counter()
+
+        async def punch(emp_id: str, qr_data: str, delay: float = 0):
+            if delay:
+                await asyncio.sleep(delay)
+            start = time.perf_counter()
+            resp = await client.post(f"/api/attendance/punch-in?emp_id={emp_id}", json={"qr_data": qr_data})
+            latencies_ms.append((time.perf_counter() - start) * 1000)
+            statuses[resp.status_code] += 1
+
+        arrivals = list(emp_ids)
+        random.shuffle(arrivals)
+        tasks = []
+        duplicate_taps = 0
+
+        command_counter.reset()
+        command_counter.enabled = True
+        run_start = time.perf_counter()
+        for index, emp_id in enumerate(arrivals):
+            qr_data = qr_payloads[index % len(qr_payloads)]
+            tasks.append(asyncio.create_task(punch(emp_id, qr_data)))
+            if random.random() < args.duplicate_ratio:
+                duplicate_taps += 1
+                delay = random.uniform(0, args.duplicate_delay_ms) / 1000
+                tasks.append(asyncio.create_task(punch(emp_id, qr_data, delay)))
+            await asyncio.sleep(random.expovariate(args.rate))
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - run_start
+        command_counter.enabled = False
+
+        # Let background work (notifications, fan-out) finish before measuring it
+        await app.router.shutdown()
+        broadcast_timer.restore()
+
+    duplicate_records = await db.attendance.aggregate([
+        {"$group": {"_id": {"emp_id": "$emp_id", "date": "$date"}, "n": {"$sum": 1}}},
+        {"$match": {"n": {"$gt": 1}}},
+        {"$count": "duplicates"}
+    ]).to_list(1)
+
+    total_requests = len(latencies_ms)
+    results = {
+        "requests": total_requests,
+        "duplicate_taps": duplicate_taps,
+        "status_codes": {str(k): v for k, v in statuses.items()},
+        "elapsed_seconds": round(elapsed, 3),
+        "throughput_rps": round(total_requests / elapsed, 2) if elapsed else 0,
+        "latency": latency_summary(latencies_ms),
+        "db_round_trips": {
+            "total": command_counter.total,
+            "per_punch": round(command_counter.total / total_requests, 2) if total_requests else 0,
+            "by_command": dict(command_counter.counts)
+        },
+        "websocket_broadcast": latency_summary(broadcast_timer.durations_ms),
+        "event_queue": event_queue.metrics(),
+        "duplicate_attendance_records": duplicate_records[0]["duplicates"] if duplicate_records else 0
+    }
+    return results
+
+
+def main():
+    args = parse_args()
+    results = asyncio.run(run(args))
+    path = write_results("punch_in_surge", vars(args), results, args.output)
+    latency = results["latency"]
+    print(f"{results['requests']} punches in {results['elapsed_seconds']}s "
+          f"({results['throughput_rps']} req/s) - p50 {latency['p50_ms']}ms "
+          f"p95 {latency['p95_ms']}ms p99 {latency['p99_ms']}ms, "
+          f"{results['db_round_trips']['per_punch']} DB round trips/punch")
+    print(f"Results written to {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field, ConfigDict
-from typing import List, Optional
+from typing import List, Optional, Dict
 from datetime import datetime, timezone
 from enum import Enum
 import uuid
@@ -77,6 +77,8 @@ class UserCreate(UserBase):
 class UserResponse(UserBase):
     model_config = ConfigDict(extra="ignore")
     id: str
+    photo: Optional[str] = None  # URL of the largest thumbnail
+    photo_thumbnails: Optional[Dict[str, str]] = None  # {"48": url, "128": url, "256": url}
 
 class UserLogin(BaseModel):
     user_id: str
@@ -110,13 +112,14 @@ class QRCodeBase(BaseModel):
     shift_end: str = "19:00"    # HH:MM format (24-hour)
 
 class QRCodeCreate(QRCodeBase):
-    pass
+    ttl_minutes: Optional[int] = None  # Short-lived rotating code; default is valid for the whole date
 
 class QRCodeResponse(QRCodeBase):
     model_config = ConfigDict(extra="ignore")
     id: str
-    qr_data: str  # The actual QR code data string
+    qr_data: str  # The actual QR code data string (signed JSON payload)
     created_at: str
+    expires_at: Optional[str] = None
     is_active: bool = True
 
 # Attendance Models
@@ -158,7 +161,7 @@ class LeaveBase(BaseModel):
     reason: str
 
 class LeaveCreate(LeaveBase):
-    pass
+    days: Optional[int] = None  # Ignored - the server counts the working days in the range
 
 class LeaveResponse(LeaveBase):
     model_config = ConfigDict(extra="ignore")
@@ -213,6 +216,8 @@ class SalaryBreakdown(BaseModel):
     half_days: int = 0  # Count of half days
     absent_days: int = 0  # Count of absent days
     leave_days: int = 0  # Count of approved leave days
+    holiday_days: int = 0  # Holidays in the month (from the holiday calendar)
+    working_days: int = 0  # Days in month minus holidays
     total_duty_earned: float = 0  # Total daily duty amount earned
     audit_expenses: float = 0  # Approved audit expense reimbursements
     advance_deduction: float = 0  # Salary advance deduction
@@ -350,6 +355,9 @@ class BulkRejectRequest(BaseModel):
     rejected_by: str
     reason: Optional[str] = None
 
+class BulkAuditExpenseApproveRequest(BulkApproveRequest):
+    amounts: Optional[Dict[str, float]] = None  # Partial payment per expense id; default pays the remaining balance
+
 # Audit Expense Models
 class AuditExpenseCategory(str, Enum):
     TICKETS = "tickets"  # Flight/Train/Bus
@@ -1,17 +1,31 @@
-from fastapi import APIRouter, HTTPException, UploadFile, File, Form, WebSocket, WebSocketDisconnect
-from fastapi.responses import StreamingResponse
+from fastapi import APIRouter, HTTPException, UploadFile, File, Form, WebSocket, WebSocketDisconnect, Request
+from fastapi.responses import StreamingResponse, FileResponse, Response
+from fastapi.concurrency import run_in_threadpool
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument, UpdateOne, ReplaceOne
+from pymongo.errors import OperationFailure, DuplicateKeyError, BulkWriteError
 from typing import List, Optional
 from datetime import datetime, timezone, time, timedelta
 from dateutil.relativedelta import relativedelta
-from collections import defaultdict
+from collections import defaultdict, Counter
 import os
 import uuid
 import json
+import asyncio
+import logging
 import base64
+import hmac
+import hashlib
+import secrets
 import csv
 import io
 import zipfile
+import shutil
+import tempfile
+import re
+import mimetypes
+from email.utils import formatdate, parsedate_to_datetime
+from PIL import Image, ImageOps, UnidentifiedImageError, features as pil_features
 
 from models import (
     UserCreate, UserResponse, UserLogin, LoginResponse, UserRole, UserStatus,
@@ -25,7 +39,7 @@ from models import (
     ProfileUpdate, LeaveBalanceResponse,
     SalaryAdvanceCreate, SalaryAdvanceResponse, AdvanceStatus,
     ShiftTemplateCreate, ShiftTemplateResponse,
-    BulkApproveRequest, BulkRejectRequest,
+    BulkApproveRequest, BulkRejectRequest, BulkAuditExpenseApproveRequest,
     AuditExpenseCreate, AuditExpenseResponse, AuditExpenseStatus, AuditExpenseCategory,
     NotificationType, NotificationCreate, NotificationResponse,
     AnalyticsTimeFilter, AnalyticsResponse,
@@ -37,6 +51,7 @@ from models import (
 )
 
 router = APIRouter()
+logger = logging.getLogger(__name__)
 
 # Health check endpoint
 @router.get("/health")
@@ -49,6 +64,118 @@ mongo_url = os.environ['MONGO_URL']
 client = AsyncIOMotorClient(mongo_url)
 db = client[os.environ['DB_NAME']]
 
+def attendance_completeness(doc: dict) -> tuple:
+    """Sort key for duplicate attendance records - the most complete one is kept"""
+    return (
+        doc.get("punch_out") is not None,
+        doc.get("punch_in") is not None,
+        doc.get("attendance_status", doc.get("status")) not in (None, "absent"),
+        sum(value is not None for value in doc.values()),
+        doc.get("updated_at") or doc.get("created_at") or ""
+    )
+
+async def ensure_unique_index(collection, keys: list, archive, keep, partial: Optional[dict] = None) -> list:
+    """
+    Create a unique index on `keys`. If existing documents violate it, `keep(docs)` picks the
+    survivor of each duplicate group; the others are copied to `archive` and deleted, then
+    the index is created. Startup fails if it still cannot be created, rather than running
+    without the uniqueness the writers rely on. Returns the removed documents.
+    """
+    spec = [(key, 1) for key in keys]
+    options = {"unique": True}
+    if partial:
+        options["partialFilterExpression"] = partial
+    try:
+        await collection.create_index(spec, **options)
+        return []
+    except OperationFailure:
+        pass
+    
+    # A plain index on the same keys (left by older versions) blocks the unique one
+    for name, info in (await collection.index_information()).items():
+        if [(key, int(direction)) for key, direction in info["key"]] == spec and not info.get("unique"):
+            await collection.drop_index(name)
+    
+    groups = await collection.aggregate([
+        {"$match": partial or {}},
+        {"$group": {"_id": {key: f"${key}" for key in keys}, "docs": {"$push": "$$ROOT"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}}
+    ], allowDiskUse=True).to_list(None)
+    removed = []
+    for group in groups:
+        survivor = keep(group["docs"])
+        removed.extend(doc for doc in group["docs"] if doc["_id"] != survivor["_id"])
+    if removed:
+        now = get_utc_now_str()
+        # Keyed by _id so a restart after a partial run does not archive twice
+        await archive.bulk_write([
+            ReplaceOne({"_id": doc["_id"]}, {**doc, "deduplicated_at": now}, upsert=True) for doc in removed
+        ], ordered=False)
+        await collection.delete_many({"_id": {"$in": [doc["_id"] for doc in removed]}})
+        logger.warning(
+            "Archived %d duplicate %s documents to %s before creating the unique %s index",
+            len(removed), collection.name, archive.name, keys
+        )
+    
+    try:
+        await collection.create_index(spec, **options)
+    except OperationFailure as e:
+        raise RuntimeError(f"Cannot create the unique {keys} index on {collection.name}: {e}") from e
+    return removed
+
+async def ensure_indexes():
+    """Create the indexes used by the hot query paths (called once at startup)"""
+    # Revocation refresh: deactivated QR codes that have not expired yet
+    await db.qr_codes.create_index([("is_active", 1), ("expires_at", 1)])
+    
+    # One attendance record per employee per day - makes bulk upserts idempotent. Duplicates
+    # from before the index (e.g. double taps) keep their most complete record.
+    removed = await ensure_unique_index(
+        db.attendance, ["emp_id", "date"], db.attendance_duplicates,
+        keep=lambda docs: max(docs, key=attendance_completeness)
+    )
+    if removed:
+        await mark_attendance_rollups_stale({doc["date"] for doc in removed if doc.get("date")})
+        await mark_leave_balances_stale(list({
+            (doc["emp_id"], int(doc["date"][:4])) for doc in removed if doc.get("emp_id") and doc.get("date")
+        }))
+    await db.attendance.create_index("date")
+    await db.job_runs.create_index([("job", 1), ("date", 1)], unique=True)
+    await db.counters.create_index("id", unique=True)
+    await db.attendance_events.create_index("seq", unique=True)
+    await db.attendance_events.create_index([("emp_id", 1), ("seq", 1)])
+    await db.leaves.create_index("approval_batch_id", sparse=True)
+    await db.bills.create_index("approval_batch_id", sparse=True)
+    # Interval overlap queries: from_date <= range_end AND to_date >= range_start
+    await db.leaves.create_index([("from_date", 1), ("to_date", 1)])
+    await db.leaves.create_index([("emp_id", 1), ("from_date", 1), ("to_date", 1)])
+    # Balances written before the per-month schema are dropped once here and rebuilt on
+    # read; rebuild placeholders (no months yet) carry rebuild_started and are kept
+    legacy = await db.leave_balances.delete_many({"months": {"$exists": False}, "rebuild_started": {"$exists": False}})
+    if legacy.deleted_count:
+        logger.info("Dropped %d leave balances in the old format", legacy.deleted_count)
+    await db.leave_balances.create_index([("emp_id", 1), ("year", 1)], unique=True)
+    # One auto-generated cash out per source record (manual entries are not constrained).
+    # Duplicate auto entries are double payments - the first one booked is kept.
+    await ensure_unique_index(
+        db.cash_out, ["reference_id", "reference_type"], db.cash_out_duplicates,
+        keep=lambda docs: min(docs, key=lambda doc: doc.get("created_at") or ""),
+        partial={"is_auto": True}
+    )
+    await db.attendance_daily_rollup.create_index(
+        [("date", 1), ("department", 1), ("location", 1), ("shift_type", 1)], unique=True
+    )
+    await db.attendance_rollup_stale.create_index("date", unique=True)
+    await db.attendance_rollup_rebuilds.create_index("date", unique=True)
+    # Approval inbox: pending items per collection, newest first
+    await db.leaves.create_index([("status", 1), ("applied_on", -1)])
+    await db.bills.create_index([("status", 1), ("submitted_on", -1)])
+    await db.advances.create_index([("status", 1), ("requested_on", -1)])
+    await db.audit_expenses.create_index([("status", 1), ("submitted_on", -1)])
+    await db.attachments.create_index("id", unique=True)
+    await db.attachments.create_index("sha256")
+    await db.attachment_blobs.create_index("sha256", unique=True)
+
 # Helper functions
 def generate_id():
     return str(uuid.uuid4())[:8].upper()
@@ -56,6 +183,37 @@ def generate_id():
 def get_utc_now_str():
     return datetime.now(timezone.utc).isoformat()
 
+async def raise_transition_conflict(collection, doc_id: str, not_found: str, conflict: str):
+    """
+    Called when a status-conditioned update matched nothing: 404 if the document
+    does not exist, otherwise 400 with `conflict` formatted with its current status.
+    """
+    current = await collection.find_one({"id": doc_id}, {"_id": 0, "status": 1})
+    if not current:
+        raise HTTPException(status_code=404, detail=not_found)
+    raise HTTPException(status_code=400, detail=conflict.format(status=current.get("status")))
+
+# Materialized views (attendance rollups, leave balances) are kept up to date by queued $inc
+# deltas and occasionally rebuilt from source. A rebuild records when it started and finished;
+# a delta that was queued around that window may or may not be in the rebuilt snapshot.
+REBUILD_SETTLE_SECONDS = int(os.environ.get("REBUILD_SETTLE_SECONDS", "5"))
+
+def classify_queued_delta(queued_at: str, rebuild_started: Optional[str], rebuilt_at: Optional[str]) -> str:
+    """
+    "apply" a delta queued at `queued_at`, "skip" it because the last rebuild already counted
+    the write, or mark the view "stale" because it may or may not have. The write happens
+    before the delta is queued, so only deltas clearly before or after the rebuild are safe.
+    """
+    if not rebuild_started:
+        return "apply"
+    settle = timedelta(seconds=REBUILD_SETTLE_SECONDS)
+    queued = datetime.fromisoformat(queued_at)
+    if queued < datetime.fromisoformat(rebuild_started) - settle:
+        return "skip"
+    if rebuilt_at and rebuilt_at >= rebuild_started and queued > datetime.fromisoformat(rebuilt_at) + settle:
+        return "apply"
+    return "stale"
+
 def parse_time(time_str: str) -> time:
     """Parse HH:MM time string to time object"""
     h, m = map(int, time_str.split(':'))
@@ -256,9 +414,21 @@ async def update_user(user_id: str, updates: dict):
     updates.pop("_id", None)
     updates.pop("id", None)
     updates.pop("password", None)
-    
-    # Check if team_lead_id is being changed
-    old_user = await db.users.find_one({"id": user_id}, {"_id": 0})
+    # Helper fields for the team leader history, never stored on the user
+    changed_by = updates.pop("changed_by", "ADMIN001")
+    change_reason = updates.pop("change_reason", "Team Leader reassignment")
+    
+    # One write returns the pre-image (for the team leader change check); the response is
+    # the pre-image with the updates applied, so the user is not read back
+    if updates:
+        old_user = await db.users.find_one_and_update(
+            {"id": user_id},
+            {"$set": updates},
+            projection={"_id": 0, "password": 0},
+            return_document=ReturnDocument.BEFORE
+        )
+    else:
+        old_user = await db.users.find_one({"id": user_id}, {"_id": 0, "password": 0})
     if not old_user:
         raise HTTPException(status_code=404, detail="User not found")
     
@@ -268,13 +438,11 @@ async def update_user(user_id: str, updates: dict):
     # If team leader is being changed, log the history
     if new_team_lead_id and old_team_lead_id != new_team_lead_id:
         # Get team leader names
-        old_tl_name = None
-        if old_team_lead_id:
-            old_tl = await db.users.find_one({"id": old_team_lead_id}, {"_id": 0, "name": 1})
-            old_tl_name = old_tl.get("name") if old_tl else None
-        
-        new_tl = await db.users.find_one({"id": new_team_lead_id}, {"_id": 0, "name": 1})
-        new_tl_name = new_tl.get("name") if new_tl else "Unknown"
+        leads = await db.users.find(
+            {"id": {"$in": [tl for tl in (old_team_lead_id, new_team_lead_id) if tl]}},
+            {"_id": 0, "id": 1, "name": 1}
+        ).to_list(None)
+        lead_names = {tl["id"]: tl.get("name") for tl in leads}
         
         # Log the change
         history_doc = {
@@ -282,25 +450,19 @@ async def update_user(user_id: str, updates: dict):
             "emp_id": user_id,
             "emp_name": old_user.get("name"),
             "old_team_leader_id": old_team_lead_id,
-            "old_team_leader_name": old_tl_name,
+            "old_team_leader_name": lead_names.get(old_team_lead_id),
             "new_team_leader_id": new_team_lead_id,
-            "new_team_leader_name": new_tl_name,
-            "changed_by": updates.get("changed_by", "ADMIN001"),
+            "new_team_leader_name": lead_names.get(new_team_lead_id) or "Unknown",
+            "changed_by": changed_by,
             "changed_at": get_utc_now_str(),
-            "reason": updates.get("change_reason", "Team Leader reassignment")
+            "reason": change_reason
         }
         await db.team_leader_history.insert_one(history_doc)
-        
-        # Remove helper fields from updates
-        updates.pop("changed_by", None)
-        updates.pop("change_reason", None)
     
-    result = await db.users.update_one({"id": user_id}, {"$set": updates})
-    if result.matched_count == 0:
-        raise HTTPException(status_code=404, detail="User not found")
+    if any(field in updates and updates[field] != old_user.get(field) for field in ("department", "role")):
+        await mark_employee_rollups_stale(user_id)
     
-    user = await db.users.find_one({"id": user_id}, {"_id": 0, "password": 0})
-    return UserResponse(**user)
+    return UserResponse(**{**old_user, **updates})
 
 # Get Team Leader change history
 @router.get("/users/{user_id}/team-leader-history")
@@ -341,46 +503,282 @@ async def reset_password(user_id: str, new_password: str, reset_by: str):
 @router.get("/users/team/{team_lead_id}", response_model=List[UserResponse])
 async def get_team_members(team_lead_id: str):
     """Get all employees assigned to a specific team leader"""
-    # Verify team lead exists
-    team_lead = await db.users.find_one({"id": team_lead_id}, {"_id": 0})
+    # Members by team_lead_id plus the legacy team_members list, resolved in one aggregation
+    members = await db.users.aggregate(team_members_pipeline(team_lead_id)).to_list(None)
+    if not members:
+        await get_team_lead_or_404(team_lead_id)
+    return members
+
+async def get_team_lead_or_404(team_lead_id: str) -> dict:
+    team_lead = await db.users.find_one({"id": team_lead_id}, {"_id": 0, "password": 0})
     if not team_lead:
         raise HTTPException(status_code=404, detail="Team lead not found")
+    return team_lead
+
+def team_members_pipeline(team_lead_id: str) -> list:
+    """
+    Aggregation stages (run on db.users) that resolve a team lead's members in one pass:
+    employees with team_lead_id set plus the legacy team_members list on the lead.
+    Yields one document per member; the lead itself is not included.
+    """
+    return [
+        {"$match": {"id": team_lead_id}},
+        {"$lookup": {
+            "from": "users",
+            "let": {"lead_id": "$id", "legacy_ids": {"$ifNull": ["$team_members", []]}},
+            "pipeline": [
+                {"$match": {"$expr": {"$or": [
+                    {"$and": [{"$eq": ["$team_lead_id", "$$lead_id"]}, {"$eq": ["$role", "employee"]}]},
+                    {"$in": ["$id", "$$legacy_ids"]}
+                ]}}},
+                {"$project": {"_id": 0, "password": 0}}
+            ],
+            "as": "members"
+        }},
+        {"$unwind": "$members"},
+        {"$replaceRoot": {"newRoot": "$members"}}
+    ]
+
+TEAM_MEMBER_SUMMARY_FIELDS = {
+    "_id": 0, "id": 1, "name": 1, "department": 1, "designation": 1, "photo": 1, "photo_thumbnails": 1, "status": 1
+}
+
+@router.get("/teams/{team_lead_id}/today")
+async def get_team_today(team_lead_id: str, date: Optional[str] = None):
+    """Team members with their punch state for a day (default: today, UTC) - one aggregation"""
+    if date is None:
+        date = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    
+    pipeline = team_members_pipeline(team_lead_id) + [
+        {"$lookup": {
+            "from": "attendance",
+            "let": {"emp_id": "$id"},
+            "pipeline": [
+                {"$match": {"$expr": {"$and": [
+                    {"$eq": ["$emp_id", "$$emp_id"]},
+                    {"$eq": ["$date", date]}
+                ]}}},
+                {"$project": {
+                    "_id": 0, "punch_in": 1, "punch_out": 1, "attendance_status": 1,
+                    "location": 1, "work_hours": 1, "conveyance_amount": 1
+                }},
+                {"$limit": 1}
+            ],
+            "as": "attendance"
+        }},
+        {"$project": {**TEAM_MEMBER_SUMMARY_FIELDS, "attendance": {"$arrayElemAt": ["$attendance", 0]}}},
+        {"$sort": {"name": 1}}
+    ]
+    members = await db.users.aggregate(pipeline).to_list(None)
+    if not members:
+        await get_team_lead_or_404(team_lead_id)
+    
+    summary = {"total": len(members), "punched_in": 0, "punched_out": 0, "on_leave": 0, "absent": 0, "not_marked": 0}
+    for member in members:
+        attendance = member.get("attendance")
+        if not attendance:
+            member["state"] = "not_marked"
+        elif attendance.get("attendance_status") == "leave":
+            member["state"] = "on_leave"
+        elif attendance.get("attendance_status") == "absent":
+            member["state"] = "absent"
+        elif attendance.get("punch_out"):
+            member["state"] = "punched_out"
+        else:
+            member["state"] = "punched_in"
+        summary[member["state"]] += 1
+    
+    return {"team_lead_id": team_lead_id, "date": date, "summary": summary, "members": members}
+
+@router.get("/teams/{team_lead_id}/month")
+async def get_team_month(team_lead_id: str, month: int, year: int):
+    """Team members with attendance totals for a month - one aggregation"""
+    if month < 1 or month > 12:
+        raise HTTPException(status_code=400, detail="Invalid month")
+    month_start = f"{year}-{month:02d}-01"
+    month_end = (datetime(year, month, 1) + relativedelta(months=1)).strftime("%Y-%m-%d")
+    
+    def count_status(*statuses):
+        return {"$sum": {"$cond": [{"$in": ["$attendance_status", list(statuses)]}, 1, 0]}}
+    
+    pipeline = team_members_pipeline(team_lead_id) + [
+        {"$lookup": {
+            "from": "attendance",
+            "let": {"emp_id": "$id"},
+            "pipeline": [
+                {"$match": {"$expr": {"$and": [
+                    {"$eq": ["$emp_id", "$$emp_id"]},
+                    {"$gte": ["$date", month_start]},
+                    {"$lt": ["$date", month_end]}
+                ]}}},
+                {"$group": {
+                    "_id": None,
+                    "full_days": count_status("full_day", "present"),
+                    "half_days": count_status("half_day"),
+                    "absent_days": count_status("absent"),
+                    "leave_days": count_status("leave"),
+                    "work_hours": {"$sum": "$work_hours"},
+                    "duty_total": {"$sum": "$daily_duty_amount"},
+                    "conveyance_total": {"$sum": "$conveyance_amount"}
+                }},
+                {"$project": {"_id": 0}}
+            ],
+            "as": "totals"
+        }},
+        {"$project": {**TEAM_MEMBER_SUMMARY_FIELDS, "totals": {"$arrayElemAt": ["$totals", 0]}}},
+        {"$sort": {"name": 1}}
+    ]
+    members = await db.users.aggregate(pipeline).to_list(None)
+    if not members:
+        await get_team_lead_or_404(team_lead_id)
     
-    # Get employees who have this team_lead_id assigned
-    members = await db.users.find(
-        {"team_lead_id": team_lead_id, "role": "employee"},
-        {"_id": 0, "password": 0}
-    ).to_list(100)
-    
-    # Also get from legacy team_members list for backward compatibility
-    team_member_ids = team_lead.get("team_members", [])
-    if team_member_ids:
-        legacy_members = await db.users.find(
-            {"id": {"$in": team_member_ids}, "team_lead_id": {"$ne": team_lead_id}},
-            {"_id": 0, "password": 0}
-        ).to_list(100)
-        members.extend(legacy_members)
-    
-    return members
+    empty_totals = {
+        "full_days": 0, "half_days": 0, "absent_days": 0, "leave_days": 0,
+        "work_hours": 0, "duty_total": 0, "conveyance_total": 0
+    }
+    team_totals = dict(empty_totals)
+    for member in members:
+        totals = member.get("totals") or dict(empty_totals)
+        for key in ("work_hours", "duty_total", "conveyance_total"):
+            totals[key] = round(totals.get(key) or 0, 2)
+        member["totals"] = totals
+        for key in team_totals:
+            team_totals[key] += totals.get(key, 0)
+    for key in ("work_hours", "duty_total", "conveyance_total"):
+        team_totals[key] = round(team_totals[key], 2)
+    
+    return {"team_lead_id": team_lead_id, "month": month, "year": year, "totals": team_totals, "members": members}
 
 # ==================== QR CODE ROUTES ====================
 
+# QR payloads carry an HMAC signature, key id and expiry so punch-in can verify
+# them without reading the QR code from the database.
+# QR_SIGNING_KEYS = "kid1:secret1,kid2:secret2" - the first key signs new codes,
+# the others are still accepted so keys can be rotated without reprinting codes.
+QR_NIGHT_SHIFT_GRACE_HOURS = 12  # Default expiry: end of QR date + grace for night shifts
+QR_REVOCATION_REFRESH_SECONDS = int(os.environ.get("QR_REVOCATION_REFRESH_SECONDS", "30"))
+
+_qr_signing_keys: dict = {}  # {kid: secret bytes}
+_qr_active_key_id: Optional[str] = None
+
+async def get_qr_signing_keys():
+    """Load QR signing keys from env, or a shared DB-stored key if none are configured"""
+    global _qr_active_key_id
+    if _qr_signing_keys:
+        return _qr_signing_keys, _qr_active_key_id
+
+    for entry in os.environ.get("QR_SIGNING_KEYS", "").split(","):
+        kid, sep, secret = entry.strip().partition(":")
+        if sep and kid and secret:
+            _qr_signing_keys[kid] = secret.encode()
+            if _qr_active_key_id is None:
+                _qr_active_key_id = kid
+
+    if not _qr_signing_keys:
+        # No configured key - generate one once and share it through the DB so all workers agree
+        key_doc = await db.app_settings.find_one_and_update(
+            {"id": "qr_signing_key"},
+            {"$setOnInsert": {
+                "id": "qr_signing_key",
+                "kid": "db1",
+                "secret": secrets.token_hex(32),
+                "created_at": get_utc_now_str()
+            }},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        _qr_signing_keys[key_doc["kid"]] = key_doc["secret"].encode()
+        _qr_active_key_id = key_doc["kid"]
+
+    return _qr_signing_keys, _qr_active_key_id
+
+def compute_qr_signature(payload: dict, secret: bytes) -> str:
+    """HMAC-SHA256 over the canonical JSON of the payload (without its signature)"""
+    unsigned = {k: v for k, v in payload.items() if k != "sig"}
+    canonical = json.dumps(unsigned, sort_keys=True, separators=(",", ":"))
+    digest = hmac.new(secret, canonical.encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).decode().rstrip("=")
+
+async def sign_qr_payload(payload: dict) -> dict:
+    """Attach key id and signature to a QR payload (payload must already contain exp)"""
+    keys, active_kid = await get_qr_signing_keys()
+    signed = {**payload, "kid": active_kid}
+    signed["sig"] = compute_qr_signature(signed, keys[active_kid])
+    return signed
+
+class QRRevocationList:
+    """In-memory set of deactivated, not-yet-expired QR ids, refreshed from the DB periodically"""
+    def __init__(self, refresh_seconds: int):
+        self.refresh_seconds = refresh_seconds
+        self.revoked_ids: set = set()
+        self.refreshed_at: Optional[datetime] = None
+
+    async def refresh(self):
+        now = datetime.now(timezone.utc)
+        revoked = await db.qr_codes.find(
+            {"is_active": False, "expires_at": {"$gt": now.isoformat()}},
+            {"_id": 0, "id": 1}
+        ).to_list(None)
+        self.revoked_ids = {q["id"] for q in revoked}
+        self.refreshed_at = now
+
+    async def is_revoked(self, qr_id: str) -> bool:
+        now = datetime.now(timezone.utc)
+        if self.refreshed_at is None or (now - self.refreshed_at).total_seconds() > self.refresh_seconds:
+            await self.refresh()
+        return qr_id in self.revoked_ids
+
+    def add(self, qr_id: str):
+        self.revoked_ids.add(qr_id)
+
+qr_revocations = QRRevocationList(QR_REVOCATION_REFRESH_SECONDS)
+
+async def verify_signed_qr(qr_info: dict):
+    """Verify signature, expiry and revocation of a signed QR payload - raises HTTPException"""
+    keys, _ = await get_qr_signing_keys()
+    secret = keys.get(qr_info.get("kid"))
+    if secret is None or not hmac.compare_digest(
+        str(qr_info.get("sig", "")), compute_qr_signature(qr_info, secret)
+    ):
+        raise HTTPException(status_code=400, detail="Invalid QR code. Please ask your Team Leader to generate a new QR code.")
+
+    try:
+        expired = datetime.now(timezone.utc).timestamp() > float(qr_info.get("exp"))
+    except (TypeError, ValueError):
+        expired = True
+    if expired or await qr_revocations.is_revoked(qr_info.get("id")):
+        raise HTTPException(status_code=400, detail="This QR code has expired. Please ask your Team Leader for a new one.")
+
+def get_qr_expiry(qr_date: str, ttl_minutes: Optional[int] = None) -> datetime:
+    """Short-lived codes use ttl_minutes; otherwise the code is valid for its date (plus night shift grace)"""
+    now = datetime.now(timezone.utc)
+    if ttl_minutes:
+        return now + timedelta(minutes=ttl_minutes)
+    try:
+        day_start = datetime.strptime(qr_date, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+    except (TypeError, ValueError):
+        return now + timedelta(days=1)
+    return day_start + timedelta(days=1, hours=QR_NIGHT_SHIFT_GRACE_HOURS)
+
 @router.post("/qr-codes", response_model=QRCodeResponse)
 async def create_qr_code(qr_data: QRCodeCreate):
     qr_id = generate_id()
-    
-    # Create QR data string (will be encoded in actual QR) - includes shift info
-    qr_string = json.dumps({
+    expires_at = get_qr_expiry(qr_data.date, qr_data.ttl_minutes)
+
+    # Create signed QR data string (will be encoded in actual QR) - includes shift info
+    qr_payload = await sign_qr_payload({
         "id": qr_id,
         "location": qr_data.location,
         "conveyance": qr_data.conveyance_amount,
         "date": qr_data.date,
         "created_by": qr_data.created_by,
-        "shift_type": qr_data.shift_type,
+        "shift_type": qr_data.shift_type.value,
         "shift_start": qr_data.shift_start,
-        "shift_end": qr_data.shift_end
+        "shift_end": qr_data.shift_end,
+        "exp": int(expires_at.timestamp())
     })
-    
+    qr_string = json.dumps(qr_payload)
+
     qr_doc = {
         "id": qr_id,
         "location": qr_data.location,
@@ -392,6 +790,7 @@ async def create_qr_code(qr_data: QRCodeCreate):
         "shift_end": qr_data.shift_end,
         "qr_data": qr_string,
         "created_at": get_utc_now_str(),
+        "expires_at": expires_at.isoformat(),
         "is_active": True
     }
     
@@ -426,10 +825,335 @@ async def deactivate_qr_code(qr_id: str):
     )
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="QR code not found")
+    
+    # Signed QR codes are verified without a DB read, so revoke locally right away
+    qr_revocations.add(qr_id)
     return {"message": "QR code deactivated"}
 
 # ==================== ATTENDANCE ROUTES ====================
 
+# --- Attendance event log ---
+# Every attendance mutation appends a compact event with a monotonic sequence number so
+# analytics, payroll and exports can tail changes instead of rescanning whole months.
+# Sequence numbers are reserved in blocks from db.counters before the events are inserted,
+# so a reader can briefly see a gap while a writer is in flight. Writers append inline right
+# after the attendance write, in the same await chain (a transaction would require a replica
+# set), so the only window where an event can be missing is a crash between the two awaits.
+
+ATTENDANCE_EVENT_SETTLE_SECONDS = int(os.environ.get("ATTENDANCE_EVENT_SETTLE_SECONDS", "10"))
+
+async def reserve_sequence(name: str, count: int = 1) -> int:
+    """Reserve `count` consecutive sequence numbers and return the first one"""
+    counter = await db.counters.find_one_and_update(
+        {"id": name},
+        {"$inc": {"seq": count}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    return counter["seq"] - count + 1
+
+def build_attendance_event(old: Optional[dict], new: dict, action: str, actor: Optional[str]) -> dict:
+    old = old or {}
+    return {
+        "emp_id": new.get("emp_id", old.get("emp_id")),
+        "date": new.get("date", old.get("date")),
+        "attendance_id": new.get("id", old.get("id")),
+        "action": action,
+        "actor": actor,
+        "old_status": old.get("attendance_status"),
+        "new_status": new.get("attendance_status"),
+        "duty_delta": round((new.get("daily_duty_amount") or 0) - (old.get("daily_duty_amount") or 0), 2),
+        "conveyance_delta": round((new.get("conveyance_amount") or 0) - (old.get("conveyance_amount") or 0), 2),
+        "work_hours": new.get("work_hours", 0)
+    }
+
+async def record_attendance_changes(changes: list, action: str, actor: Optional[str] = None) -> int:
+    """
+    Append one event per (old, new) attendance pair - old is None for new records - and
+    queue the derived leave balance and rollup deltas. Returns the number of events written.
+    Awaited by the writer right after its attendance write, so sequence numbers follow
+    mutation order and the events exist before the response is sent.
+    """
+    if not changes:
+        return 0
+    # When the attendance write finished - the rollup/leave balance rebuild checks compare against it
+    changed_at = get_utc_now_str()
+    first_seq = await reserve_sequence("attendance_events", len(changes))
+    now = get_utc_now_str()
+    events = []
+    for offset, (old, new) in enumerate(changes):
+        event = build_attendance_event(old, new, action, actor)
+        event["seq"] = first_seq + offset
+        event["created_at"] = now
+        events.append(event)
+    await db.attendance_events.insert_many(events, ordered=False)
+    await queue_leave_balance_deltas(leave_balance_deltas_from_events(events), changed_at)
+    await queue_attendance_rollup_changes(changes, changed_at)
+    return len(events)
+
+# ==================== ATTENDANCE ROLLUPS ====================
+
+# db.attendance_daily_rollup holds one document per (date, department, location, shift_type)
+# with present/half_day/absent/leave/total counts and duty/conveyance sums. Every attendance
+# write applies its (old, new) change as $inc deltas on the background queue; dates whose
+# deltas could not be applied go to db.attendance_rollup_stale and are rebuilt from
+# attendance on the next read. db.attendance_rollup_rebuilds holds the last rebuild window
+# per date, and rollups carry that rebuild's rebuilt_at, so a delta that races a rebuild
+# marks the date stale instead of being counted twice or lost. Admin attendance is counted
+# under department "Unknown", like the analytics always did.
+ATTENDANCE_ROLLUP_KEY = ("date", "department", "location", "shift_type")
+
+def rollup_key_value(value):
+    return "Unknown" if value is None else value
+
+def attendance_rollup_bucket(record: dict) -> str:
+    status = record.get("attendance_status", record.get("status", "absent"))
+    if status in ("full_day", "present"):
+        return "present"
+    if status in ("half_day", "leave"):
+        return status
+    return "absent"
+
+def attendance_rollup_deltas(changes: list, departments: dict) -> dict:
+    """{rollup key tuple: Counter of $inc fields} for (old, new) attendance pairs"""
+    deltas = defaultdict(Counter)
+    for old, new in changes:
+        for record, sign in ((old, -1), (new, 1)):
+            if not record or not record.get("date"):
+                continue
+            key = (
+                record["date"],
+                departments.get(record.get("emp_id"), "Unknown"),
+                rollup_key_value(record.get("location")),
+                rollup_key_value(record.get("shift_type"))
+            )
+            counter = deltas[key]
+            counter[attendance_rollup_bucket(record)] += sign
+            counter["total"] += sign
+            counter["duty_amount"] += sign * (record.get("daily_duty_amount") or 0)
+            counter["conveyance_amount"] += sign * (record.get("conveyance_amount") or 0)
+    return deltas
+
+async def rollup_departments(emp_ids: list) -> dict:
+    users = await db.users.find(
+        {"id": {"$in": emp_ids}, "role": {"$ne": "admin"}}, {"_id": 0, "id": 1, "department": 1}
+    ).to_list(None)
+    return {user["id"]: rollup_key_value(user.get("department")) for user in users}
+
+async def apply_attendance_rollup_changes(changes: list, queued_at: str):
+    """Apply attendance changes to the daily rollups (runs on the event queue)"""
+    dates = {record["date"] for pair in changes for record in pair if record and record.get("date")}
+    try:
+        rebuilds = {
+            doc["date"]: doc for doc in await db.attendance_rollup_rebuilds.find(
+                {"date": {"$in": list(dates)}}, {"_id": 0}
+            ).to_list(None)
+        }
+        actions = {
+            date: classify_queued_delta(
+                queued_at, rebuilds.get(date, {}).get("started_at"), rebuilds.get(date, {}).get("rebuilt_at")
+            )
+            for date in dates
+        }
+        await mark_attendance_rollups_stale({date for date, action in actions.items() if action == "stale"})
+        
+        emp_ids = list({record.get("emp_id") for pair in changes for record in pair if record})
+        deltas = attendance_rollup_deltas(changes, await rollup_departments(emp_ids))
+        now = get_utc_now_str()
+        operations = []
+        for key, counter in deltas.items():
+            if actions[key[0]] != "apply":
+                continue
+            increments = {field: round(value, 2) for field, value in counter.items() if round(value, 2)}
+            if increments:
+                # Only the rollup generation the decision was made against - a rollup replaced
+                # by a rebuild since then fails the upsert on the unique key and goes stale
+                operations.append(UpdateOne(
+                    {**dict(zip(ATTENDANCE_ROLLUP_KEY, key)), "rebuilt_at": rebuilds.get(key[0], {}).get("rebuilt_at")},
+                    {"$inc": increments, "$set": {"updated_at": now}},
+                    upsert=True
+                ))
+        if not operations:
+            return
+        try:
+            await db.attendance_daily_rollup.bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+            # Two first writes for the same new key raced on the upsert - the retry finds the doc
+            # (a generation mismatch fails again and is handled below)
+            errors = e.details.get("writeErrors", [])
+            if any(error.get("code") != 11000 for error in errors):
+                raise
+            await db.attendance_daily_rollup.bulk_write([operations[error["index"]] for error in errors], ordered=False)
+    except Exception:
+        logger.exception("Attendance rollup update failed - marking dates stale")
+        await mark_attendance_rollups_stale(dates)
+
+async def mark_attendance_rollups_stale(dates):
+    if not dates:
+        return
+    now = get_utc_now_str()
+    await db.attendance_rollup_stale.bulk_write([
+        UpdateOne({"date": date}, {"$set": {"marked_at": now}}, upsert=True) for date in dates
+    ], ordered=False)
+
+async def mark_employee_rollups_stale(emp_id: str):
+    """
+    Rollups count attendance under the employee's current department, so a department or
+    role change moves all of their history - have every date they have attendance on rebuilt
+    """
+    await mark_attendance_rollups_stale(await db.attendance.distinct("date", {"emp_id": emp_id}))
+
+async def queue_attendance_rollup_changes(changes: list, queued_at: Optional[str] = None):
+    if not changes:
+        return
+    if not event_queue.publish(apply_attendance_rollup_changes, changes, queued_at or get_utc_now_str()):
+        # Dropped under overload - have the affected dates rebuilt on next read
+        await mark_attendance_rollups_stale({
+            record["date"] for pair in changes for record in pair if record and record.get("date")
+        })
+
+async def rebuild_attendance_rollups(from_date: Optional[str] = None, to_date: Optional[str] = None,
+                                     dates: Optional[list] = None) -> int:
+    """
+    Recompute the rollups for a date range (or list of dates; everything when neither is
+    given) from attendance in one aggregation and store them. Returns the rollup count.
+    """
+    started = get_utc_now_str()
+    date_match = {}
+    if dates is not None:
+        date_match["date"] = {"$in": list(dates)}
+    elif from_date or to_date:
+        date_match["date"] = {k: v for k, v in (("$gte", from_date), ("$lte", to_date)) if v}
+    if dates is None:
+        dates = set(await db.attendance.distinct("date", date_match))
+        dates.update(await db.attendance_daily_rollup.distinct("date", date_match))
+    dates = list(dates)
+    # Deltas queued from here until the rebuild is recorded as finished mark the dates stale
+    if dates:
+        await db.attendance_rollup_rebuilds.bulk_write([
+            UpdateOne({"date": date}, {"$set": {"started_at": started, "rebuilt_at": None}}, upsert=True)
+            for date in dates
+        ], ordered=False)
+    
+    sums = {field: {"$sum": f"${field}"} for field in (
+        "present", "half_day", "absent", "leave", "total", "duty_amount", "conveyance_amount"
+    )}
+    rows = await db.attendance.aggregate([
+        {"$match": date_match},
+        {"$project": {
+            "emp_id": 1,
+            "date": 1,
+            "location": {"$ifNull": ["$location", "Unknown"]},
+            "shift_type": {"$ifNull": ["$shift_type", "Unknown"]},
+            "bucket": {"$let": {"vars": {"s": ATTENDANCE_STATUS_EXPR}, "in": {"$switch": {
+                "branches": [
+                    {"case": {"$in": ["$$s", ["full_day", "present"]]}, "then": "present"},
+                    {"case": {"$in": ["$$s", ["half_day", "leave"]]}, "then": "$$s"}
+                ],
+                "default": "absent"
+            }}}},
+            "duty_amount": {"$ifNull": ["$daily_duty_amount", 0]},
+            "conveyance_amount": {"$ifNull": ["$conveyance_amount", 0]}
+        }},
+        # Per employee first so the department $lookup runs once per employee and key
+        {"$group": {
+            "_id": {"emp_id": "$emp_id", "date": "$date", "location": "$location", "shift_type": "$shift_type"},
+            **{bucket: {"$sum": {"$cond": [{"$eq": ["$bucket", bucket]}, 1, 0]}}
+               for bucket in ("present", "half_day", "absent", "leave")},
+            "total": {"$sum": 1},
+            "duty_amount": {"$sum": "$duty_amount"},
+            "conveyance_amount": {"$sum": "$conveyance_amount"}
+        }},
+        {"$lookup": {
+            "from": "users",
+            "let": {"emp_id": "$_id.emp_id"},
+            "pipeline": [
+                {"$match": {"$expr": {"$eq": ["$id", "$$emp_id"]}, "role": {"$ne": "admin"}}},
+                {"$limit": 1},
+                {"$project": {"_id": 0, "department": {"$ifNull": ["$department", "Unknown"]}}}
+            ],
+            "as": "user"
+        }},
+        {"$group": {
+            "_id": {
+                "date": "$_id.date",
+                "department": {"$ifNull": [{"$arrayElemAt": ["$user.department", 0]}, "Unknown"]},
+                "location": "$_id.location",
+                "shift_type": "$_id.shift_type"
+            },
+            **sums
+        }}
+    ]).to_list(None)
+    
+    now = get_utc_now_str()
+    operations = []
+    for row in rows:
+        key = row.pop("_id")
+        row["duty_amount"] = round(row["duty_amount"], 2)
+        row["conveyance_amount"] = round(row["conveyance_amount"], 2)
+        operations.append(ReplaceOne(key, {**key, **row, "updated_at": now, "rebuilt_at": now}, upsert=True))
+    if operations:
+        await db.attendance_daily_rollup.bulk_write(operations, ordered=False)
+    # Rollups in the range that this rebuild did not produce are stale, including ones first
+    # created by an incremental update (those have no rebuilt_at)
+    await db.attendance_daily_rollup.delete_many({**date_match, "rebuilt_at": {"$ne": now}})
+    # A newer rebuild of the same date owns its window
+    await db.attendance_rollup_rebuilds.update_many(
+        {"date": {"$in": dates}, "started_at": started}, {"$set": {"rebuilt_at": now}}
+    )
+    await db.attendance_rollup_stale.delete_many({**date_match, "marked_at": {"$lt": started}})
+    return len(operations)
+
+async def ensure_attendance_rollups_fresh(start_date: str, end_date: str):
+    """Rebuild any dates in the range whose incremental updates were lost"""
+    stale = await db.attendance_rollup_stale.distinct("date", {"date": {"$gte": start_date, "$lte": end_date}})
+    if stale:
+        await rebuild_attendance_rollups(dates=stale)
+
+async def backfill_attendance_rollups():
+    """Build all rollups once when the collection is empty but attendance exists (startup)"""
+    if await db.attendance_daily_rollup.find_one({}, {"_id": 1}):
+        return
+    if await db.attendance.find_one({}, {"_id": 1}):
+        count = await rebuild_attendance_rollups()
+        logger.info("Backfilled %d attendance rollups", count)
+
+@router.post("/attendance/rollups/rebuild")
+async def rebuild_attendance_rollups_endpoint(from_date: Optional[str] = None, to_date: Optional[str] = None):
+    """Rebuild daily attendance rollups for a date range (Admin only) - all dates when omitted"""
+    count = await rebuild_attendance_rollups(from_date, to_date)
+    return {"message": f"{count} rollups rebuilt", "rollups": count, "from_date": from_date, "to_date": to_date}
+
+@router.get("/attendance/events")
+async def get_attendance_events(after_seq: int = 0, limit: int = 500):
+    """
+    Tail the attendance event log: events with seq > after_seq in order.
+    Stops early at a sequence gap that may still be filled by an in-flight write;
+    gaps older than the settle window are skipped. Resume with after_seq=last_seq.
+    """
+    limit = max(1, min(limit, 5000))
+    events = await db.attendance_events.find(
+        {"seq": {"$gt": after_seq}}, {"_id": 0}
+    ).sort("seq", 1).limit(limit).to_list(limit)
+    
+    settle_before = (datetime.now(timezone.utc) - timedelta(seconds=ATTENDANCE_EVENT_SETTLE_SECONDS)).isoformat()
+    visible = []
+    expected_seq = after_seq + 1
+    stopped_at_gap = False
+    for event in events:
+        if event["seq"] != expected_seq and event["created_at"] > settle_before:
+            stopped_at_gap = True
+            break
+        visible.append(event)
+        expected_seq = event["seq"] + 1
+    
+    return {
+        "events": visible,
+        "last_seq": visible[-1]["seq"] if visible else after_seq,
+        "has_more": stopped_at_gap or len(events) == limit
+    }
+
+
 @router.post("/attendance/punch-in", response_model=AttendanceResponse)
 async def punch_in(data: AttendanceCreate, emp_id: str):
     # Parse QR data
@@ -438,12 +1162,27 @@ async def punch_in(data: AttendanceCreate, emp_id: str):
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Invalid QR code data: {str(e)}")
     
-    # Verify QR code exists and is active
-    qr_code = await db.qr_codes.find_one({"id": qr_info.get("id")}, {"_id": 0})
-    if not qr_code:
-        raise HTTPException(status_code=404, detail="QR code not found. Please ask your Team Leader to generate a new QR code.")
-    if not qr_code.get("is_active", False):
-        raise HTTPException(status_code=400, detail="This QR code has expired. Please ask your Team Leader for a new one.")
+    if "sig" in qr_info:
+        # Signed QR - authenticity, expiry and revocation are checked without a DB lookup
+        await verify_signed_qr(qr_info)
+        qr_code = {
+            "id": qr_info["id"],
+            "location": qr_info.get("location"),
+            "conveyance_amount": qr_info.get("conveyance", 0),
+            "shift_type": qr_info.get("shift_type"),
+            "shift_start": qr_info.get("shift_start"),
+            "shift_end": qr_info.get("shift_end")
+        }
+    else:
+        # Legacy unsigned QR - verify QR code exists and is active
+        qr_code = await db.qr_codes.find_one({"id": qr_info.get("id")}, {"_id": 0})
+        if not qr_code:
+            raise HTTPException(status_code=404, detail="QR code not found. Please ask your Team Leader to generate a new QR code.")
+        if qr_code.get("expires_at"):
+            # Codes with an expiry were issued signed - a payload without its signature was tampered with
+            raise HTTPException(status_code=400, detail="Invalid QR code. Please ask your Team Leader to generate a new QR code.")
+        if not qr_code.get("is_active", False):
+            raise HTTPException(status_code=400, detail="This QR code has expired. Please ask your Team Leader for a new one.")
     
     today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
     
@@ -455,10 +1194,11 @@ async def punch_in(data: AttendanceCreate, emp_id: str):
     
     punch_in_time = datetime.now(timezone.utc).strftime("%H:%M")
     
-    # Get shift info from QR code (with defaults for backward compatibility)
-    shift_type = qr_info.get("shift_type", qr_code.get("shift_type", "day"))
-    shift_start = qr_info.get("shift_start", qr_code.get("shift_start", "10:00"))
-    shift_end = qr_info.get("shift_end", qr_code.get("shift_end", "19:00"))
+    # Get shift info from the verified payload or the stored QR code - never from an
+    # unsigned payload (with defaults for backward compatibility)
+    shift_type = qr_code.get("shift_type") or "day"
+    shift_start = qr_code.get("shift_start") or "10:00"
+    shift_end = qr_code.get("shift_end") or "19:00"
     
     # Calculate attendance status based on punch-in time and shift
     attendance_status = calculate_attendance_status(punch_in_time, shift_start, shift_end, shift_type)
@@ -515,14 +1255,20 @@ async def punch_in(data: AttendanceCreate, emp_id: str):
         "shift_end": shift_end
     }
     
-    await db.attendance.insert_one(attendance_doc)
+    try:
+        await db.attendance.insert_one(attendance_doc)
+    except DuplicateKeyError:
+        # A concurrent tap won the race - return the record it created
+        existing = await db.attendance.find_one({"emp_id": emp_id, "date": today}, {"_id": 0})
+        return AttendanceResponse(**existing)
     attendance_doc.pop("_id", None)
+    await record_attendance_changes([(None, attendance_doc)], "punch_in", emp_id)
     
     # Get employee name for notification
     emp_name = user.get("name", emp_id) if user else emp_id
     
-    # Broadcast real-time attendance update to admins and team leads
-    await manager.broadcast_to_admins_and_teamleads({
+    # Broadcast real-time attendance update to admins and team leads (after the response)
+    event_queue.publish(manager.broadcast_to_admins_and_teamleads, {
         "type": "attendance_update",
         "action": "punch_in",
         "data": {
@@ -536,7 +1282,8 @@ async def punch_in(data: AttendanceCreate, emp_id: str):
     })
     
     # Create notification for admins/team leads
-    await create_notification(
+    event_queue.publish(
+        create_notification,
         recipient_id="",
         recipient_role="admin",
         title="Employee Punched In",
@@ -618,16 +1365,20 @@ async def direct_punch_in(emp_id: str, location: str = "Office", shift_type: str
         "shift_end": shift_end
     }
     
-    await db.attendance.insert_one(attendance_doc)
+    try:
+        await db.attendance.insert_one(attendance_doc)
+    except DuplicateKeyError:
+        # A concurrent tap won the race - return the record it created
+        existing = await db.attendance.find_one({"emp_id": emp_id, "date": today}, {"_id": 0})
+        return AttendanceResponse(**existing)
     attendance_doc.pop("_id", None)
+    await record_attendance_changes([(None, attendance_doc)], "direct_punch_in", emp_id)
     
-    # Get user name for notification
-    user = await db.users.find_one({"id": emp_id}, {"_id": 0})
+    # Get user name for notification (user was already loaded for the duty calculation)
     emp_name = user.get("name", emp_id) if user else emp_id
-    punch_in_time = attendance_doc.get("punch_in", "")
     
-    # Broadcast real-time attendance update to admins
-    await manager.broadcast_to_role("admin", {
+    # Broadcast real-time attendance update to admins (after the response)
+    event_queue.publish(manager.broadcast_to_role, "admin", {
         "type": "attendance_update",
         "action": "punch_in",
         "data": {
@@ -642,7 +1393,8 @@ async def direct_punch_in(emp_id: str, location: str = "Office", shift_type: str
     })
     
     # Create notification for admins
-    await create_notification(
+    event_queue.publish(
+        create_notification,
         recipient_id="",
         recipient_role="admin",
         title="Team Lead Punched In",
@@ -682,27 +1434,30 @@ async def punch_out(data: AttendancePunchOut):
         {"$set": {"punch_out": punch_out_time, "work_hours": work_hours}}
     )
     
+    previous = dict(attendance)
     attendance["punch_out"] = punch_out_time
     attendance["work_hours"] = work_hours
+    await record_attendance_changes([(previous, attendance)], "punch_out", data.emp_id)
     
-    # Get user name for notification
-    user = await db.users.find_one({"id": data.emp_id}, {"_id": 0})
-    emp_name = user.get("name", data.emp_id) if user else data.emp_id
+    # Broadcast real-time attendance update (after the response)
+    event_queue.publish(broadcast_punch_out, {
+        "emp_id": data.emp_id,
+        "punch_out": punch_out_time,
+        "work_hours": work_hours,
+        "date": data.date
+    })
     
-    # Broadcast real-time attendance update
+    return AttendanceResponse(**attendance)
+
+async def broadcast_punch_out(update: dict):
+    """Resolve the employee name and broadcast a punch-out to admins and team leads"""
+    user = await db.users.find_one({"id": update["emp_id"]}, {"_id": 0, "name": 1})
+    update["emp_name"] = user.get("name", update["emp_id"]) if user else update["emp_id"]
     await manager.broadcast_to_admins_and_teamleads({
         "type": "attendance_update",
         "action": "punch_out",
-        "data": {
-            "emp_id": data.emp_id,
-            "emp_name": emp_name,
-            "punch_out": punch_out_time,
-            "work_hours": work_hours,
-            "date": data.date
-        }
+        "data": update
     })
-    
-    return AttendanceResponse(**attendance)
 
 @router.get("/attendance", response_model=List[AttendanceResponse])
 async def get_attendance(
@@ -733,6 +1488,97 @@ async def get_monthly_attendance(emp_id: str, month: int, year: int):
     ).to_list(100)
     return attendance
 
+# Single-letter codes for the compact month matrix ("-" = no record)
+ATTENDANCE_MATRIX_CODES = {
+    "full_day": "F",
+    "present": "F",
+    "half_day": "H",
+    "absent": "A",
+    "leave": "L"
+}
+
+@router.get("/attendance/matrix")
+async def get_attendance_matrix(month: int, year: int, team_lead_id: Optional[str] = None):
+    """
+    Compact month grid for the team / employee attendance views.
+    Each employee gets a `codes` string with one character per day of the month
+    (F full day, H half day, A absent, L leave, - no record) plus duty and conveyance totals.
+    Without team_lead_id all active employees and team leads are returned.
+    """
+    from calendar import monthrange
+    if month < 1 or month > 12:
+        raise HTTPException(status_code=400, detail="Invalid month")
+    days_in_month = monthrange(year, month)[1]
+    month_start = f"{year}-{month:02d}-01"
+    next_month = datetime(year, month, 1) + relativedelta(months=1)
+    month_end = next_month.strftime("%Y-%m-%d")
+    
+    if team_lead_id:
+        pipeline = team_members_pipeline(team_lead_id)
+    else:
+        pipeline = [{"$match": {"status": "active", "role": {"$in": ["employee", "teamlead"]}}}]
+    
+    pipeline += [
+        {"$lookup": {
+            "from": "attendance",
+            "let": {"emp_id": "$id"},
+            "pipeline": [
+                {"$match": {"$expr": {"$and": [
+                    {"$eq": ["$emp_id", "$$emp_id"]},
+                    {"$gte": ["$date", month_start]},
+                    {"$lt": ["$date", month_end]}
+                ]}}},
+                {"$project": {
+                    "_id": 0,
+                    "date": 1,
+                    "attendance_status": 1,
+                    "daily_duty_amount": 1,
+                    "conveyance_amount": 1
+                }}
+            ],
+            "as": "days"
+        }},
+        {"$project": {
+            "_id": 0,
+            "id": 1,
+            "name": 1,
+            "department": 1,
+            "days": 1,
+            "duty_total": {"$sum": "$days.daily_duty_amount"},
+            "conveyance_total": {"$sum": "$days.conveyance_amount"}
+        }},
+        {"$sort": {"name": 1}}
+    ]
+    
+    rows = await db.users.aggregate(pipeline).to_list(None)
+    if team_lead_id and not rows:
+        await get_team_lead_or_404(team_lead_id)
+    
+    employees = []
+    for row in rows:
+        codes = ["-"] * days_in_month
+        for day in row["days"]:
+            day_index = int(day["date"][8:10]) - 1
+            if 0 <= day_index < days_in_month:
+                codes[day_index] = ATTENDANCE_MATRIX_CODES.get(day.get("attendance_status"), "-")
+        employees.append({
+            "id": row["id"],
+            "name": row.get("name"),
+            "department": row.get("department"),
+            "codes": "".join(codes),
+            "duty_total": round(row.get("duty_total") or 0, 2),
+            "conveyance_total": round(row.get("conveyance_total") or 0, 2)
+        })
+    
+    return {
+        "month": month,
+        "year": year,
+        "team_lead_id": team_lead_id,
+        "days": [f"{year}-{month:02d}-{d:02d}" for d in range(1, days_in_month + 1)],
+        "legend": {"F": "full_day", "H": "half_day", "A": "absent", "L": "leave", "-": "no_record"},
+        "employees": employees
+    }
+
 # Admin mark attendance endpoint
 @router.post("/attendance/mark")
 async def mark_attendance(
@@ -797,49 +1643,42 @@ async def mark_attendance(
         punch_out = None
         work_hours = 0
     
-    # Check if attendance record already exists for this date
-    existing = await db.attendance.find_one({"emp_id": emp_id, "date": date})
+    # One upsert on the unique (emp_id, date) index: concurrent marks for the same day update
+    # the same record instead of racing a find_one against an insert
+    marked = {
+        "status": status,
+        "attendance_status": attendance_status,
+        "punch_in": punch_in,
+        "punch_out": punch_out,
+        "work_hours": work_hours,
+        "conveyance_amount": conveyance,
+        "daily_duty_amount": daily_duty,
+        "location": location,
+        "marked_by": marked_by
+    }
+    created = {
+        "id": generate_id(),
+        "qr_code_id": None,
+        "shift_type": "day",
+        "shift_start": "10:00",
+        "shift_end": "19:00"
+    }
+    now = get_utc_now_str()
+    existing = await db.attendance.find_one_and_update(
+        {"emp_id": emp_id, "date": date},
+        {"$set": {**marked, "updated_at": now}, "$setOnInsert": {**created, "created_at": now}},
+        projection={"_id": 0},
+        upsert=True,
+        return_document=ReturnDocument.BEFORE
+    )
     
     if existing:
-        # Update existing record
-        await db.attendance.update_one(
-            {"emp_id": emp_id, "date": date},
-            {"$set": {
-                "status": status,
-                "attendance_status": attendance_status,
-                "punch_in": punch_in,
-                "punch_out": punch_out,
-                "work_hours": work_hours,
-                "conveyance_amount": conveyance,
-                "daily_duty_amount": daily_duty,
-                "location": location,
-                "marked_by": marked_by,
-                "updated_at": get_utc_now_str()
-            }}
-        )
+        updated = {**existing, **marked}
+        await record_attendance_changes([(existing, updated)], "mark", marked_by)
         message = "Attendance updated"
     else:
-        # Create new attendance record
-        attendance_doc = {
-            "id": generate_id(),
-            "emp_id": emp_id,
-            "date": date,
-            "punch_in": punch_in,
-            "punch_out": punch_out,
-            "status": status,
-            "attendance_status": attendance_status,
-            "work_hours": work_hours,
-            "qr_code_id": None,
-            "location": location,
-            "conveyance_amount": conveyance,
-            "daily_duty_amount": daily_duty,
-            "shift_type": "day",
-            "shift_start": "10:00",
-            "shift_end": "19:00",
-            "marked_by": marked_by,
-            "created_at": get_utc_now_str()
-        }
-        await db.attendance.insert_one(attendance_doc)
+        attendance_doc = {"emp_id": emp_id, "date": date, **created, **marked}
+        await record_attendance_changes([(None, attendance_doc)], "mark", marked_by)
         message = "Attendance created"
     
     return {
@@ -854,13 +1693,159 @@ async def mark_attendance(
         "work_hours": work_hours
     }
 
+# --- Auto-absent materialization ---
+
+AUTO_ABSENT_ENABLED = os.environ.get("AUTO_ABSENT_ENABLED", "true").lower() == "true"
+AUTO_ABSENT_RUN_AT = os.environ.get("AUTO_ABSENT_RUN_AT", "00:30")  # HH:MM UTC, runs for the previous day
+AUTO_ABSENT_CATCHUP_DAYS = int(os.environ.get("AUTO_ABSENT_CATCHUP_DAYS", "3"))
+
+async def materialize_absent_attendance(date: str) -> dict:
+    """
+    Insert an 'absent' attendance record for every active employee with no record on `date`.
+    Holidays and approved leaves are skipped. Uses $setOnInsert upserts on (emp_id, date),
+    so running it again for the same date (or after a crash) never duplicates or overwrites.
+    """
+    job_key = {"job": "auto_absent", "date": date}
+    await db.job_runs.update_one(
+        job_key,
+        {"$set": {"status": "running", "started_at": get_utc_now_str()}},
+        upsert=True
+    )
+    
+    await holiday_calendar.ensure_fresh()
+    holiday = holiday_calendar.get(date)
+    if holiday:
+        result = {"date": date, "holiday": holiday.get("name"), "inserted": 0}
+        await db.job_runs.update_one(job_key, {"$set": {"status": "completed", "finished_at": get_utc_now_str(), "result": result}})
+        return result
+    
+    active_users = await db.users.find(
+        {
+            "status": "active",
+            "role": {"$in": ["employee", "teamlead"]},
+            "$or": [{"joining_date": {"$lte": date}}, {"joining_date": None}, {"joining_date": ""}]
+        },
+        {"_id": 0, "id": 1}
+    ).to_list(None)
+    recorded = set(await db.attendance.distinct("emp_id", {"date": date}))
+    on_leave = set(await db.leaves.distinct("emp_id", leave_overlap_query(date, date, statuses=["approved"])))
+    
+    missing = [u["id"] for u in active_users if u["id"] not in recorded and u["id"] not in on_leave]
+    now = get_utc_now_str()
+    absent_docs = [
+        {
+            "id": generate_id(),
+            "emp_id": emp_id,
+            "date": date,
+            "punch_in": None,
+            "punch_out": None,
+            "status": "absent",
+            "attendance_status": "absent",
+            "work_hours": 0,
+            "qr_code_id": None,
+            "location": None,
+            "conveyance_amount": 0,
+            "daily_duty_amount": 0,
+            "shift_type": "day",
+            "shift_start": "10:00",
+            "shift_end": "19:00",
+            "marked_by": "SYSTEM",
+            "auto_absent": True,
+            "created_at": now
+        }
+        for emp_id in missing
+    ]
+    operations = [
+        UpdateOne({"emp_id": doc["emp_id"], "date": date}, {"$setOnInsert": doc}, upsert=True)
+        for doc in absent_docs
+    ]
+    
+    inserted = 0
+    if operations:
+        write_result = await db.attendance.bulk_write(operations, ordered=False)
+        inserted = write_result.upserted_count
+        # Only records this run actually created are logged (upserted_ids is keyed by op index)
+        await record_attendance_changes(
+            [(None, absent_docs[index]) for index in sorted(write_result.upserted_ids)],
+            "auto_absent",
+            "SYSTEM"
+        )
+    
+    result = {
+        "date": date,
+        "holiday": None,
+        "active_employees": len(active_users),
+        "already_recorded": len(recorded),
+        "on_leave": len(on_leave),
+        "inserted": inserted
+    }
+    await db.job_runs.update_one(job_key, {"$set": {"status": "completed", "finished_at": get_utc_now_str(), "result": result}})
+    return result
+
+@router.post("/attendance/auto-absent")
+async def run_auto_absent(date: Optional[str] = None):
+    """Materialize absent records for a date (default: yesterday, UTC). Safe to re-run."""
+    today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    if date is None:
+        date = (datetime.now(timezone.utc) - timedelta(days=1)).strftime("%Y-%m-%d")
+    # Employees can still punch in today - marking them absent now would block the punch
+    if date >= today:
+        raise HTTPException(status_code=400, detail="Auto-absent can only run for past dates")
+    return await materialize_absent_attendance(date)
+
+async def auto_absent_scheduler():
+    """Nightly loop: catch up on recent days that never completed, then run daily at AUTO_ABSENT_RUN_AT"""
+    run_hour, run_minute = map(int, AUTO_ABSENT_RUN_AT.split(":"))
+    while True:
+        try:
+            today = datetime.now(timezone.utc).date()
+            for days_back in range(AUTO_ABSENT_CATCHUP_DAYS, 0, -1):
+                date = (today - timedelta(days=days_back)).strftime("%Y-%m-%d")
+                done = await db.job_runs.find_one({"job": "auto_absent", "date": date, "status": "completed"})
+                if not done:
+                    result = await materialize_absent_attendance(date)
+                    logger.info("Auto-absent for %s: %s records inserted", date, result["inserted"])
+        except Exception:
+            logger.exception("Auto-absent job failed")
+        
+        now = datetime.now(timezone.utc)
+        next_run = now.replace(hour=run_hour, minute=run_minute, second=0, microsecond=0)
+        if next_run <= now:
+            next_run += timedelta(days=1)
+        await asyncio.sleep((next_run - now).total_seconds())
+
 # ==================== LEAVE ROUTES ====================
 
 @router.post("/leaves", response_model=LeaveResponse)
 async def create_leave(leave: LeaveCreate):
+    """
+    Apply for leave. `days` is always the number of working days from from_date to
+    to_date (see HolidayCalendar.working_days_in_range) - any client value is ignored,
+    and a range with no working days is rejected.
+    """
     leave_doc = leave.model_dump()
+    
+    # Leave days are counted server-side so holidays inside the range are not charged
+    await holiday_calendar.ensure_fresh()
+    try:
+        leave_doc["days"] = holiday_calendar.working_days_in_range(leave.from_date, leave.to_date)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid leave dates")
+    if leave_doc["days"] <= 0:
+        raise HTTPException(status_code=400, detail="Selected dates contain no working days")
+    
+    overlapping = await db.leaves.find_one(
+        leave_overlap_query(leave.from_date, leave.to_date, emp_ids=[leave.emp_id], statuses=["pending", "approved"]),
+        {"_id": 0, "from_date": 1, "to_date": 1, "status": 1}
+    )
+    if overlapping:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Overlaps an existing {overlapping['status']} leave ({overlapping['from_date']} to {overlapping['to_date']})"
+        )
+    
     leave_doc["id"] = generate_id()
-    leave_doc["status"] = LeaveStatus.PENDING
+    leave_doc["status"] = LeaveStatus.PENDING.value
     leave_doc["applied_on"] = get_utc_now_str()[:10]
     
     await db.leaves.insert_one(leave_doc)
@@ -871,7 +1856,7 @@ async def create_leave(leave: LeaveCreate):
         recipient_id="",
         recipient_role="admin",
         title="New Leave Request",
-        message=f"{leave.emp_name} requested {leave.days} days of {leave.type}",
+        message=f"{leave.emp_name} requested {leave_doc['days']} days of {leave.type}",
         notification_type="leave",
         related_id=leave_doc["id"],
         data={"emp_id": leave.emp_id, "action": "created"}
@@ -890,94 +1875,186 @@ async def get_leaves(emp_id: Optional[str] = None, status: Optional[str] = None)
     leaves = await db.leaves.find(query, {"_id": 0}).to_list(1000)
     return leaves
 
-@router.put("/leaves/{leave_id}/approve")
-async def approve_leave(leave_id: str, approved_by: str):
-    leave = await db.leaves.find_one({"id": leave_id}, {"_id": 0})
-    if not leave:
-        raise HTTPException(status_code=404, detail="Leave request not found")
-    
-    result = await db.leaves.update_one(
-        {"id": leave_id},
-        {"$set": {"status": LeaveStatus.APPROVED, "approved_by": approved_by}}
-    )
-    
-    # Update attendance records for leave dates to "leave" status
-    # This converts absent days to approved leave with full day credit
-    emp_id = leave["emp_id"]
-    from_date = leave.get("from_date")
-    to_date = leave.get("to_date", from_date)
+def leave_overlap_query(from_date: str, to_date: str, emp_ids: Optional[list] = None, statuses: Optional[list] = None) -> dict:
+    """Leaves overlapping [from_date, to_date] (inclusive) - served by the (from_date, to_date) indexes"""
+    query = {"from_date": {"$lte": to_date}, "to_date": {"$gte": from_date}}
+    if emp_ids is not None:
+        query["emp_id"] = {"$in": emp_ids}
+    if statuses:
+        query["status"] = {"$in": statuses}
+    return query
+
+LEAVE_CALENDAR_MAX_DAYS = 92
+
+@router.get("/leaves/calendar")
+async def get_leave_calendar(
+    from_date: str,
+    to_date: str,
+    team_lead_id: Optional[str] = None,
+    department: Optional[str] = None,
+    include_pending: bool = False
+):
+    """Who is on leave on each day between from_date and to_date, optionally for one team or department"""
+    try:
+        start = datetime.strptime(from_date, "%Y-%m-%d")
+        end = datetime.strptime(to_date, "%Y-%m-%d")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Dates must be YYYY-MM-DD")
+    if end < start:
+        raise HTTPException(status_code=400, detail="to_date must not be before from_date")
+    if (end - start).days + 1 > LEAVE_CALENDAR_MAX_DAYS:
+        raise HTTPException(status_code=400, detail=f"Range is limited to {LEAVE_CALENDAR_MAX_DAYS} days")
+    
+    emp_ids = None
+    if team_lead_id:
+        members = await db.users.aggregate(
+            team_members_pipeline(team_lead_id) + [{"$project": {"id": 1}}]
+        ).to_list(None)
+        emp_ids = [m["id"] for m in members]
+    elif department:
+        emp_ids = await db.users.distinct("id", {"department": department})
+    
+    statuses = ["approved", "pending"] if include_pending else ["approved"]
+    leaves = await db.leaves.find(
+        leave_overlap_query(from_date, to_date, emp_ids=emp_ids, statuses=statuses),
+        {"_id": 0, "id": 1, "emp_id": 1, "emp_name": 1, "type": 1, "status": 1, "from_date": 1, "to_date": 1}
+    ).to_list(None)
+    
+    await holiday_calendar.ensure_fresh()
+    days = []
+    current = start
+    while current <= end:
+        date_str = current.strftime("%Y-%m-%d")
+        on_leave = [
+            {"emp_id": l["emp_id"], "name": l.get("emp_name"), "type": l.get("type"), "status": l.get("status")}
+            for l in leaves
+            if l["from_date"] <= date_str <= l["to_date"]
+        ]
+        holiday = holiday_calendar.get(date_str)
+        days.append({
+            "date": date_str,
+            "count": len(on_leave),
+            "employees": on_leave,
+            "holiday": holiday.get("name") if holiday else None
+        })
+        current += timedelta(days=1)
     
-    # Get employee salary for daily duty calculation
-    user = await db.users.find_one({"id": emp_id}, {"_id": 0})
+    return {"from_date": from_date, "to_date": to_date, "leaves": len(leaves), "days": days}
+
+def get_leave_daily_duty(user: Optional[dict], from_date: str) -> float:
+    """Full-day duty credited for a leave day - daily rate uses the month the leave starts in"""
+    from calendar import monthrange
     emp_salary = user.get("salary", 0) if user else 0
     salary_type = user.get("salary_type", "monthly") if user else "monthly"
-    
-    # Calculate daily rate based on salary type and leave start date
-    from calendar import monthrange
-    from datetime import datetime, timedelta
     start_date = datetime.strptime(from_date, "%Y-%m-%d")
-    end_date = datetime.strptime(to_date, "%Y-%m-%d")
-    
-    # Use first day of leave to determine month's days
     days_in_month = monthrange(start_date.year, start_date.month)[1]
     
     # For daily wage employees, use salary directly as daily rate
     # For monthly employees, divide by days in month
     if salary_type == "daily":
-        daily_rate = emp_salary  # Use salary directly as daily rate
+        daily_rate = emp_salary
     else:
-        daily_rate = emp_salary / days_in_month  # Monthly: divide by days in month
-    
-    full_day_duty = round(daily_rate, 2)
-    leave_conveyance = 0  # NO conveyance on leave days - only duty amount
+        daily_rate = emp_salary / days_in_month
+    return round(daily_rate, 2)
+
+def build_leave_attendance_ops(leave: dict, user: Optional[dict], existing: dict, now: str):
+    """
+    Attendance upserts that turn every non-holiday day of an approved leave into a
+    'leave' record (full duty, no conveyance). `existing` maps (emp_id, date) to the
+    current attendance doc and is only used to describe the change for the event log.
+    Returns (operations, changes).
+    """
+    emp_id = leave["emp_id"]
+    from_date = leave.get("from_date")
+    to_date = leave.get("to_date") or from_date
+    full_day_duty = get_leave_daily_duty(user, from_date)
+    leave_fields = {
+        "status": "leave",
+        "attendance_status": "leave",
+        "conveyance_amount": 0,  # NO conveyance on leave days - only duty amount
+        "daily_duty_amount": full_day_duty
+    }
     
-    # Update all attendance records within the leave date range
-    current_date = start_date
+    operations = []
+    changes = []
+    current_date = datetime.strptime(from_date, "%Y-%m-%d")
+    end_date = datetime.strptime(to_date, "%Y-%m-%d")
     while current_date <= end_date:
         date_str = current_date.strftime("%Y-%m-%d")
-        
-        # Check if attendance record exists for this date
-        existing_attendance = await db.attendance.find_one({
-            "emp_id": emp_id,
-            "date": date_str
-        })
-        
-        if existing_attendance:
-            # Update existing attendance to "leave" status with full day credits
-            await db.attendance.update_one(
-                {"emp_id": emp_id, "date": date_str},
-                {"$set": {
-                    "status": "leave",
-                    "attendance_status": "leave",
-                    "conveyance_amount": leave_conveyance,  # No conveyance on leave
-                    "daily_duty_amount": full_day_duty
-                }}
-            )
-        else:
-            # Create new attendance record for leave
-            attendance_doc = {
-                "id": generate_id(),
-                "emp_id": emp_id,
-                "date": date_str,
-                "punch_in": None,
-                "punch_out": None,
-                "status": "leave",
-                "attendance_status": "leave",
-                "work_hours": 0,
-                "qr_code_id": None,
-                "location": None,
-                "conveyance_amount": leave_conveyance,  # No conveyance on leave
-                "daily_duty_amount": full_day_duty,
-                "shift_type": "day",
-                "shift_start": "10:00",
-                "shift_end": "19:00"
-            }
-            await db.attendance.insert_one(attendance_doc)
-        
         current_date += timedelta(days=1)
+        if holiday_calendar.is_holiday(date_str):
+            continue
+        
+        insert_fields = {
+            "id": generate_id(),
+            "punch_in": None,
+            "punch_out": None,
+            "work_hours": 0,
+            "qr_code_id": None,
+            "location": None,
+            "shift_type": "day",
+            "shift_start": "10:00",
+            "shift_end": "19:00",
+            "created_at": now
+        }
+        operations.append(UpdateOne(
+            {"emp_id": emp_id, "date": date_str},
+            {"$set": {**leave_fields, "updated_at": now}, "$setOnInsert": insert_fields},
+            upsert=True
+        ))
+        old = existing.get((emp_id, date_str))
+        base = old if old else {**insert_fields, "emp_id": emp_id, "date": date_str}
+        changes.append((old, {**base, **leave_fields}))
+    
+    return operations, changes
+
+async def fetch_attendance_for_ranges(ranges: list) -> dict:
+    """One query for the attendance docs covering [(emp_id, from_date, to_date), ...], keyed by (emp_id, date)"""
+    if not ranges:
+        return {}
+    records = await db.attendance.find(
+        {"$or": [
+            {"emp_id": emp_id, "date": {"$gte": from_date, "$lte": to_date}}
+            for emp_id, from_date, to_date in ranges
+        ]},
+        {"_id": 0}
+    ).to_list(None)
+    return {(r["emp_id"], r["date"]): r for r in records}
+
+@router.put("/leaves/{leave_id}/approve")
+async def approve_leave(leave_id: str, approved_by: str):
+    # Flip the status only if it is still pending, so two approvers cannot both apply it
+    leave = await db.leaves.find_one_and_update(
+        {"id": leave_id, "status": LeaveStatus.PENDING},
+        {"$set": {
+            "status": LeaveStatus.APPROVED,
+            "approved_by": approved_by,
+            "approved_on": get_utc_now_str()
+        }},
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
+    if not leave:
+        await raise_transition_conflict(db.leaves, leave_id, "Leave request not found", "Leave request is already {status}")
     
-    # Notify employee
-    await create_notification(
+    # Convert every leave day to an approved leave record with full day credit,
+    # in one unordered bulk upsert (holidays are not leave days)
+    emp_id = leave["emp_id"]
+    from_date = leave.get("from_date")
+    to_date = leave.get("to_date") or from_date
+    
+    user = await db.users.find_one({"id": emp_id}, {"_id": 0, "salary": 1, "salary_type": 1})
+    existing = await fetch_attendance_for_ranges([(emp_id, from_date, to_date)])
+    await holiday_calendar.ensure_fresh()
+    operations, changes = build_leave_attendance_ops(leave, user, existing, get_utc_now_str())
+    if operations:
+        await db.attendance.bulk_write(operations, ordered=False)
+    await record_attendance_changes(changes, "leave_approved", approved_by)
+    await queue_leave_balance_deltas(leave_balance_deltas_from_leaves([leave]))
+    
+    # Notify employee (after the response)
+    event_queue.publish(
+        create_notification,
         recipient_id=leave["emp_id"],
         title="Leave Approved",
         message=f"Your {leave['type']} request for {leave['days']} days has been approved",
@@ -986,21 +2063,22 @@ async def approve_leave(leave_id: str, approved_by: str):
         data={"action": "approved"}
     )
     
-    return {"message": "Leave approved", "attendance_updated": True}
+    return {"message": "Leave approved", "attendance_updated": True, "days_updated": len(operations)}
 
 @router.put("/leaves/{leave_id}/reject")
 async def reject_leave(leave_id: str, rejected_by: str):
-    leave = await db.leaves.find_one({"id": leave_id}, {"_id": 0})
-    if not leave:
-        raise HTTPException(status_code=404, detail="Leave request not found")
-    
-    result = await db.leaves.update_one(
-        {"id": leave_id},
-        {"$set": {"status": LeaveStatus.REJECTED, "rejected_by": rejected_by}}
+    leave = await db.leaves.find_one_and_update(
+        {"id": leave_id, "status": LeaveStatus.PENDING},
+        {"$set": {"status": LeaveStatus.REJECTED, "rejected_by": rejected_by}},
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
     )
+    if not leave:
+        await raise_transition_conflict(db.leaves, leave_id, "Leave request not found", "Leave request is already {status}")
     
     # Notify employee
-    await create_notification(
+    event_queue.publish(
+        create_notification,
         recipient_id=leave["emp_id"],
         title="Leave Rejected",
         message=f"Your {leave['type']} request for {leave['days']} days has been rejected",
@@ -1091,34 +2169,40 @@ async def approve_bill(bill_id: str, approved_by: str, approved_amount: float, s
     bill goes to 'revalidation' status for remaining amount.
     Cash Out is ALWAYS created for approved amount.
     """
-    bill = await db.bills.find_one({"id": bill_id}, {"_id": 0})
+    # Remaining balance and status are derived from the stored total inside the update,
+    # and only a pending bill matches, so two approvers cannot both pay it
+    if send_to_revalidation:
+        new_status = {"$cond": [{"$gt": ["$remaining_balance", 0]}, "revalidation", BillStatus.APPROVED.value]}
+    else:
+        new_status = {"$literal": BillStatus.APPROVED.value}
+    bill = await db.bills.find_one_and_update(
+        {"id": bill_id, "status": BillStatus.PENDING},
+        [
+            {"$set": {
+                "approved_by": {"$literal": approved_by},
+                "approved_amount": {"$literal": approved_amount},
+                "remaining_balance": {"$subtract": [{"$ifNull": ["$total_amount", 0]}, {"$literal": approved_amount}]},
+                "approved_on": {"$literal": get_utc_now_str()[:10]}
+            }},
+            {"$set": {"status": new_status}}
+        ],
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
     if not bill:
-        raise HTTPException(status_code=404, detail="Bill not found")
+        await raise_transition_conflict(db.bills, bill_id, "Bill not found", "Bill is already {status}")
     
     total_amount = bill.get("total_amount", 0)
-    remaining_balance = total_amount - approved_amount
-    
-    # Determine status based on partial approval and revalidation flag
-    if send_to_revalidation and remaining_balance > 0:
-        new_status = "revalidation"
+    remaining_balance = bill["remaining_balance"]
+    new_status = bill["status"]
+    if new_status == "revalidation":
         message = f"Bill partially approved (₹{approved_amount}). Remaining ₹{remaining_balance} sent for revalidation."
     else:
-        new_status = BillStatus.APPROVED
         message = f"Bill approved for ₹{approved_amount}"
     
-    result = await db.bills.update_one(
-        {"id": bill_id},
-        {"$set": {
-            "status": new_status,
-            "approved_by": approved_by,
-            "approved_amount": approved_amount,
-            "remaining_balance": remaining_balance,
-            "approved_on": get_utc_now_str()[:10]
-        }}
-    )
-    
     # Notify employee
-    await create_notification(
+    event_queue.publish(
+        create_notification,
         recipient_id=bill["emp_id"],
         title="Bill Partially Approved" if send_to_revalidation else "Bill Approved",
         message=f"Your bill of ₹{total_amount} for {bill['month']} has been approved (₹{approved_amount})" + 
@@ -1130,23 +2214,26 @@ async def approve_bill(bill_id: str, approved_by: str, approved_amount: float, s
     
     # ALWAYS create Cash Out entry for approved amount (even for partial approvals)
     if approved_amount > 0:
-        month_num = ["January", "February", "March", "April", "May", "June", 
-                     "July", "August", "September", "October", "November", "December"].index(bill.get("month", "January")) + 1
-        date_str = f"{bill.get('year', 2026)}-{month_num:02d}-{datetime.now().day:02d}"
-        
-        await create_auto_cash_out(
-            category="bills",
-            description=f"Bill Reimbursement - {bill.get('emp_name', '')} ({bill.get('month', '')} {bill.get('year', '')})",
-            amount=approved_amount,
-            date=date_str,
-            reference_id=bill_id,
-            reference_type="bill",
-            month=bill.get("month"),
-            year=bill.get("year")
-        )
+        await create_auto_cash_out(**bill_cash_out_fields(bill, approved_amount))
     
     return {"message": message, "status": new_status, "remaining_balance": remaining_balance}
 
+def bill_cash_out_fields(bill: dict, amount: float) -> dict:
+    """create_auto_cash_out / build_auto_cash_out_doc arguments for an approved bill"""
+    month_num = ["January", "February", "March", "April", "May", "June", 
+                 "July", "August", "September", "October", "November", "December"].index(bill.get("month", "January")) + 1
+    date_str = f"{bill.get('year', 2026)}-{month_num:02d}-{datetime.now().day:02d}"
+    return {
+        "category": "bills",
+        "description": f"Bill Reimbursement - {bill.get('emp_name', '')} ({bill.get('month', '')} {bill.get('year', '')})",
+        "amount": amount,
+        "date": date_str,
+        "reference_id": bill["id"],
+        "reference_type": "bill",
+        "month": bill.get("month"),
+        "year": bill.get("year")
+    }
+
 
 @router.put("/bills/{bill_id}/revalidate")
 async def revalidate_bill(bill_id: str, revalidated_by: str, additional_amount: float = 0):
@@ -1154,45 +2241,49 @@ async def revalidate_bill(bill_id: str, revalidated_by: str, additional_amount:
     Revalidate a bill that was partially approved.
     Admin can approve additional amount or reject the remaining.
     """
-    bill = await db.bills.find_one({"id": bill_id}, {"_id": 0})
+    if additional_amount < 0:
+        raise HTTPException(status_code=400, detail="Additional amount cannot be negative")
+    query = {"id": bill_id, "status": BillStatus.REVALIDATION}
+    if additional_amount > 0:
+        # Never approve more than is still outstanding
+        query["remaining_balance"] = {"$gte": additional_amount}
+    bill = await db.bills.find_one_and_update(
+        query,
+        {
+            "$inc": {"approved_amount": additional_amount, "remaining_balance": -additional_amount},
+            "$set": {
+                "status": BillStatus.APPROVED,
+                "revalidated_by": revalidated_by,
+                "revalidated_on": get_utc_now_str()[:10]
+            }
+        },
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
     if not bill:
-        raise HTTPException(status_code=404, detail="Bill not found")
-    
-    if bill.get("status") != "revalidation":
-        raise HTTPException(status_code=400, detail="Bill is not in revalidation status")
-    
-    current_approved = bill.get("approved_amount", 0)
-    new_total_approved = current_approved + additional_amount
-    remaining = bill.get("total_amount", 0) - new_total_approved
+        current = await db.bills.find_one({"id": bill_id}, {"_id": 0, "status": 1, "remaining_balance": 1})
+        if current and current.get("status") == BillStatus.REVALIDATION:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Additional amount exceeds the remaining balance (₹{current.get('remaining_balance', 0)})"
+            )
+        await raise_transition_conflict(db.bills, bill_id, "Bill not found", "Bill is not in revalidation status")
     
-    await db.bills.update_one(
-        {"id": bill_id},
-        {"$set": {
-            "status": BillStatus.APPROVED,
-            "approved_amount": new_total_approved,
-            "remaining_balance": remaining,
-            "revalidated_by": revalidated_by,
-            "revalidated_on": get_utc_now_str()[:10]
-        }}
-    )
+    new_total_approved = bill["approved_amount"]
+    remaining = bill["remaining_balance"]
     
     # Create cash out for additional approved amount
     if additional_amount > 0:
-        month_num = ["January", "February", "March", "April", "May", "June", 
-                     "July", "August", "September", "October", "November", "December"].index(bill.get("month", "January")) + 1
-        date_str = f"{bill.get('year', 2026)}-{month_num:02d}-{datetime.now().day:02d}"
-        
-        await create_auto_cash_out(
-            category="bills",
+        cash_out = bill_cash_out_fields(bill, additional_amount)
+        cash_out.update(
             description=f"Bill Revalidation - {bill.get('emp_name', '')} ({bill.get('month', '')} {bill.get('year', '')})",
-            amount=additional_amount,
-            date=date_str,
-            reference_id=bill_id,
             reference_type="bill_revalidation"
         )
+        await create_auto_cash_out(**cash_out)
     
     # Notify employee
-    await create_notification(
+    event_queue.publish(
+        create_notification,
         recipient_id=bill["emp_id"],
         title="Bill Revalidated",
         message=f"Your bill has been revalidated. Total approved: ₹{new_total_approved}",
@@ -1205,17 +2296,18 @@ async def revalidate_bill(bill_id: str, revalidated_by: str, additional_amount:
 
 @router.put("/bills/{bill_id}/reject")
 async def reject_bill(bill_id: str, rejected_by: str):
-    bill = await db.bills.find_one({"id": bill_id}, {"_id": 0})
-    if not bill:
-        raise HTTPException(status_code=404, detail="Bill not found")
-    
-    result = await db.bills.update_one(
-        {"id": bill_id},
-        {"$set": {"status": BillStatus.REJECTED, "rejected_by": rejected_by}}
+    bill = await db.bills.find_one_and_update(
+        {"id": bill_id, "status": {"$in": [BillStatus.PENDING, BillStatus.REVALIDATION]}},
+        {"$set": {"status": BillStatus.REJECTED, "rejected_by": rejected_by}},
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
     )
+    if not bill:
+        await raise_transition_conflict(db.bills, bill_id, "Bill not found", "Bill is already {status}")
     
     # Notify employee
-    await create_notification(
+    event_queue.publish(
+        create_notification,
         recipient_id=bill["emp_id"],
         title="Bill Rejected",
         message=f"Your bill of ₹{bill['total_amount']} for {bill['month']} has been rejected",
@@ -1226,38 +2318,410 @@ async def reject_bill(bill_id: str, rejected_by: str):
     
     return {"message": "Bill rejected"}
 
+# ==================== FILE UPLOAD HELPERS ====================
+
+# Uploads are copied to disk in chunks so a large PDF never sits in memory as one
+# bytes object, and every disk call runs in the thread pool so it cannot stall the
+# event loop (and the punch-ins sharing it).
+UPLOAD_DIR = "/app/backend/uploads"
+UPLOAD_CHUNK_SIZE = 256 * 1024
+PDF_MAGIC = b"%PDF-"
+
+def remove_file_quietly(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+async def iter_upload_chunks(upload: UploadFile, max_bytes: int, too_large: str, magic: bytes = None):
+    """
+    Yield an upload in chunks, raising 400 as soon as it grows past max_bytes or
+    (when magic is given) its first bytes do not match.
+    """
+    size = 0
+    while True:
+        chunk = await upload.read(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            return
+        if size == 0 and magic and not chunk.startswith(magic):
+            raise HTTPException(status_code=400, detail="File content does not match the allowed type")
+        size += len(chunk)
+        if size > max_bytes:
+            raise HTTPException(status_code=400, detail=too_large)
+        yield chunk
+
+def write_and_hash_chunk(out, hasher, chunk: bytes):
+    hasher.update(chunk)
+    out.write(chunk)
+
+async def spool_upload(upload: UploadFile, directory: str, max_bytes: int, too_large: str, magic: bytes = None):
+    """
+    Copy an upload into a temp file in `directory`, hashing it on the way.
+    Returns (temp_path, size, sha256 hex); the temp file is removed if any check fails.
+    """
+    await run_in_threadpool(os.makedirs, directory, exist_ok=True)
+    fd, tmp_path = await run_in_threadpool(tempfile.mkstemp, dir=directory, suffix=".part")
+    hasher = hashlib.sha256()
+    size = 0
+    try:
+        with os.fdopen(fd, "wb") as out:
+            async for chunk in iter_upload_chunks(upload, max_bytes, too_large, magic):
+                await run_in_threadpool(write_and_hash_chunk, out, hasher, chunk)
+                size += len(chunk)
+    except BaseException:
+        await run_in_threadpool(remove_file_quietly, tmp_path)
+        raise
+    return tmp_path, size, hasher.hexdigest()
+
+async def read_upload_limited(upload: UploadFile, max_bytes: int, too_large: str, magic: bytes = None) -> bytes:
+    """Read a small upload into memory, stopping at the first chunk past max_bytes"""
+    return b"".join([chunk async for chunk in iter_upload_chunks(upload, max_bytes, too_large, magic)])
+
+# ==================== FILE RESPONSES ====================
+
+# Downloads answer conditional requests (ETag / Last-Modified -> 304) and single byte
+# ranges (206), so re-opening the same PDF during review does not re-send it.
+# Content-addressed files never change and are cached as immutable; anything else is
+# revalidated with its ETag.
+IMMUTABLE_CACHE_CONTROL = "private, max-age=31536000, immutable"
+REVALIDATE_CACHE_CONTROL = "private, no-cache"
+
+def parse_byte_range(range_header: str, size: int):
+    """
+    (start, end) inclusive for a single "bytes=" range, or None when the header should be
+    ignored (other units, multiple ranges, malformed). Raises ValueError if unsatisfiable.
+    """
+    units, _, spec = range_header.partition("=")
+    if units.strip().lower() != "bytes" or "," in spec:
+        return None
+    start_text, dash, end_text = spec.strip().partition("-")
+    if not dash:
+        return None
+    try:
+        start = int(start_text) if start_text else None
+        end = int(end_text) if end_text else None
+    except ValueError:
+        return None
+    if start is None:
+        # Suffix range: the last `end` bytes
+        if not end or size == 0:
+            raise ValueError("unsatisfiable range")
+        return max(size - end, 0), size - 1
+    if end is None or end >= size:
+        end = size - 1
+    if start >= size or start > end:
+        raise ValueError("unsatisfiable range")
+    return start, end
+
+def etag_matches(header: str, etag: str) -> bool:
+    """Weak comparison of an If-None-Match header against an ETag"""
+    tags = [tag.strip() for tag in header.split(",")]
+    return "*" in tags or any(tag.removeprefix("W/") == etag.removeprefix("W/") for tag in tags)
+
+async def iter_file_range(path: str, start: int, length: int):
+    handle = await run_in_threadpool(open, path, "rb")
+    try:
+        await run_in_threadpool(handle.seek, start)
+        while length > 0:
+            chunk = await run_in_threadpool(handle.read, min(UPLOAD_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        await run_in_threadpool(handle.close)
+
+async def file_response(request: Request, path: str, media_type: str = None, filename: str = None,
+                        cache_control: str = REVALIDATE_CACHE_CONTROL, etag: str = None,
+                        not_found: str = "File not found"):
+    """
+    Serve a file with ETag / Last-Modified / Cache-Control headers, answering
+    If-None-Match / If-Modified-Since with 304 and a single Range with 206.
+    `etag` defaults to one derived from mtime and size.
+    """
+    try:
+        stat = await run_in_threadpool(os.stat, path)
+    except (FileNotFoundError, NotADirectoryError):
+        raise HTTPException(status_code=404, detail=not_found)
+    
+    media_type = media_type or mimetypes.guess_type(path)[0] or "application/octet-stream"
+    etag = f'"{etag}"' if etag else f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+    last_modified = formatdate(stat.st_mtime, usegmt=True)
+    headers = {
+        "ETag": etag,
+        "Last-Modified": last_modified,
+        "Cache-Control": cache_control,
+        "Accept-Ranges": "bytes"
+    }
+    
+    if_none_match = request.headers.get("if-none-match")
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_none_match is not None:
+        if etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers=headers)
+    elif if_modified_since:
+        try:
+            if int(stat.st_mtime) <= parsedate_to_datetime(if_modified_since).timestamp():
+                return Response(status_code=304, headers=headers)
+        except (TypeError, ValueError):
+            pass
+    
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and if_range and if_range not in (etag, last_modified):
+        range_header = None  # The client's copy is stale - send the whole file
+    if range_header:
+        try:
+            byte_range = parse_byte_range(range_header, stat.st_size)
+        except ValueError:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{stat.st_size}"})
+        if byte_range:
+            start, end = byte_range
+            headers["Content-Range"] = f"bytes {start}-{end}/{stat.st_size}"
+            headers["Content-Length"] = str(end - start + 1)
+            if filename:
+                headers["Content-Disposition"] = f'attachment; filename="{filename}"'
+            return StreamingResponse(
+                iter_file_range(path, start, end - start + 1),
+                status_code=206, media_type=media_type, headers=headers
+            )
+    
+    return FileResponse(path, media_type=media_type, filename=filename, headers=headers, stat_result=stat)
+
+def resolve_upload_path(relative_path: str) -> str:
+    """
+    Absolute path of a finished file under UPLOAD_DIR. Raises 404 for paths escaping the
+    directory (.., symlinks), hidden files, in-progress uploads and anything not a file.
+    """
+    base = os.path.realpath(UPLOAD_DIR)
+    full_path = os.path.realpath(os.path.join(base, relative_path))
+    name = os.path.basename(full_path)
+    if (
+        os.path.commonpath([base, full_path]) != base
+        or name.startswith(".")
+        or name.endswith((".part", ".gc"))
+        or not os.path.isfile(full_path)
+    ):
+        raise HTTPException(status_code=404, detail="File not found")
+    return full_path
+
+def upload_cache_control(path: str) -> str:
+    """Cache-Control for a file under UPLOAD_DIR - immutable for content-addressed stores"""
+    real_path = os.path.realpath(path)
+    if real_path.startswith(os.path.realpath(PHOTO_DIR) + os.sep):
+        return PHOTO_CACHE_CONTROL
+    if real_path.startswith(os.path.realpath(ATTACHMENT_STORE_DIR) + os.sep):
+        return IMMUTABLE_CACHE_CONTROL
+    return REVALIDATE_CACHE_CONTROL
+
+def attachment_file_response(request: Request, file_path: str, filename: str = None, not_found: str = "File not found"):
+    """file_response for a PDF resolved by resolve_attachment_paths - stored blobs use their hash as ETag"""
+    if file_path.startswith(ATTACHMENT_STORE_DIR + "/"):
+        return file_response(
+            request, file_path, "application/pdf", filename,
+            cache_control=IMMUTABLE_CACHE_CONTROL, etag=os.path.basename(file_path)[:-len(".pdf")],
+            not_found=not_found
+        )
+    return file_response(request, file_path, "application/pdf", filename, not_found=not_found)
+
+# ==================== ATTACHMENT STORE ====================
+
+# PDFs are stored once per content under uploads/cas/ab/cd/<sha256>.pdf.
+#   db.attachments:      one doc per upload {"id", "sha256", "size", "kind", "created_at"}
+#                        - the id is what bill/invoice URLs carry
+#   db.attachment_blobs: one doc per stored file {"sha256", "size", "refcount", ...}
+# Uploading content that is already stored only bumps the refcount. Files uploaded
+# before the store existed stay at their old paths and are still served from there.
+ATTACHMENT_STORE_DIR = f"{UPLOAD_DIR}/cas"
+ATTACHMENT_GC_GRACE_HOURS = int(os.environ.get("ATTACHMENT_GC_GRACE_HOURS", "24"))
+
+def attachment_blob_path(sha256: str) -> str:
+    return f"{ATTACHMENT_STORE_DIR}/{sha256[:2]}/{sha256[2:4]}/{sha256}.pdf"
+
+def commit_attachment_blob(tmp_path: str, blob_path: str, size: int) -> bool:
+    """
+    Move a spooled upload into the store, or drop it when an intact copy (same size)
+    is already there. Returns True when the write was skipped.
+    """
+    if os.path.exists(blob_path) and os.path.getsize(blob_path) == size:
+        os.remove(tmp_path)
+        return True
+    os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+    os.replace(tmp_path, blob_path)
+    return False
+
+async def store_pdf_attachment(upload: UploadFile, kind: str, max_bytes: int, too_large: str) -> dict:
+    """Stream a PDF upload into the content-addressed store and record it; returns the attachment doc"""
+    tmp_path, size, sha256 = await spool_upload(
+        upload, f"{ATTACHMENT_STORE_DIR}/tmp", max_bytes, too_large, magic=PDF_MAGIC
+    )
+    now = get_utc_now_str()
+    blob_update = {
+        "$inc": {"refcount": 1},
+        "$set": {"last_referenced_at": now},
+        "$setOnInsert": {"size": size, "created_at": now}
+    }
+    try:
+        try:
+            await db.attachment_blobs.update_one({"sha256": sha256}, blob_update, upsert=True)
+        except DuplicateKeyError:
+            # Same content uploaded concurrently - the other upsert created the doc
+            await db.attachment_blobs.update_one({"sha256": sha256}, blob_update, upsert=True)
+        deduplicated = await run_in_threadpool(commit_attachment_blob, tmp_path, attachment_blob_path(sha256), size)
+    except BaseException:
+        await run_in_threadpool(remove_file_quietly, tmp_path)
+        raise
+    
+    attachment = {
+        "id": generate_id(),
+        "sha256": sha256,
+        "size": size,
+        "kind": kind,
+        "deduplicated": deduplicated,
+        "created_at": now
+    }
+    await db.attachments.insert_one(attachment.copy())
+    return attachment
+
+async def resolve_attachment_paths(file_ids: list, legacy_dir: str) -> dict:
+    """{file_id: path on disk} - store path for recorded uploads, legacy_dir/<id>.pdf otherwise"""
+    paths = {file_id: f"{legacy_dir}/{file_id}.pdf" for file_id in file_ids}
+    if file_ids:
+        async for doc in db.attachments.find({"id": {"$in": list(file_ids)}}, {"_id": 0, "id": 1, "sha256": 1}):
+            paths[doc["id"]] = attachment_blob_path(doc["sha256"])
+    return paths
+
+def trash_attachment_blob(blob_path: str):
+    """Rename a blob aside before its doc is deleted; a racing upload then rewrites it"""
+    try:
+        os.replace(blob_path, f"{blob_path}.gc")
+        return True
+    except FileNotFoundError:
+        return False
+
+def restore_attachment_blob(blob_path: str):
+    os.replace(f"{blob_path}.gc", blob_path)
+
+async def clear_attachment_store():
+    """Drop every recorded upload and the stored files behind them (used when wiping all data)"""
+    await db.attachments.delete_many({})
+    await db.attachment_blobs.delete_many({})
+    await run_in_threadpool(shutil.rmtree, ATTACHMENT_STORE_DIR, True)
+
+@router.post("/attachments/gc")
+async def collect_attachment_garbage(grace_hours: int = ATTACHMENT_GC_GRACE_HOURS, dry_run: bool = False):
+    """
+    Garbage-collect the attachment store (Admin only).
+    Uploads older than grace_hours that no bill, audit expense or invoice points at are
+    dropped, refcounts are reconciled, and stored files left with no uploads are deleted.
+    """
+    cutoff = (datetime.now(timezone.utc) - timedelta(hours=grace_hours)).isoformat()
+    
+    # Mark: every upload id still referenced by a URL
+    referenced = set()
+    for collection, field in (
+        ("bills", "items.attachment_url"),
+        ("audit_expenses", "items.receipt_url"),
+        ("cash_in", "invoice_pdf_url")
+    ):
+        for url in await db[collection].distinct(field):
+            if isinstance(url, str) and url:
+                referenced.add(url.rstrip("/").split("/")[-1])
+    
+    orphans = await db.attachments.find(
+        {"created_at": {"$lt": cutoff}, "id": {"$nin": list(referenced)}},
+        {"_id": 0, "id": 1, "sha256": 1}
+    ).to_list(None)
+    released = Counter(orphan["sha256"] for orphan in orphans)
+    if orphans and not dry_run:
+        await db.attachments.delete_many({"id": {"$in": [orphan["id"] for orphan in orphans]}})
+    
+    # Reconcile refcounts against the uploads that remain (an interrupted upload can leave
+    # a count too high); the update is conditioned on the count read so it never loses an $inc
+    live_counts = Counter({
+        row["_id"]: row["count"]
+        async for row in db.attachments.aggregate([{"$group": {"_id": "$sha256", "count": {"$sum": 1}}}])
+    })
+    if dry_run:
+        live_counts.subtract(released)
+    blobs = await db.attachment_blobs.find(
+        {"last_referenced_at": {"$lt": cutoff}},
+        {"_id": 0, "sha256": 1, "refcount": 1, "size": 1}
+    ).to_list(None)
+    repairs = [
+        UpdateOne({"sha256": blob["sha256"], "refcount": blob["refcount"]},
+                  {"$set": {"refcount": max(live_counts[blob["sha256"]], 0)}})
+        for blob in blobs if blob.get("refcount") != max(live_counts[blob["sha256"]], 0)
+    ]
+    if repairs and not dry_run:
+        await db.attachment_blobs.bulk_write(repairs, ordered=False)
+    
+    # Sweep: files with no uploads left
+    deleted_files = 0
+    freed_bytes = 0
+    for blob in blobs:
+        if live_counts[blob["sha256"]] > 0:
+            continue
+        if dry_run:
+            deleted_files += 1
+            freed_bytes += blob.get("size", 0)
+            continue
+        blob_path = attachment_blob_path(blob["sha256"])
+        trashed = await run_in_threadpool(trash_attachment_blob, blob_path)
+        removed = await db.attachment_blobs.find_one_and_delete({
+            "sha256": blob["sha256"], "refcount": {"$lte": 0}, "last_referenced_at": {"$lt": cutoff}
+        })
+        if not trashed:
+            continue
+        if removed:
+            await run_in_threadpool(remove_file_quietly, f"{blob_path}.gc")
+            deleted_files += 1
+            freed_bytes += blob.get("size", 0)
+        else:
+            # Referenced again since the scan - put it back
+            await run_in_threadpool(restore_attachment_blob, blob_path)
+    
+    return {
+        "dry_run": dry_run,
+        "orphaned_uploads": len(orphans),
+        "refcounts_repaired": len(repairs),
+        "deleted_files": deleted_files,
+        "freed_bytes": freed_bytes
+    }
+
 # File upload for bill attachments
 @router.post("/bills/upload-attachment")
 async def upload_attachment(file: UploadFile = File(...)):
-    # Check file size (5MB max)
-    contents = await file.read()
-    if len(contents) > 5 * 1024 * 1024:
-        raise HTTPException(status_code=400, detail="File size exceeds 5MB limit")
-    
     # Check file type
     if not file.content_type == "application/pdf":
         raise HTTPException(status_code=400, detail="Only PDF files are allowed")
     
-    # Save file
-    file_id = generate_id()
-    file_path = f"/app/backend/uploads/{file_id}.pdf"
+    # Save file (5MB max, checked while streaming); identical PDFs are stored once
+    attachment = await store_pdf_attachment(file, "bill", 5 * 1024 * 1024, "File size exceeds 5MB limit")
+    file_id = attachment["id"]
     
-    os.makedirs("/app/backend/uploads", exist_ok=True)
-    with open(file_path, "wb") as f:
-        f.write(contents)
-    
-    return {"file_id": file_id, "url": f"/api/bills/attachments/{file_id}"}
+    return {"file_id": file_id, "url": f"/api/bills/attachments/{file_id}", "deduplicated": attachment["deduplicated"]}
 
 @router.get("/bills/attachments/{file_id}")
-async def get_attachment(file_id: str):
-    from fastapi.responses import FileResponse
-    file_path = f"/app/backend/uploads/{file_id}.pdf"
-    if not os.path.exists(file_path):
-        raise HTTPException(status_code=404, detail="File not found")
-    return FileResponse(file_path, media_type="application/pdf")
+async def get_attachment(file_id: str, request: Request):
+    file_path = (await resolve_attachment_paths([file_id], UPLOAD_DIR))[file_id]
+    return await attachment_file_response(request, file_path)
 
 # ==================== PAYSLIP ROUTES ====================
 
+def salary_cash_out_reference(emp_id: str, year: int, month_num: int) -> str:
+    """Cash-out reference_id for an employee's salary in a period (reference_type "salary")"""
+    return f"{emp_id}-{year}-{month_num:02d}"
+
+def get_month_day_counts(year: int, month_num: int):
+    """(holiday_days, working_days) for a month from the in-memory holiday calendar"""
+    from calendar import monthrange
+    days_in_month = monthrange(year, month_num)[1]
+    month_start = f"{year}-{month_num:02d}-01"
+    month_end = f"{year}-{month_num:02d}-{days_in_month:02d}"
+    holiday_days = len(holiday_calendar.holidays_in_range(month_start, month_end))
+    return holiday_days, days_in_month - holiday_days
+
 @router.get("/payslips", response_model=List[PayslipResponse])
 async def get_payslips(
     emp_id: Optional[str] = None,
@@ -1336,6 +2800,9 @@ async def generate_payslip(data: PayslipCreate):
     attendance_conveyance = 0
     total_duty_earned = 0
     
+    await holiday_calendar.ensure_fresh()
+    holiday_days, working_days = get_month_day_counts(data.year, month_num)
+    
     for record in attendance_records:
         att_status = record.get("attendance_status", record.get("status", "present"))
         if att_status == "full_day" or att_status == "present":
@@ -1343,7 +2810,9 @@ async def generate_payslip(data: PayslipCreate):
         elif att_status == "half_day":
             half_days += 1
         elif att_status == "absent":
-            absent_days += 1
+            # No-shows on a holiday are not absences
+            if not holiday_calendar.is_holiday(record.get("date", "")):
+                absent_days += 1
         elif att_status == "leave":
             leave_days += 1
             # Leave counts as full day - already has conveyance and duty set
@@ -1420,6 +2889,8 @@ async def generate_payslip(data: PayslipCreate):
         half_days=half_days,
         absent_days=absent_days,
         leave_days=leave_days,
+        holiday_days=holiday_days,
+        working_days=working_days,
         total_duty_earned=total_duty_earned,
         audit_expenses=total_audit_expenses,
         advance_deduction=advance_deduction,
@@ -1569,6 +3040,9 @@ async def generate_payslip_final(payslip_id: str):
     attendance_conveyance = 0
     total_duty_earned = 0
     
+    await holiday_calendar.ensure_fresh()
+    holiday_days, working_days = get_month_day_counts(year, month_num)
+    
     for record in attendance_records:
         att_status = record.get("attendance_status", record.get("status", "present"))
         if att_status == "full_day" or att_status == "present":
@@ -1576,7 +3050,9 @@ async def generate_payslip_final(payslip_id: str):
         elif att_status == "half_day":
             half_days += 1
         elif att_status == "absent":
-            absent_days += 1
+            # No-shows on a holiday are not absences
+            if not holiday_calendar.is_holiday(record.get("date", "")):
+                absent_days += 1
         elif att_status == "leave":
             leave_days += 1
         attendance_conveyance += record.get("conveyance_amount", 0)
@@ -1650,6 +3126,8 @@ async def generate_payslip_final(payslip_id: str):
         "half_days": half_days,
         "absent_days": absent_days,
         "leave_days": leave_days,
+        "holiday_days": holiday_days,
+        "working_days": working_days,
         "total_duty_earned": round(total_duty_earned, 2),
         "audit_expenses": total_audit_expenses,
         "advance_deduction": advance_deduction,
@@ -1678,24 +3156,20 @@ async def generate_payslip_final(payslip_id: str):
         salary_cash_out_amount = 0
     
     if salary_cash_out_amount > 0:
-        # Delete any existing auto cash-out entry to avoid duplicates
-        await db.cash_out.delete_many({
-            "reference_type": "payslip",
-            "month": month,
-            "year": year,
-            "description": {"$regex": f".*{payslip.get('emp_name', '')}.*"}
-        })
-        
+        # One salary row per employee and period, replaced in place if the payslip is regenerated
+        await db.cash_out.delete_many({"reference_type": "payslip", "reference_id": payslip_id, "is_auto": True})  # legacy key
         date_str = f"{year}-{month_num:02d}-28"
         await create_auto_cash_out(
             category="salary",
             description=f"Salary - {payslip.get('emp_name', '')} ({month} {year})",
             amount=salary_cash_out_amount,
             date=date_str,
-            reference_id=payslip_id,
-            reference_type="payslip",
+            reference_id=salary_cash_out_reference(emp_id, year, month_num),
+            reference_type="salary",
             month=month,
-            year=year
+            year=year,
+            replace=True,
+            extra={"emp_id": emp_id, "payslip_id": payslip_id}
         )
     
     # Create notification for employee
@@ -1756,6 +3230,9 @@ async def recalculate_payslip(payslip_id: str):
     attendance_conveyance = 0
     total_duty_earned = 0
     
+    await holiday_calendar.ensure_fresh()
+    holiday_days, working_days = get_month_day_counts(year, month_num)
+    
     for record in attendance_records:
         att_status = record.get("attendance_status", record.get("status", "present"))
         if att_status == "full_day" or att_status == "present":
@@ -1763,7 +3240,9 @@ async def recalculate_payslip(payslip_id: str):
         elif att_status == "half_day":
             half_days += 1
         elif att_status == "absent":
-            absent_days += 1
+            # No-shows on a holiday are not absences
+            if not holiday_calendar.is_holiday(record.get("date", "")):
+                absent_days += 1
         elif att_status == "leave":
             leave_days += 1
         attendance_conveyance += record.get("conveyance_amount", 0)
@@ -1831,6 +3310,8 @@ async def recalculate_payslip(payslip_id: str):
         "half_days": half_days,
         "absent_days": absent_days,
         "leave_days": leave_days,
+        "holiday_days": holiday_days,
+        "working_days": working_days,
         "total_duty_earned": round(total_duty_earned, 2),
         "audit_expenses": total_audit_expenses,
         "advance_deduction": advance_deduction,
@@ -1883,6 +3364,114 @@ async def settle_payslip(payslip_id: str):
     
     return {"message": "Payslip settled"}
 
+@router.get("/payroll/reconciliation")
+async def get_payroll_reconciliation(month: str, year: int):
+    """
+    Check generated/settled payslips for a period against salary cash-out rows in one aggregation.
+    Each payslip is reported as ok, missing, amount_mismatch or duplicate; salary rows whose
+    payslip no longer exists are reported as orphaned.
+    """
+    months_list = ["January", "February", "March", "April", "May", "June",
+                   "July", "August", "September", "October", "November", "December"]
+    month_name = month.split()[0]
+    if month_name not in months_list:
+        raise HTTPException(status_code=400, detail="Invalid month")
+    month_num = months_list.index(month_name) + 1
+    period_months = [month_name, f"{month_name} {year}"]
+    period_suffix = f"-{year}-{month_num:02d}"
+    
+    # Salary cash out = duty earned + conveyance - advance deduction (see generate_payslip_final)
+    expected_amount = {"$max": [0, {"$round": [{"$subtract": [
+        {"$add": [
+            {"$ifNull": ["$breakdown.total_duty_earned", 0]},
+            {"$ifNull": ["$breakdown.conveyance", 0]}
+        ]},
+        {"$ifNull": ["$breakdown.advance_deduction", 0]}
+    ]}, 2]}]}
+    
+    pipeline = [
+        {"$match": {"year": year, "month": {"$in": period_months}, "status": {"$in": ["generated", "settled"]}}},
+        {"$lookup": {
+            "from": "cash_out",
+            "let": {"reference_id": {"$concat": ["$emp_id", period_suffix]}, "payslip_id": "$id"},
+            "pipeline": [
+                {"$match": {"is_auto": True, "$expr": {"$or": [
+                    {"$and": [{"$eq": ["$reference_type", "salary"]}, {"$eq": ["$reference_id", "$$reference_id"]}]},
+                    # Rows written before salary rows were keyed by employee and period
+                    {"$and": [{"$eq": ["$reference_type", "payslip"]}, {"$eq": ["$reference_id", "$$payslip_id"]}]}
+                ]}}},
+                {"$project": {"_id": 0, "id": 1, "amount": 1}}
+            ],
+            "as": "cash_outs"
+        }},
+        {"$project": {
+            "_id": 0,
+            "kind": "payslip",
+            "payslip_id": "$id",
+            "emp_id": 1,
+            "emp_name": 1,
+            "status": 1,
+            "expected_amount": expected_amount,
+            "cash_out_amount": {"$sum": "$cash_outs.amount"},
+            "cash_out_count": {"$size": "$cash_outs"}
+        }},
+        {"$unionWith": {
+            "coll": "cash_out",
+            "pipeline": [
+                {"$match": {"is_auto": True, "category": "salary", "year": year, "month": {"$in": period_months}}},
+                {"$lookup": {
+                    "from": "payslips",
+                    "let": {"payslip_id": {"$ifNull": ["$payslip_id", "$reference_id"]}},
+                    "pipeline": [
+                        {"$match": {"$expr": {"$eq": ["$id", "$$payslip_id"]}}},
+                        {"$project": {"_id": 0, "status": 1}}
+                    ],
+                    "as": "payslip"
+                }},
+                {"$match": {"$expr": {"$eq": [{"$size": {"$filter": {
+                    "input": "$payslip",
+                    "cond": {"$in": ["$$this.status", ["generated", "settled"]]}
+                }}}, 0]}}},
+                {"$project": {
+                    "_id": 0,
+                    "kind": "orphaned_cash_out",
+                    "cash_out_id": "$id",
+                    "emp_id": 1,
+                    "description": 1,
+                    "cash_out_amount": "$amount"
+                }}
+            ]
+        }}
+    ]
+    rows = await db.payslips.aggregate(pipeline).to_list(None)
+    
+    payslips = []
+    orphaned = []
+    summary = {"ok": 0, "missing": 0, "amount_mismatch": 0, "duplicate": 0}
+    for row in rows:
+        if row["kind"] == "orphaned_cash_out":
+            orphaned.append(row)
+            continue
+        if row["cash_out_count"] == 0:
+            row["result"] = "ok" if row["expected_amount"] == 0 else "missing"
+        elif row["cash_out_count"] > 1:
+            row["result"] = "duplicate"
+        elif abs(row["cash_out_amount"] - row["expected_amount"]) > 0.01:
+            row["result"] = "amount_mismatch"
+        else:
+            row["result"] = "ok"
+        summary[row["result"]] += 1
+        payslips.append(row)
+    
+    return {
+        "month": month_name,
+        "year": year,
+        "consistent": summary["ok"] == len(payslips) and not orphaned,
+        "summary": {**summary, "orphaned_cash_outs": len(orphaned)},
+        "payslips": payslips,
+        "orphaned_cash_outs": orphaned
+    }
+
 @router.get("/payslips/{payslip_id}/download")
 async def download_payslip(payslip_id: str):
     """Generate and download payslip as PDF"""
@@ -1939,6 +3528,66 @@ async def download_payslip(payslip_id: str):
 
 # ==================== HOLIDAY ROUTES ====================
 
+HOLIDAY_CALENDAR_REFRESH_SECONDS = int(os.environ.get("HOLIDAY_CALENDAR_REFRESH_SECONDS", "300"))
+
+class HolidayCalendar:
+    """
+    In-memory date -> holiday map per year, loaded at startup and reloaded whenever
+    holidays change. Lookups and range counts never touch the DB; ensure_fresh()
+    picks up changes made through other workers after the refresh interval.
+    """
+    def __init__(self, refresh_seconds: int):
+        self.refresh_seconds = refresh_seconds
+        self.by_year: dict = {}  # {"2025": {"2025-01-26": holiday_doc}}
+        self.refreshed_at: Optional[datetime] = None
+
+    async def refresh(self):
+        holidays = await db.holidays.find({}, {"_id": 0}).to_list(None)
+        by_year = defaultdict(dict)
+        for holiday in holidays:
+            date = holiday.get("date")
+            if date:
+                by_year[date[:4]].setdefault(date, holiday)
+        self.by_year = dict(by_year)
+        self.refreshed_at = datetime.now(timezone.utc)
+
+    async def ensure_fresh(self):
+        now = datetime.now(timezone.utc)
+        if self.refreshed_at is None or (now - self.refreshed_at).total_seconds() > self.refresh_seconds:
+            await self.refresh()
+
+    def get(self, date: str) -> Optional[dict]:
+        return self.by_year.get(date[:4], {}).get(date)
+
+    def is_holiday(self, date: str) -> bool:
+        return date in self.by_year.get(date[:4], {})
+
+    def holidays_in_range(self, from_date: str, to_date: str) -> list:
+        """Holidays with from_date <= date <= to_date (YYYY-MM-DD strings), sorted by date"""
+        found = []
+        for year in range(int(from_date[:4]), int(to_date[:4]) + 1):
+            for date, holiday in self.by_year.get(str(year), {}).items():
+                if from_date <= date <= to_date:
+                    found.append(holiday)
+        return sorted(found, key=lambda h: h["date"])
+
+    def working_days_in_range(self, from_date: str, to_date: str) -> int:
+        """
+        Days in the inclusive range minus holidays. Weekends count as working days, as in
+        payroll (salary / days_in_month): a leave spanning a Sunday charges that Sunday.
+        """
+        start = datetime.strptime(from_date, "%Y-%m-%d")
+        end = datetime.strptime(to_date, "%Y-%m-%d")
+        if end < start:
+            return 0
+        return (end - start).days + 1 - len(self.holidays_in_range(from_date, to_date))
+
+    def all(self, year: Optional[int] = None) -> list:
+        years = [str(year)] if year else sorted(self.by_year)
+        return [h for y in years for _, h in sorted(self.by_year.get(y, {}).items())]
+
+holiday_calendar = HolidayCalendar(HOLIDAY_CALENDAR_REFRESH_SECONDS)
+
 @router.post("/holidays", response_model=HolidayResponse)
 async def create_holiday(holiday: HolidayCreate):
     holiday_doc = holiday.model_dump()
@@ -1946,43 +3595,173 @@ async def create_holiday(holiday: HolidayCreate):
     
     await db.holidays.insert_one(holiday_doc)
     holiday_doc.pop("_id", None)
+    await holiday_calendar.refresh()
     
     return HolidayResponse(**holiday_doc)
 
 @router.get("/holidays", response_model=List[HolidayResponse])
-async def get_holidays():
-    holidays = await db.holidays.find({}, {"_id": 0}).to_list(100)
-    return holidays
+async def get_holidays(year: Optional[int] = None):
+    await holiday_calendar.ensure_fresh()
+    return holiday_calendar.all(year)
 
 @router.delete("/holidays/{holiday_id}")
 async def delete_holiday(holiday_id: str):
     result = await db.holidays.delete_one({"id": holiday_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Holiday not found")
+    await holiday_calendar.refresh()
     return {"message": "Holiday deleted"}
 
 # ==================== DASHBOARD STATS ====================
 
 @router.get("/dashboard/stats")
 async def get_dashboard_stats():
-    total_users = await db.users.count_documents({"role": {"$ne": "admin"}})
-    active_users = await db.users.count_documents({"role": {"$ne": "admin"}, "status": "active"})
-    
     today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
-    present_today = await db.attendance.count_documents({"date": today, "status": "present"})
-    
-    pending_leaves = await db.leaves.count_documents({"status": "pending"})
-    pending_bills = await db.bills.count_documents({"status": "pending"})
+    (
+        total_users, active_users, present_today, on_leave_today, pending_leaves, pending_bills
+    ) = await asyncio.gather(
+        db.users.count_documents({"role": {"$ne": "admin"}}),
+        db.users.count_documents({"role": {"$ne": "admin"}, "status": "active"}),
+        db.attendance.count_documents({"date": today, "status": "present"}),
+        db.leaves.count_documents(leave_overlap_query(today, today, statuses=["approved"])),
+        db.leaves.count_documents({"status": "pending"}),
+        db.bills.count_documents({"status": "pending"})
+    )
     
     return {
         "total_employees": total_users,
         "active_employees": active_users,
         "present_today": present_today,
         "absent_today": active_users - present_today,
+        "on_leave_today": on_leave_today,
         "pending_leaves": pending_leaves,
         "pending_bills": pending_bills
     }
 
+# ==================== APPROVAL INBOX ====================
+
+# Everything waiting on an approver, per kind: source collection, the statuses that count
+# as open, the submission timestamp field and the lightweight fields an inbox row needs.
+INBOX_SOURCES = {
+    "leave": {
+        "collection": "leaves",
+        "statuses": [LeaveStatus.PENDING.value],
+        "submitted_field": "applied_on",
+        "fields": {"title": "$type", "from_date": 1, "to_date": 1, "days": 1}
+    },
+    "bill": {
+        "collection": "bills",
+        "statuses": [BillStatus.PENDING.value, BillStatus.REVALIDATION.value],
+        "submitted_field": "submitted_on",
+        "fields": {"amount": "$total_amount", "approved_amount": 1, "remaining_balance": 1, "month": 1, "year": 1}
+    },
+    "advance": {
+        "collection": "advances",
+        "statuses": [AdvanceStatus.PENDING.value],
+        "submitted_field": "requested_on",
+        "fields": {"amount": 1, "title": "$reason", "deduct_from_month": 1, "deduct_from_year": 1}
+    },
+    "audit_expense": {
+        "collection": "audit_expenses",
+        "statuses": [AuditExpenseStatus.PENDING.value, AuditExpenseStatus.PARTIALLY_APPROVED.value],
+        "submitted_field": "submitted_on",
+        "fields": {"amount": "$total_amount", "approved_amount": 1, "remaining_balance": 1, "title": "$trip_purpose"}
+    }
+}
+
+def inbox_sort_key(field: str) -> dict:
+    """
+    Comparable submission time: leaves and bills store a UTC date, advances and audit
+    expenses a full ISO timestamp, so date-only values are padded to midnight
+    """
+    value = {"$ifNull": [f"${field}", ""]}
+    date_only = {"$and": [{"$ne": [value, ""]}, {"$eq": [{"$size": {"$split": [value, "T"]}}, 1]}]}
+    return {"$cond": [date_only, {"$concat": [value, "T00:00:00"]}, value]}
+
+def inbox_source_pipeline(kind: str, emp_filter: Optional[dict], limit: int) -> list:
+    """Open items of one kind: the newest `limit` rows and the total count in one $facet"""
+    source = INBOX_SOURCES[kind]
+    match = {"status": {"$in": source["statuses"]}}
+    if emp_filter is not None:
+        match["emp_id"] = emp_filter
+    return [
+        {"$match": match},
+        {"$facet": {
+            "items": [
+                {"$addFields": {"sort_key": inbox_sort_key(source["submitted_field"])}},
+                {"$sort": {"sort_key": -1}},
+                {"$limit": limit},
+                {"$project": {
+                    "_id": 0, "kind": {"$literal": kind}, "id": 1, "emp_id": 1, "emp_name": 1, "status": 1,
+                    "submitted_at": f"${source['submitted_field']}", "sort_key": 1,
+                    **source["fields"]
+                }}
+            ],
+            "count": [{"$count": "n"}]
+        }}
+    ]
+
+@router.get("/inbox")
+async def get_approval_inbox(
+    role: str,
+    user_id: Optional[str] = None,
+    types: Optional[str] = None,
+    page: int = 1,
+    page_size: int = 20
+):
+    """
+    Pending leaves, bills, advances and audit expenses in one list, newest first.
+    Admins see everything, team leads their team's items, anyone else their own.
+    `types` is an optional comma-separated subset of leave,bill,advance,audit_expense.
+    """
+    kinds = [k.strip() for k in types.split(",") if k.strip()] if types else list(INBOX_SOURCES)
+    unknown = [k for k in kinds if k not in INBOX_SOURCES]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown inbox types: {', '.join(unknown)}")
+    page = max(page, 1)
+    page_size = min(max(page_size, 1), 100)
+    
+    if role == "admin":
+        emp_filter = None
+    elif not user_id:
+        raise HTTPException(status_code=400, detail="user_id is required for this role")
+    elif role == "teamlead":
+        members = await db.users.aggregate(
+            team_members_pipeline(user_id) + [{"$project": {"_id": 0, "id": 1}}]
+        ).to_list(None)
+        emp_filter = {"$in": [member["id"] for member in members]}
+    else:
+        emp_filter = user_id
+    
+    # Every kind needs its newest page*page_size rows for the merged page to be exact
+    limit = page * page_size
+    results = await asyncio.gather(*[
+        db[INBOX_SOURCES[kind]["collection"]].aggregate(inbox_source_pipeline(kind, emp_filter, limit)).to_list(1)
+        for kind in kinds
+    ])
+    
+    items = []
+    counts = {}
+    for kind, result in zip(kinds, results):
+        facet = result[0] if result else {"items": [], "count": []}
+        items.extend(facet["items"])
+        counts[kind] = facet["count"][0]["n"] if facet["count"] else 0
+    items.sort(key=lambda item: item["sort_key"], reverse=True)
+    total = sum(counts.values())
+    start = (page - 1) * page_size
+    page_items = items[start:start + page_size]
+    for item in page_items:
+        del item["sort_key"]
+    
+    return {
+        "items": page_items,
+        "counts": counts,
+        "total": total,
+        "page": page,
+        "page_size": page_size,
+        "has_more": start + page_size < total
+    }
+
 # ==================== SEED DATA ====================
 
 @router.post("/clear-all-data")
@@ -1996,6 +3775,11 @@ async def clear_all_data():
     # Delete all collections
     await db.users.delete_many({})
     await db.attendance.delete_many({})
+    await db.attendance_events.delete_many({})
+    await db.attendance_daily_rollup.delete_many({})
+    await db.attendance_rollup_stale.delete_many({})
+    await db.attendance_rollup_rebuilds.delete_many({})
+    await db.leave_balances.delete_many({})
     await db.payslips.delete_many({})
     await db.leaves.delete_many({})
     await db.bills.delete_many({})
@@ -2011,6 +3795,8 @@ async def clear_all_data():
     await db.loan_payments.delete_many({})
     await db.payables.delete_many({})
     await db.team_leader_history.delete_many({})
+    # Bills, audit expenses and invoices are gone, so nothing references their PDFs
+    await clear_attachment_store()
     
     # Create a single admin user for login
     admin_user = {
@@ -2030,6 +3816,7 @@ async def clear_all_data():
     }
     
     await db.users.insert_one(admin_user)
+    await holiday_calendar.refresh()
     
     return {
         "message": "All data cleared successfully",
@@ -2050,6 +3837,10 @@ async def seed_database():
     await db.holidays.delete_many({})
     await db.qr_codes.delete_many({})
     await db.attendance.delete_many({})
+    await db.attendance_events.delete_many({})
+    await db.attendance_daily_rollup.delete_many({})
+    await db.attendance_rollup_stale.delete_many({})
+    await db.attendance_rollup_rebuilds.delete_many({})
     await db.leaves.delete_many({})
     await db.bills.delete_many({})
     await db.payslips.delete_many({})
@@ -2362,62 +4153,10 @@ async def seed_database():
     await db.shift_templates.delete_many({})
     await db.shift_templates.insert_many(shift_templates)
     
-    # Seed leave balances for employees and team leads
-    leave_balances = [
-        {
-            "emp_id": "EMP001",
-            "year": 2026,
-            "casual_leave": 12,
-            "sick_leave": 6,
-            "vacation": 15,
-            "casual_used": 2,
-            "sick_used": 1,
-            "vacation_used": 0
-        },
-        {
-            "emp_id": "EMP002",
-            "year": 2026,
-            "casual_leave": 12,
-            "sick_leave": 6,
-            "vacation": 15,
-            "casual_used": 3,
-            "sick_used": 0,
-            "vacation_used": 5
-        },
-        {
-            "emp_id": "EMP003",
-            "year": 2026,
-            "casual_leave": 12,
-            "sick_leave": 6,
-            "vacation": 15,
-            "casual_used": 0,
-            "sick_used": 2,
-            "vacation_used": 3
-        },
-        {
-            "emp_id": "TL001",
-            "year": 2026,
-            "casual_leave": 15,
-            "sick_leave": 8,
-            "vacation": 18,
-            "casual_used": 1,
-            "sick_used": 0,
-            "vacation_used": 2
-        },
-        {
-            "emp_id": "TL002",
-            "year": 2026,
-            "casual_leave": 15,
-            "sick_leave": 8,
-            "vacation": 18,
-            "casual_used": 2,
-            "sick_used": 1,
-            "vacation_used": 0
-        }
-    ]
-    
+    # Leave balances are materialized from attendance - rebuilt on first read
     await db.leave_balances.delete_many({})
-    await db.leave_balances.insert_many(leave_balances)
+    
+    await holiday_calendar.refresh()
     
     return {"message": "Database seeded successfully"}
 
@@ -2437,99 +4176,413 @@ async def update_profile(user_id: str, profile: ProfileUpdate):
     updated_user = await db.users.find_one({"id": user_id}, {"_id": 0, "password": 0})
     return updated_user
 
+# Profile photos are decoded once and stored as square thumbnails under
+# uploads/photos/<content hash>/<size>.webp; the user document only holds their URLs
+# (photo = largest, photo_thumbnails = {size: url}). A new photo gets a new hash and so
+# new URLs, which lets browsers cache the files forever.
+PHOTO_DIR = f"{UPLOAD_DIR}/photos"
+PHOTO_THUMBNAIL_SIZES = (48, 128, 256)
+PHOTO_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+def render_photo_thumbnails(contents: bytes) -> dict:
+    """
+    Decode a photo and write its thumbnails (WebP, JPEG if Pillow lacks WebP) - runs in a
+    worker thread. Returns {str(size): url}; files that already exist are not re-encoded.
+    """
+    digest = hashlib.sha256(contents).hexdigest()[:32]
+    directory = f"{PHOTO_DIR}/{digest}"
+    fmt, ext = ("WEBP", "webp") if pil_features.check("webp") else ("JPEG", "jpg")
+    urls = {str(size): f"/api/photos/{digest}/{size}.{ext}" for size in PHOTO_THUMBNAIL_SIZES}
+    pending = [size for size in PHOTO_THUMBNAIL_SIZES if not os.path.exists(f"{directory}/{size}.{ext}")]
+    if not pending:
+        return urls
+    
+    try:
+        with Image.open(io.BytesIO(contents)) as image:
+            # JPEGs can be decoded at a reduced scale when only small sizes are needed
+            image.draft("RGB", (max(pending), max(pending)))
+            image = ImageOps.exif_transpose(image)
+            image = image.convert("RGBA" if fmt == "WEBP" and image.mode in ("RGBA", "LA", "P") else "RGB")
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError):
+        raise HTTPException(status_code=400, detail="Photo must be a valid image file")
+    
+    os.makedirs(directory, exist_ok=True)
+    for size in pending:
+        path = f"{directory}/{size}.{ext}"
+        thumbnail = ImageOps.fit(image, (size, size), Image.Resampling.LANCZOS)
+        tmp_path = f"{path}.{secrets.token_hex(4)}.part"
+        thumbnail.save(tmp_path, fmt, quality=82)
+        os.replace(tmp_path, path)
+    return urls
+
+def photo_fields(thumbnails: dict) -> dict:
+    return {"photo": thumbnails[str(max(PHOTO_THUMBNAIL_SIZES))], "photo_thumbnails": thumbnails}
+
 @router.post("/users/{user_id}/photo")
 async def upload_profile_photo(user_id: str, photo: UploadFile = File(...)):
     """Upload profile photo"""
-    user = await db.users.find_one({"id": user_id})
+    user = await db.users.find_one({"id": user_id}, {"_id": 0, "id": 1})
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
-    # Read and encode photo
-    contents = await photo.read()
-    if len(contents) > 2 * 1024 * 1024:  # 2MB limit
-        raise HTTPException(status_code=400, detail="Photo size must be less than 2MB")
+    # Read the photo (2MB limit, checked while reading) and resize it off the event loop
+    contents = await read_upload_limited(photo, 2 * 1024 * 1024, "Photo size must be less than 2MB")
+    fields = photo_fields(await run_in_threadpool(render_photo_thumbnails, contents))
     
-    photo_base64 = base64.b64encode(contents).decode()
-    photo_data = f"data:{photo.content_type};base64,{photo_base64}"
+    await db.users.update_one({"id": user_id}, {"$set": fields})
     
-    await db.users.update_one({"id": user_id}, {"$set": {"photo": photo_data}})
+    return {"message": "Photo uploaded successfully", **fields}
+
+@router.get("/photos/{digest}/{name}")
+async def get_photo_thumbnail(digest: str, name: str, request: Request):
+    """Serve a profile photo thumbnail (content-addressed, cacheable forever)"""
+    match = re.fullmatch(r"(\d+)\.(webp|jpg)", name)
+    if not re.fullmatch(r"[0-9a-f]{32}", digest) or not match:
+        raise HTTPException(status_code=404, detail="Photo not found")
+    media_type = "image/webp" if match.group(2) == "webp" else "image/jpeg"
+    return await file_response(
+        request, f"{PHOTO_DIR}/{digest}/{name}", media_type,
+        cache_control=PHOTO_CACHE_CONTROL, etag=f"{digest}-{name}", not_found="Photo not found"
+    )
+
+def decode_data_uri_photo(data_uri: str) -> dict:
+    """Thumbnails for a legacy base64 data URI photo (worker thread)"""
+    return render_photo_thumbnails(base64.b64decode(data_uri.split(",", 1)[-1]))
+
+@router.post("/users/photos/migrate")
+async def migrate_profile_photos():
+    """Convert photos stored inline as base64 data URIs into thumbnail files (Admin only)"""
+    migrated = 0
+    failed = []
+    operations = []
+    async for user in db.users.find({"photo": {"$regex": "^data:"}}, {"_id": 0, "id": 1, "photo": 1}):
+        try:
+            thumbnails = await run_in_threadpool(decode_data_uri_photo, user["photo"])
+        except (HTTPException, ValueError):
+            failed.append(user["id"])
+            continue
+        # Only replace the photo the scan read, in case the user uploaded a new one meanwhile
+        operations.append(UpdateOne({"id": user["id"], "photo": user["photo"]}, {"$set": photo_fields(thumbnails)}))
+        if len(operations) >= 100:
+            migrated += (await db.users.bulk_write(operations, ordered=False)).modified_count
+            operations = []
+    if operations:
+        migrated += (await db.users.bulk_write(operations, ordered=False)).modified_count
     
-    return {"message": "Photo uploaded successfully", "photo": photo_data}
+    return {"message": f"{migrated} photos migrated", "migrated": migrated, "failed": failed}
 
 # ==================== LEAVE BALANCE ROUTES ====================
 
+# Leave balances are materialized per (emp_id, year) in db.leave_balances:
+#   {"emp_id", "year", "months": {"01": {"full_days", "leave_days"}, ...}, "used_from_requests"}
+# Attendance changes and leave approvals apply $inc deltas to existing documents on the
+# background queue; missing or stale documents are rebuilt from attendance on read. Each
+# document carries the window of the rebuild that produced it (rebuild_started, rebuilt_at)
+# so deltas that race a rebuild mark it stale instead of being counted twice or lost.
+
+LEAVE_ACCRUAL_MIN_FULL_DAYS = 24  # Full days in a month that earn one leave
+
+def leave_balance_deltas_from_events(events: list) -> dict:
+    """{(emp_id, year): Counter of $inc paths} for the full/leave day changes in attendance events"""
+    deltas = defaultdict(Counter)
+    for event in events:
+        date = event.get("date") or ""
+        if len(date) < 7:
+            continue
+        key = (event["emp_id"], int(date[:4]))
+        for field, status in (("full_days", "full_day"), ("leave_days", "leave")):
+            change = (event.get("new_status") == status) - (event.get("old_status") == status)
+            if change:
+                deltas[key][f"months.{date[5:7]}.{field}"] += change
+    return deltas
+
+def leave_balance_deltas_from_leaves(leaves: list) -> dict:
+    """{(emp_id, year): Counter} adding approved leave request days (year of from_date)"""
+    deltas = defaultdict(Counter)
+    for leave in leaves:
+        deltas[(leave["emp_id"], int(leave["from_date"][:4]))]["used_from_requests"] += leave.get("days", 0)
+    return deltas
+
+async def apply_leave_balance_deltas(deltas: dict, queued_at: str):
+    """Apply $inc deltas to existing balance documents only - absent ones are built on first read"""
+    keys = [key for key, counter in deltas.items() if any(counter.values())]
+    if not keys:
+        return
+    try:
+        docs = await db.leave_balances.find(
+            {"$or": [{"emp_id": emp_id, "year": year} for emp_id, year in keys]},
+            {"_id": 0, "emp_id": 1, "year": 1, "rebuild_started": 1, "rebuilt_at": 1}
+        ).to_list(None)
+        now = get_utc_now_str()
+        operations, applied, stale = [], [], []
+        for doc in docs:
+            key = (doc["emp_id"], doc["year"])
+            action = classify_queued_delta(queued_at, doc.get("rebuild_started"), doc.get("rebuilt_at"))
+            if action == "stale":
+                stale.append(key)
+            elif action == "apply":
+                # Matches only the generation that was classified
+                operations.append(UpdateOne(
+                    {"emp_id": key[0], "year": key[1],
+                     "rebuild_started": doc.get("rebuild_started"), "rebuilt_at": doc.get("rebuilt_at")},
+                    {"$inc": {path: value for path, value in deltas[key].items() if value}, "$set": {"updated_at": now}}
+                ))
+                applied.append(key)
+        if operations:
+            result = await db.leave_balances.bulk_write(operations, ordered=False)
+            if result.matched_count < len(operations):
+                # A rebuild started on some of them after they were read
+                stale.extend(applied)
+        if stale:
+            await mark_leave_balances_stale(stale)
+    except Exception:
+        logger.exception("Leave balance update failed - marking balances stale")
+        await mark_leave_balances_stale(keys)
+
+async def mark_leave_balances_stale(keys: list):
+    await db.leave_balances.update_many(
+        {"$or": [{"emp_id": emp_id, "year": year} for emp_id, year in keys]},
+        {"$set": {"stale": True}}
+    )
+
+async def queue_leave_balance_deltas(deltas: dict, queued_at: Optional[str] = None):
+    if not deltas:
+        return
+    if not event_queue.publish(apply_leave_balance_deltas, deltas, queued_at or get_utc_now_str()):
+        # Dropped under overload - have the affected balances rebuilt on next read
+        await mark_leave_balances_stale(list(deltas))
+
+async def rebuild_leave_balances(year: int, emp_ids: Optional[list] = None) -> list:
+    """
+    Recompute balance documents for a year from attendance (one $group by employee and month)
+    plus approved leave requests, and store them. Without emp_ids every employee with
+    attendance or approved leaves in the year is rebuilt. Returns the documents.
+    """
+    started = get_utc_now_str()
+    # Deltas queued from here until the replacement is written mark the balances stale; the
+    # requested employees get a placeholder (no "months") so deltas cannot miss them either
+    if emp_ids is not None:
+        if emp_ids:
+            await db.leave_balances.bulk_write([
+                UpdateOne({"emp_id": emp_id, "year": year}, {"$set": {"rebuild_started": started}}, upsert=True)
+                for emp_id in emp_ids
+            ], ordered=False)
+    else:
+        await db.leave_balances.update_many({"year": year}, {"$set": {"rebuild_started": started}})
+    
+    attendance_match = {
+        "date": {"$gte": f"{year}-01-01", "$lt": f"{year + 1}-01-01"},
+        "attendance_status": {"$in": ["full_day", "leave"]}
+    }
+    leave_match = {"status": "approved", "from_date": {"$gte": f"{year}-01-01", "$lte": f"{year}-12-31"}}
+    if emp_ids is not None:
+        attendance_match["emp_id"] = {"$in": emp_ids}
+        leave_match["emp_id"] = {"$in": emp_ids}
+    
+    monthly = await db.attendance.aggregate([
+        {"$match": attendance_match},
+        {"$group": {
+            "_id": {"emp_id": "$emp_id", "month": {"$substrBytes": ["$date", 5, 2]}},
+            "full_days": {"$sum": {"$cond": [{"$eq": ["$attendance_status", "full_day"]}, 1, 0]}},
+            "leave_days": {"$sum": {"$cond": [{"$eq": ["$attendance_status", "leave"]}, 1, 0]}}
+        }}
+    ]).to_list(None)
+    used = await db.leaves.aggregate([
+        {"$match": leave_match},
+        {"$group": {"_id": "$emp_id", "days": {"$sum": "$days"}}}
+    ]).to_list(None)
+    
+    now = get_utc_now_str()
+    docs = {
+        emp_id: {"emp_id": emp_id, "year": year, "months": {}, "used_from_requests": 0, "updated_at": now}
+        for emp_id in (emp_ids or [])
+    }
+    for row in monthly:
+        emp_id = row["_id"]["emp_id"]
+        doc = docs.setdefault(emp_id, {"emp_id": emp_id, "year": year, "months": {}, "used_from_requests": 0, "updated_at": now})
+        doc["months"][row["_id"]["month"]] = {"full_days": row["full_days"], "leave_days": row["leave_days"]}
+    for row in used:
+        doc = docs.setdefault(row["_id"], {"emp_id": row["_id"], "year": year, "months": {}, "used_from_requests": 0, "updated_at": now})
+        doc["used_from_requests"] = row["days"]
+    for doc in docs.values():
+        doc.update(rebuild_started=started, rebuilt_at=now)
+    
+    if docs:
+        await db.leave_balances.bulk_write([
+            ReplaceOne({"emp_id": doc["emp_id"], "year": year}, doc, upsert=True)
+            for doc in docs.values()
+        ], ordered=False)
+    return list(docs.values())
+
+def summarize_leave_balance(doc: dict) -> dict:
+    """Accrual rule: one leave for each month with LEAVE_ACCRUAL_MIN_FULL_DAYS+ full days"""
+    months = doc.get("months", {}).values()
+    leave_days_from_attendance = sum(m.get("leave_days", 0) for m in months)
+    return {
+        "emp_id": doc["emp_id"],
+        "year": doc["year"],
+        "total_leave": sum(1 for m in months if m.get("full_days", 0) >= LEAVE_ACCRUAL_MIN_FULL_DAYS),
+        # Approved leaves also create leave attendance, so take the larger count to avoid double counting
+        "total_used": max(doc.get("used_from_requests", 0), leave_days_from_attendance),
+        "working_days_count": sum(m.get("full_days", 0) for m in months)
+    }
+
 @router.get("/leave-balance/{emp_id}", response_model=LeaveBalanceResponse)
 async def get_leave_balance(emp_id: str, year: int = None):
-    """Get employee leave balance for a year - calculated based on monthly working days"""
+    """Get employee leave balance for a year - one document read from the materialized balances"""
     if year is None:
         year = datetime.now().year
     
-    # Calculate leave accrual per month
-    # Rule: If employee has 24+ working days in a month, 1 leave is accrued for that month
-    total_accrued = 0
-    total_working_days = 0
-    total_leave_days_from_attendance = 0
-    
-    for month in range(1, 13):
-        month_str = f"{year}-{month:02d}"
-        
-        # Get attendance records for this month
-        attendance_records = await db.attendance.find({
-            "emp_id": emp_id,
-            "date": {"$regex": f"^{month_str}"}
-        }).to_list(100)
-        
-        # Count full days (actual working days via QR punch-in)
-        # Only full_day counts towards the 24 days requirement
-        working_days_in_month = sum(1 for a in attendance_records 
-                                    if a.get("attendance_status") == "full_day")
-        
-        # Count leave days from attendance records (admin marked directly as leave)
-        leave_days_in_month = sum(1 for a in attendance_records 
-                                   if a.get("attendance_status") == "leave")
-        
-        total_working_days += working_days_in_month
-        total_leave_days_from_attendance += leave_days_in_month
-        
-        # If 24+ working days in this month, add 1 leave
-        if working_days_in_month >= 24:
-            total_accrued += 1
-    
-    # Get used leaves from approved leave requests
-    approved_leaves = await db.leaves.find({
-        "emp_id": emp_id,
-        "status": "approved",
-        "from_date": {"$gte": f"{year}-01-01", "$lte": f"{year}-12-31"}
-    }).to_list(100)
-    
-    # Total used = approved leave requests + direct attendance leave markings
-    # But avoid double counting - attendance marked as leave via approval already has a leave request
-    # So we only count attendance leaves that DON'T have a corresponding leave request
-    leaves_from_requests = sum(l.get("days", 0) for l in approved_leaves)
+    doc = await db.leave_balances.find_one({"emp_id": emp_id, "year": year}, {"_id": 0})
+    # No months: a placeholder left by a rebuild that never finished
+    if not doc or "months" not in doc or doc.get("stale"):
+        doc = (await rebuild_leave_balances(year, [emp_id]))[0]
     
-    # Total used leaves = from approved requests + from direct attendance marking (avoiding duplicates)
-    # Since approved leaves create attendance records, we use the max of both to avoid under-counting
-    total_used = max(leaves_from_requests, total_leave_days_from_attendance)
+    return LeaveBalanceResponse(**summarize_leave_balance(doc))
+
+@router.put("/leave-balance/{emp_id}")
+async def update_leave_balance(emp_id: str, days: int = 0, year: int = None):
+    """Recalculate an employee's stored leave balance from attendance and approved leaves"""
+    if days:
+        raise HTTPException(
+            status_code=400,
+            detail="Leave balances cannot be adjusted by days - they are recalculated from attendance and approved leaves"
+        )
+    if year is None:
+        year = datetime.now().year
     
-    balance = {
-        "emp_id": emp_id,
-        "year": year,
-        "total_leave": total_accrued,
-        "total_used": total_used,
-        "working_days_count": total_working_days
-    }
+    doc = (await rebuild_leave_balances(year, [emp_id]))[0]
+    return {"message": "Leave balance updated", "balance": summarize_leave_balance(doc)}
+
+@router.post("/leave-balance/rebuild")
+async def rebuild_all_leave_balances(year: int = None):
+    """Rebuild every stored leave balance for a year (e.g. after bulk data fixes)"""
+    if year is None:
+        year = datetime.now().year
     
-    return LeaveBalanceResponse(**balance)
+    docs = await rebuild_leave_balances(year)
+    return {"message": f"{len(docs)} leave balances rebuilt", "year": year, "count": len(docs)}
 
-@router.put("/leave-balance/{emp_id}")
-async def update_leave_balance(emp_id: str, days: int, year: int = None):
-    """Update leave balance when leave is approved"""
+def leave_balance_report_pipeline(year: int, department: Optional[str] = None, status: Optional[str] = None) -> list:
+    """
+    One users-rooted aggregation computing every employee's leave balance for a year:
+    attendance grouped by month (accrual rule applied in the pipeline) and approved
+    leave request days, each joined with a $lookup.
+    """
+    user_match = {"role": {"$in": ["employee", "teamlead"]}}
+    if department:
+        user_match["department"] = department
+    if status:
+        user_match["status"] = status
+    year_start = f"{year}-01-01"
+    year_end = f"{year + 1}-01-01"
+    
+    return [
+        {"$match": user_match},
+        {"$lookup": {
+            "from": "attendance",
+            "let": {"emp_id": "$id"},
+            "pipeline": [
+                {"$match": {
+                    "attendance_status": {"$in": ["full_day", "leave"]},
+                    "$expr": {"$and": [
+                        {"$eq": ["$emp_id", "$$emp_id"]},
+                        {"$gte": ["$date", year_start]},
+                        {"$lt": ["$date", year_end]}
+                    ]}
+                }},
+                {"$group": {
+                    "_id": {"$substrBytes": ["$date", 5, 2]},
+                    "full_days": {"$sum": {"$cond": [{"$eq": ["$attendance_status", "full_day"]}, 1, 0]}},
+                    "leave_days": {"$sum": {"$cond": [{"$eq": ["$attendance_status", "leave"]}, 1, 0]}}
+                }}
+            ],
+            "as": "months"
+        }},
+        {"$lookup": {
+            "from": "leaves",
+            "let": {"emp_id": "$id"},
+            "pipeline": [
+                {"$match": {
+                    "status": "approved",
+                    "$expr": {"$and": [
+                        {"$eq": ["$emp_id", "$$emp_id"]},
+                        {"$gte": ["$from_date", year_start]},
+                        {"$lt": ["$from_date", year_end]}
+                    ]}
+                }},
+                {"$group": {"_id": None, "days": {"$sum": "$days"}}}
+            ],
+            "as": "requests"
+        }},
+        {"$project": {
+            "_id": 0,
+            "emp_id": "$id",
+            "name": 1,
+            "department": 1,
+            "role": 1,
+            "accrued": {"$size": {"$filter": {
+                "input": "$months",
+                "cond": {"$gte": ["$$this.full_days", LEAVE_ACCRUAL_MIN_FULL_DAYS]}
+            }}},
+            "working_days": {"$sum": "$months.full_days"},
+            "attendance_leave_days": {"$sum": "$months.leave_days"},
+            "requested_days": {"$ifNull": [{"$arrayElemAt": ["$requests.days", 0]}, 0]}
+        }},
+        # Approved leaves also create leave attendance, so take the larger count (same as the per-employee balance)
+        {"$addFields": {"used": {"$max": ["$requested_days", "$attendance_leave_days"]}}},
+        {"$addFields": {"remaining": {"$subtract": ["$accrued", "$used"]}}},
+        {"$sort": {"department": 1, "name": 1}}
+    ]
+
+@router.get("/leave-balance")
+async def get_leave_balance_report(
+    year: Optional[int] = None,
+    department: Optional[str] = None,
+    status: Optional[str] = None,
+    format: str = "json"
+):
+    """Accrued, used and remaining leave for every employee in a year - one aggregation, JSON or streamed CSV"""
     if year is None:
         year = datetime.now().year
+    pipeline = leave_balance_report_pipeline(year, department, status)
+    
+    if format != "csv":
+        rows = await db.users.aggregate(pipeline).to_list(None)
+        return {"year": year, "accrual_min_full_days": LEAVE_ACCRUAL_MIN_FULL_DAYS, "employees": rows}
     
-    # Leave balance is now calculated dynamically, so this just validates
-    # The actual used count comes from approved leaves in the database
-    return {"message": "Leave balance updated"}
+    async def csv_rows():
+        output = io.StringIO()
+        writer = csv.writer(output)
+        writer.writerow([
+            "Employee ID", "Name", "Department", "Role", "Full Days",
+            "Accrued", "Used (Requests)", "Used (Attendance)", "Used", "Remaining"
+        ])
+        async for row in db.users.aggregate(pipeline):
+            writer.writerow([
+                row.get("emp_id", ""),
+                row.get("name", ""),
+                row.get("department", ""),
+                row.get("role", ""),
+                row.get("working_days", 0),
+                row.get("accrued", 0),
+                row.get("requested_days", 0),
+                row.get("attendance_leave_days", 0),
+                row.get("used", 0),
+                row.get("remaining", 0)
+            ])
+            if output.tell() > 64 * 1024:
+                yield output.getvalue()
+                output.seek(0)
+                output.truncate(0)
+        yield output.getvalue()
+    
+    filename = f"leave_balances_{year}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
+    return StreamingResponse(
+        csv_rows(),
+        media_type="text/csv",
+        headers={"Content-Disposition": f"attachment; filename={filename}"}
+    )
 
 # ==================== SALARY ADVANCE ROUTES ====================
 
@@ -2614,29 +4667,23 @@ async def get_advances(emp_id: str = None, status: str = None):
 @router.put("/advances/{advance_id}/approve")
 async def approve_advance(advance_id: str, approved_by: str):
     """Approve a salary advance request"""
-    advance = await db.advances.find_one({"id": advance_id}, {"_id": 0})
-    if not advance:
-        raise HTTPException(status_code=404, detail="Advance not found")
-    
-    result = await db.advances.update_one(
+    advance = await db.advances.find_one_and_update(
         {"id": advance_id, "status": AdvanceStatus.PENDING},
         {"$set": {
             "status": AdvanceStatus.APPROVED,
             "approved_by": approved_by,
             "approved_on": get_utc_now_str()
-        }}
+        }},
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
     )
-    
-    if result.modified_count == 0:
-        raise HTTPException(status_code=400, detail="Advance already processed")
+    if not advance:
+        await raise_transition_conflict(db.advances, advance_id, "Advance not found", "Advance already processed")
     
     # Create Cash Out entry for "Advance Given"
     # This records when money is given to employee
     deduct_month = advance.get('deduct_from_month', 'January')
     deduct_year = advance.get('deduct_from_year', 2026)
-    month_num = ["January", "February", "March", "April", "May", "June", 
-                 "July", "August", "September", "October", "November", "December"].index(deduct_month) + 1
-    date_str = f"{deduct_year}-{month_num:02d}-{datetime.now().day:02d}"
     
     await create_auto_cash_out(
         category="advance",
@@ -2650,7 +4697,8 @@ async def approve_advance(advance_id: str, approved_by: str):
     )
     
     # Notify employee
-    await create_notification(
+    event_queue.publish(
+        create_notification,
         recipient_id=advance["emp_id"],
         title="Advance Approved",
         message=f"Your advance request of ₹{advance['amount']} has been approved. It will be deducted from {advance.get('deduct_from_month', '')} {advance.get('deduct_from_year', '')} salary.",
@@ -2659,30 +4707,27 @@ async def approve_advance(advance_id: str, approved_by: str):
         data={"action": "advance_approved"}
     )
     
-    advance = await db.advances.find_one({"id": advance_id}, {"_id": 0})
     return advance
 
 @router.put("/advances/{advance_id}/reject")
 async def reject_advance(advance_id: str, rejected_by: str):
     """Reject a salary advance request"""
-    advance = await db.advances.find_one({"id": advance_id}, {"_id": 0})
-    if not advance:
-        raise HTTPException(status_code=404, detail="Advance not found")
-    
-    result = await db.advances.update_one(
+    advance = await db.advances.find_one_and_update(
         {"id": advance_id, "status": AdvanceStatus.PENDING},
         {"$set": {
             "status": AdvanceStatus.REJECTED,
             "approved_by": rejected_by,
             "approved_on": get_utc_now_str()
-        }}
+        }},
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
     )
-    
-    if result.modified_count == 0:
-        raise HTTPException(status_code=400, detail="Advance already processed")
+    if not advance:
+        await raise_transition_conflict(db.advances, advance_id, "Advance not found", "Advance already processed")
     
     # Notify employee
-    await create_notification(
+    event_queue.publish(
+        create_notification,
         recipient_id=advance["emp_id"],
         title="Advance Rejected",
         message=f"Your advance request of ₹{advance['amount']} has been rejected.",
@@ -2691,7 +4736,6 @@ async def reject_advance(advance_id: str, rejected_by: str):
         data={"action": "advance_rejected"}
     )
     
-    advance = await db.advances.find_one({"id": advance_id}, {"_id": 0})
     return advance
 
 # ==================== SHIFT TEMPLATE ROUTES ====================
@@ -2757,23 +4801,67 @@ async def delete_shift_template(template_id: str):
 
 @router.post("/leaves/bulk-approve")
 async def bulk_approve_leaves(data: BulkApproveRequest):
-    """Bulk approve multiple leave requests"""
+    """
+    Bulk approve multiple leave requests - same attendance effect as approve_leave,
+    but a fixed handful of round trips however many leaves are selected
+    """
+    # Tag the leaves this request flips so concurrent approvals never double-apply
+    batch_id = generate_id()
+    now = get_utc_now_str()
     result = await db.leaves.update_many(
         {"id": {"$in": data.ids}, "status": "pending"},
         {"$set": {
             "status": LeaveStatus.APPROVED,
             "approved_by": data.approved_by,
-            "approved_on": get_utc_now_str()
+            "approved_on": now,
+            "approval_batch_id": batch_id
         }}
     )
+    if result.modified_count == 0:
+        return {"message": "0 leaves approved", "count": 0, "attendance_updated": 0}
+    
+    leaves = await db.leaves.find({"approval_batch_id": batch_id}, {"_id": 0}).to_list(None)
+    emp_ids = list({leave["emp_id"] for leave in leaves})
+    users = await db.users.find(
+        {"id": {"$in": emp_ids}}, {"_id": 0, "id": 1, "salary": 1, "salary_type": 1}
+    ).to_list(None)
+    users_by_id = {u["id"]: u for u in users}
+    existing = await fetch_attendance_for_ranges([
+        (leave["emp_id"], leave["from_date"], leave.get("to_date") or leave["from_date"])
+        for leave in leaves
+    ])
     
-    # Update leave balances for each approved leave
-    for leave_id in data.ids:
-        leave = await db.leaves.find_one({"id": leave_id})
-        if leave:
-            await update_leave_balance(leave["emp_id"], leave["type"], leave["days"])
+    # Attendance upserts for every leave day of every employee, applied in one bulk write
+    await holiday_calendar.ensure_fresh()
+    operations = []
+    changes = []
+    for leave in leaves:
+        leave_ops, leave_changes = build_leave_attendance_ops(leave, users_by_id.get(leave["emp_id"]), existing, now)
+        operations.extend(leave_ops)
+        changes.extend(leave_changes)
+    if operations:
+        await db.attendance.bulk_write(operations, ordered=False)
+    await record_attendance_changes(changes, "leave_approved", data.approved_by)
+    await queue_leave_balance_deltas(leave_balance_deltas_from_leaves(leaves))
+    
+    # Notify employees in one batch (after the response)
+    event_queue.publish(create_notifications, [
+        {
+            "recipient_id": leave["emp_id"],
+            "title": "Leave Approved",
+            "message": f"Your {leave['type']} request for {leave['days']} days has been approved",
+            "notification_type": "leave",
+            "related_id": leave["id"],
+            "data": {"action": "approved"}
+        }
+        for leave in leaves
+    ])
     
-    return {"message": f"{result.modified_count} leaves approved", "count": result.modified_count}
+    return {
+        "message": f"{len(leaves)} leaves approved",
+        "count": len(leaves),
+        "attendance_updated": len(operations)
+    }
 
 @router.post("/leaves/bulk-reject")
 async def bulk_reject_leaves(data: BulkRejectRequest):
@@ -2792,26 +4880,52 @@ async def bulk_reject_leaves(data: BulkRejectRequest):
 
 @router.post("/bills/bulk-approve")
 async def bulk_approve_bills(data: BulkApproveRequest):
-    """Bulk approve multiple bill submissions"""
+    """Bulk approve multiple bill submissions in full - cash outs and notifications included"""
+    # Pipeline update copies each bill's total into approved_amount in the same write;
+    # the batch id identifies exactly the bills this request approved
+    batch_id = generate_id()
     result = await db.bills.update_many(
         {"id": {"$in": data.ids}, "status": "pending"},
-        {"$set": {
-            "status": BillStatus.APPROVED,
-            "approved_by": data.approved_by,
-            "approved_on": get_utc_now_str()
-        }}
+        [{"$set": {
+            "status": {"$literal": BillStatus.APPROVED.value},
+            "approved_by": {"$literal": data.approved_by},
+            "approved_on": {"$literal": get_utc_now_str()[:10]},
+            "approved_amount": {"$ifNull": ["$total_amount", 0]},
+            "remaining_balance": 0,
+            "approval_batch_id": {"$literal": batch_id}
+        }}]
     )
+    if result.modified_count == 0:
+        return {"message": "0 bills approved", "count": 0, "cash_out_created": 0}
     
-    # Set approved_amount = total_amount for each approved bill
-    for bill_id in data.ids:
-        bill = await db.bills.find_one({"id": bill_id})
-        if bill:
-            await db.bills.update_one(
-                {"id": bill_id},
-                {"$set": {"approved_amount": bill.get("total_amount", 0)}}
-            )
+    bills = await db.bills.find(
+        {"approval_batch_id": batch_id},
+        {"_id": 0, "id": 1, "emp_id": 1, "emp_name": 1, "month": 1, "year": 1, "total_amount": 1, "approved_amount": 1}
+    ).to_list(None)
+    
+    cash_out_created = await create_auto_cash_outs([
+        bill_cash_out_fields(bill, bill["approved_amount"])
+        for bill in bills
+        if bill.get("approved_amount", 0) > 0
+    ])
+    
+    event_queue.publish(create_notifications, [
+        {
+            "recipient_id": bill["emp_id"],
+            "title": "Bill Approved",
+            "message": f"Your bill of ₹{bill.get('total_amount', 0)} for {bill.get('month', '')} has been approved (₹{bill['approved_amount']})",
+            "notification_type": "bill",
+            "related_id": bill["id"],
+            "data": {"action": "approved", "approved_amount": bill["approved_amount"], "remaining_balance": 0}
+        }
+        for bill in bills
+    ])
     
-    return {"message": f"{result.modified_count} bills approved", "count": result.modified_count}
+    return {
+        "message": f"{len(bills)} bills approved",
+        "count": len(bills),
+        "cash_out_created": cash_out_created
+    }
 
 @router.post("/bills/bulk-reject")
 async def bulk_reject_bills(data: BulkRejectRequest):
@@ -2920,165 +5034,241 @@ async def update_audit_expense(expense_id: str, expense: AuditExpenseCreate, emp
     updated = await db.audit_expenses.find_one({"id": expense_id}, {"_id": 0})
     return updated
 
+def audit_expense_cash_out_fields(expense: dict, amount: float, payment_number: int) -> dict:
+    """
+    create_auto_cash_out / build_auto_cash_out_doc arguments for one audit expense payment.
+    Every partial payment gets its own reference (the first keeps the plain expense id).
+    """
+    # Use the trip_start_date (the month the expense belongs to), not submission or approval date
+    trip_date = expense.get("trip_start_date", expense.get("submitted_on", get_utc_now_str()[:10]))
+    if isinstance(trip_date, str) and len(trip_date) >= 10:
+        cash_out_date = trip_date[:10]
+    else:
+        cash_out_date = get_utc_now_str()[:10]
+    reference_id = expense["id"] if payment_number <= 1 else f"{expense['id']}-{payment_number}"
+    return {
+        "category": "audit_expenses",
+        "description": f"Audit Expense - {expense.get('emp_name', '')} ({expense.get('trip_purpose', '')})",
+        "amount": amount,
+        "date": cash_out_date,
+        "reference_id": reference_id,
+        "reference_type": "audit_expense"
+    }
+
+def python_str_expr(expr) -> dict:
+    """$toString that keeps Python's str() format for whole doubles ("500.0", not "500")"""
+    return {"$let": {"vars": {"n": expr}, "in": {"$concat": [
+        {"$toString": "$$n"},
+        {"$cond": [{"$and": [{"$eq": [{"$type": "$$n"}, "double"]}, {"$eq": ["$$n", {"$trunc": "$$n"}]}]}, ".0", ""]}
+    ]}}}
+
+def audit_expense_payment_pipeline(approved_by: str, approved_amount: Optional[float], now: str) -> list:
+    """
+    Pipeline update paying an audit expense from its stored totals: the payment (the
+    requested amount or the full balance, capped at what is still outstanding) is added
+    to approved_amount and appended to payment_history, then remaining_balance and status
+    follow from the new total.
+    """
+    total = {"$ifNull": ["$total_amount", 0]}
+    outstanding = {"$subtract": [total, {"$ifNull": ["$approved_amount", 0]}]}
+    payment = outstanding if approved_amount is None else {"$min": [{"$literal": approved_amount}, outstanding]}
+    return [
+        # Both fields are computed from the same input document, so they see the same payment
+        {"$set": {
+            "approved_amount": {"$add": [{"$ifNull": ["$approved_amount", 0]}, payment]},
+            "payment_history": {"$concatArrays": [
+                {"$ifNull": ["$payment_history", []]},
+                [{
+                    "amount": payment,
+                    "paid_by": {"$literal": approved_by},
+                    "paid_on": {"$literal": now},
+                    "note": {"$concat": ["Payment of ₹", python_str_expr(payment)]}
+                }]
+            ]},
+            "approved_by": {"$literal": approved_by},
+            "approved_on": {"$literal": now}
+        }},
+        {"$set": {
+            "remaining_balance": {"$max": [0, {"$subtract": [total, "$approved_amount"]}]},
+            "status": {"$cond": [
+                {"$lte": [{"$subtract": [total, "$approved_amount"]}, 0]},
+                AuditExpenseStatus.APPROVED.value,
+                AuditExpenseStatus.PARTIALLY_APPROVED.value
+            ]}
+        }}
+    ]
+
 @router.put("/audit-expenses/{expense_id}/approve")
 async def approve_audit_expense(expense_id: str, approved_by: str, approved_amount: Optional[float] = None):
     """Approve an audit expense (Admin only) - supports partial approval with balance tracking"""
-    expense = await db.audit_expenses.find_one({"id": expense_id}, {"_id": 0})
+    if approved_amount is not None and approved_amount <= 0:
+        raise HTTPException(status_code=400, detail="Approved amount must be greater than 0")
+    # The payment is computed from the stored totals inside the update and appended to the
+    # history in the same write, so two approvers clicking at once each pay against the
+    # balance the other left
+    expense = await db.audit_expenses.find_one_and_update(
+        {"id": expense_id, "status": {"$in": [AuditExpenseStatus.PENDING, AuditExpenseStatus.PARTIALLY_APPROVED]}},
+        audit_expense_payment_pipeline(approved_by, approved_amount, get_utc_now_str()),
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
     if not expense:
-        raise HTTPException(status_code=404, detail="Audit expense not found")
-    
-    current_status = expense.get("status")
-    if current_status not in ["pending", "partially_approved"]:
-        raise HTTPException(status_code=400, detail="Expense cannot be approved in current state")
-    
-    total_amount = expense.get("total_amount", 0)
-    previous_approved = expense.get("approved_amount", 0)
+        await raise_transition_conflict(
+            db.audit_expenses, expense_id, "Audit expense not found", "Expense cannot be approved in current state"
+        )
     
-    # Calculate new payment amount
-    payment_amount = approved_amount if approved_amount is not None else (total_amount - previous_approved)
-    new_total_approved = previous_approved + payment_amount
-    remaining_balance = total_amount - new_total_approved
+    payment_amount = expense["payment_history"][-1]["amount"]
     
-    # Ensure we don't approve more than total
-    if new_total_approved > total_amount:
-        new_total_approved = total_amount
-        remaining_balance = 0
-        payment_amount = total_amount - previous_approved
+    # Auto-create Cash Out entry for this payment
+    if payment_amount > 0:
+        await create_auto_cash_out(**audit_expense_cash_out_fields(expense, payment_amount, len(expense["payment_history"])))
     
-    # Determine status based on remaining balance
-    if remaining_balance <= 0:
-        status = AuditExpenseStatus.APPROVED
-        remaining_balance = 0
-    else:
-        status = AuditExpenseStatus.PARTIALLY_APPROVED
-    
-    # Add to payment history
-    payment_history = expense.get("payment_history", []) or []
-    payment_history.append({
-        "amount": payment_amount,
-        "paid_by": approved_by,
-        "paid_on": get_utc_now_str(),
-        "note": f"Payment of ₹{payment_amount}"
-    })
+    return {
+        "message": f"Expense {expense['status']}",
+        "payment_amount": payment_amount,
+        "total_approved": expense["approved_amount"],
+        "remaining_balance": expense["remaining_balance"]
+    }
+
+@router.post("/audit-expenses/bulk-approve")
+async def bulk_approve_audit_expenses(data: BulkAuditExpenseApproveRequest):
+    """
+    Approve many audit expenses at once, optionally paying a partial amount per id.
+    Each payment is computed inside its update like a single approval; all updates go out
+    in one bulk_write and all cash outs in one insert.
+    """
+    amounts = data.amounts or {}
+    # A zero or negative partial payment would lower approved_amount - those ids are not touched
+    invalid = {expense_id for expense_id in data.ids if expense_id in amounts and amounts[expense_id] <= 0}
+    ids = [expense_id for expense_id in dict.fromkeys(data.ids) if expense_id not in invalid]
+    batch_id = generate_id()
+    now = get_utc_now_str()
+    operations = [
+        UpdateOne(
+            {"id": expense_id, "status": {"$in": [AuditExpenseStatus.PENDING, AuditExpenseStatus.PARTIALLY_APPROVED]}},
+            audit_expense_payment_pipeline(data.approved_by, amounts.get(expense_id), now)
+            + [{"$set": {"payment_batch_id": {"$literal": batch_id}}}]
+        )
+        for expense_id in ids
+    ]
+    if operations:
+        await db.audit_expenses.bulk_write(operations, ordered=False)
     
-    await db.audit_expenses.update_one(
-        {"id": expense_id},
-        {"$set": {
-            "status": status,
-            "approved_amount": new_total_approved,
-            "remaining_balance": remaining_balance,
-            "approved_by": approved_by,
-            "approved_on": get_utc_now_str(),
-            "payment_history": payment_history
-        }}
-    )
+    # The batch id identifies exactly the expenses this request paid
+    applied = {
+        expense["id"]: expense
+        for expense in await db.audit_expenses.find({"payment_batch_id": batch_id}, {"_id": 0}).to_list(None)
+    }
+    unapplied = [expense_id for expense_id in ids if expense_id not in applied]
+    statuses = {}
+    if unapplied:
+        statuses = {
+            expense["id"]: expense.get("status")
+            for expense in await db.audit_expenses.find({"id": {"$in": unapplied}}, {"_id": 0, "id": 1, "status": 1}).to_list(None)
+        }
     
-    # Auto-create Cash Out entry for approved audit expense
-    # Use the trip_start_date (the month the expense belongs to), not submission or approval date
-    if payment_amount > 0:
-        # Get the month from the trip start date (when expense was incurred)
-        trip_date = expense.get("trip_start_date", expense.get("submitted_on", get_utc_now_str()[:10]))
-        if isinstance(trip_date, str) and len(trip_date) >= 10:
-            cash_out_date = trip_date[:10]  # Use trip start date
+    results = []
+    for expense_id in dict.fromkeys(data.ids):
+        expense = applied.get(expense_id)
+        if expense_id in invalid:
+            results.append({"id": expense_id, "error": "Approved amount must be greater than 0"})
+        elif expense:
+            results.append({
+                "id": expense_id,
+                "status": expense["status"],
+                "payment_amount": expense["payment_history"][-1]["amount"],
+                "total_approved": expense["approved_amount"],
+                "remaining_balance": expense["remaining_balance"]
+            })
+        elif expense_id in statuses:
+            results.append({"id": expense_id, "error": "Expense cannot be approved in current state"})
         else:
-            cash_out_date = get_utc_now_str()[:10]
-        
-        await create_auto_cash_out(
-            category="audit_expenses",
-            description=f"Audit Expense - {expense.get('emp_name', '')} ({expense.get('trip_purpose', '')})",
-            amount=payment_amount,
-            date=cash_out_date,  # Use trip start date, not approval date
-            reference_id=expense_id,
-            reference_type="audit_expense"
-        )
+            results.append({"id": expense_id, "error": "Audit expense not found"})
+    
+    await create_auto_cash_outs([
+        audit_expense_cash_out_fields(expense, expense["payment_history"][-1]["amount"], len(expense["payment_history"]))
+        for expense in applied.values()
+        if expense["payment_history"][-1]["amount"] > 0
+    ])
     
     return {
-        "message": f"Expense {status.value}",
-        "payment_amount": payment_amount,
-        "total_approved": new_total_approved,
-        "remaining_balance": remaining_balance
+        "message": f"{len(applied)} audit expenses approved",
+        "count": len(applied),
+        "results": results
     }
 
 @router.put("/audit-expenses/{expense_id}/revalidate")
 async def revalidate_audit_expense(expense_id: str, requested_by: str, reason: str):
     """Request revalidation of an audit expense (Admin only) - Team Lead can then edit and resubmit"""
-    expense = await db.audit_expenses.find_one({"id": expense_id}, {"_id": 0})
-    if not expense:
-        raise HTTPException(status_code=404, detail="Audit expense not found")
-    
-    current_status = expense.get("status")
-    if current_status not in ["pending", "partially_approved"]:
-        raise HTTPException(status_code=400, detail="Only pending or partially approved expenses can be sent for revalidation")
-    
-    await db.audit_expenses.update_one(
-        {"id": expense_id},
+    expense = await db.audit_expenses.find_one_and_update(
+        {"id": expense_id, "status": {"$in": [AuditExpenseStatus.PENDING, AuditExpenseStatus.PARTIALLY_APPROVED]}},
         {"$set": {
             "status": AuditExpenseStatus.REVALIDATION,
             "revalidation_reason": reason,
             "approved_by": requested_by,
             "approved_on": get_utc_now_str()
-        }}
+        }},
+        projection={"_id": 0, "id": 1}
     )
+    if not expense:
+        await raise_transition_conflict(
+            db.audit_expenses, expense_id, "Audit expense not found",
+            "Only pending or partially approved expenses can be sent for revalidation"
+        )
     
     return {"message": "Expense sent for revalidation", "reason": reason}
 
 @router.put("/audit-expenses/{expense_id}/resubmit")
 async def resubmit_audit_expense(expense_id: str, expense: AuditExpenseCreate, emp_id: str):
     """Resubmit an expense after revalidation (Team Lead only)"""
-    existing = await db.audit_expenses.find_one({"id": expense_id}, {"_id": 0})
-    if not existing:
-        raise HTTPException(status_code=404, detail="Audit expense not found")
-    
-    if existing.get("status") != "revalidation":
-        raise HTTPException(status_code=400, detail="Only expenses in revalidation can be resubmitted")
-    
-    if existing.get("emp_id") != emp_id:
-        raise HTTPException(status_code=403, detail="You can only resubmit your own expenses")
-    
     total_amount = sum(item.amount for item in expense.items)
-    previous_approved = existing.get("approved_amount", 0)
     
-    await db.audit_expenses.update_one(
-        {"id": expense_id},
-        {"$set": {
-            "items": [item.model_dump() for item in expense.items],
-            "total_amount": total_amount,
-            "trip_purpose": expense.trip_purpose,
-            "trip_location": expense.trip_location,
-            "trip_start_date": expense.trip_start_date,
-            "trip_end_date": expense.trip_end_date,
-            "remarks": expense.remarks,
-            "status": AuditExpenseStatus.PENDING,
-            "remaining_balance": total_amount - previous_approved,
+    updated = await db.audit_expenses.find_one_and_update(
+        {"id": expense_id, "status": AuditExpenseStatus.REVALIDATION, "emp_id": emp_id},
+        [{"$set": {
+            "items": {"$literal": [item.model_dump() for item in expense.items]},
+            "total_amount": {"$literal": total_amount},
+            "trip_purpose": {"$literal": expense.trip_purpose},
+            "trip_location": {"$literal": expense.trip_location},
+            "trip_start_date": {"$literal": expense.trip_start_date},
+            "trip_end_date": {"$literal": expense.trip_end_date},
+            "remarks": {"$literal": expense.remarks},
+            "status": {"$literal": AuditExpenseStatus.PENDING.value},
+            "remaining_balance": {"$subtract": [{"$literal": total_amount}, {"$ifNull": ["$approved_amount", 0]}]},
             "revalidation_reason": None,
-            "submitted_on": get_utc_now_str()
-        }}
+            "submitted_on": {"$literal": get_utc_now_str()}
+        }}],
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
     )
+    if updated:
+        return updated
     
-    updated = await db.audit_expenses.find_one({"id": expense_id}, {"_id": 0})
-    return updated
+    existing = await db.audit_expenses.find_one({"id": expense_id}, {"_id": 0, "status": 1, "emp_id": 1})
+    if not existing:
+        raise HTTPException(status_code=404, detail="Audit expense not found")
+    if existing.get("status") != "revalidation":
+        raise HTTPException(status_code=400, detail="Only expenses in revalidation can be resubmitted")
+    raise HTTPException(status_code=403, detail="You can only resubmit your own expenses")
 
 @router.put("/audit-expenses/{expense_id}/reject")
 async def reject_audit_expense(expense_id: str, rejected_by: str, reason: Optional[str] = None):
     """Reject an audit expense (Admin only)"""
-    expense = await db.audit_expenses.find_one({"id": expense_id}, {"_id": 0})
-    if not expense:
-        raise HTTPException(status_code=404, detail="Audit expense not found")
-    
-    current_status = expense.get("status")
-    if current_status not in ["pending", "partially_approved"]:
-        raise HTTPException(status_code=400, detail="Expense cannot be rejected in current state")
-    
-    await db.audit_expenses.update_one(
-        {"id": expense_id},
+    expense = await db.audit_expenses.find_one_and_update(
+        {"id": expense_id, "status": {"$in": [AuditExpenseStatus.PENDING, AuditExpenseStatus.PARTIALLY_APPROVED]}},
         {"$set": {
             "status": AuditExpenseStatus.REJECTED,
             "approved_amount": 0,
             "approved_by": rejected_by,
             "approved_on": get_utc_now_str(),
             "rejection_reason": reason
-        }}
+        }},
+        projection={"_id": 0, "id": 1}
     )
+    if not expense:
+        await raise_transition_conflict(
+            db.audit_expenses, expense_id, "Audit expense not found", "Expense cannot be rejected in current state"
+        )
     
     return {"message": "Expense rejected"}
 
@@ -3210,6 +5400,127 @@ async def create_notification(
     
     return notification_doc
 
+async def create_notifications(notifications: list):
+    """
+    Batch form of create_notification: one insert_many for a list of dicts with the
+    same keyword arguments, then the usual real-time delivery for each.
+    """
+    if not notifications:
+        return []
+    now = get_utc_now_str()
+    notification_docs = [
+        {
+            "id": generate_id(),
+            "recipient_id": n.get("recipient_id", ""),
+            "recipient_role": n.get("recipient_role"),
+            "title": n["title"],
+            "message": n["message"],
+            "type": n["notification_type"],
+            "related_id": n.get("related_id"),
+            "data": n.get("data"),
+            "is_read": False,
+            "created_at": now
+        }
+        for n in notifications
+    ]
+    await db.notifications.insert_many(notification_docs)
+    
+    for notification_doc in notification_docs:
+        notification_doc.pop("_id", None)
+        ws_message = {"type": "notification", "notification": notification_doc}
+        if notification_doc["recipient_id"]:
+            await manager.send_to_user(notification_doc["recipient_id"], ws_message)
+        elif notification_doc["recipient_role"]:
+            await manager.broadcast_to_role(notification_doc["recipient_role"], ws_message)
+    
+    return notification_docs
+
+
+# ==================== BACKGROUND EVENT QUEUE ====================
+
+EVENT_QUEUE_SIZE = int(os.environ.get("EVENT_QUEUE_SIZE", "10000"))
+EVENT_QUEUE_WORKERS = int(os.environ.get("EVENT_QUEUE_WORKERS", "4"))
+
+class EventQueue:
+    """
+    Bounded in-process queue for work that should happen after the response is sent
+    (notification inserts, WebSocket fan-out), so a slow socket never delays a punch.
+    """
+    def __init__(self, maxsize: int, worker_count: int):
+        self.maxsize = maxsize
+        self.worker_count = worker_count
+        self.queue: Optional[asyncio.Queue] = None
+        self.workers: list = []
+        self.accepting = True
+        self.stats = {"published": 0, "processed": 0, "failed": 0, "dropped": 0, "high_water_mark": 0}
+
+    def start(self):
+        """Start worker tasks (called at startup, or lazily on first publish)"""
+        if self.workers:
+            return
+        self.queue = asyncio.Queue(maxsize=self.maxsize)
+        self.accepting = True
+        self.workers = [asyncio.create_task(self._worker()) for _ in range(self.worker_count)]
+
+    def publish(self, handler, *args, **kwargs) -> bool:
+        """Queue handler(*args, **kwargs) without waiting; returns False if the event was dropped"""
+        if not self.accepting:
+            self.stats["dropped"] += 1
+            logger.warning("Event queue is draining - dropped %s", getattr(handler, "__name__", handler))
+            return False
+        if not self.workers:
+            self.start()
+        try:
+            self.queue.put_nowait((handler, args, kwargs))
+        except asyncio.QueueFull:
+            self.stats["dropped"] += 1
+            logger.error("Event queue full (%s) - dropped %s", self.maxsize, getattr(handler, "__name__", handler))
+            return False
+        self.stats["published"] += 1
+        self.stats["high_water_mark"] = max(self.stats["high_water_mark"], self.queue.qsize())
+        return True
+
+    async def _worker(self):
+        while True:
+            handler, args, kwargs = await self.queue.get()
+            try:
+                await handler(*args, **kwargs)
+                self.stats["processed"] += 1
+            except Exception:
+                self.stats["failed"] += 1
+                logger.exception("Event queue handler %s failed", getattr(handler, "__name__", handler))
+            finally:
+                self.queue.task_done()
+
+    async def drain(self, timeout: float = 10):
+        """Stop accepting events, wait for queued ones to finish, then stop the workers"""
+        self.accepting = False
+        if self.queue is not None:
+            try:
+                await asyncio.wait_for(self.queue.join(), timeout)
+            except asyncio.TimeoutError:
+                logger.warning("Event queue drain timed out with %s events pending", self.queue.qsize())
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    def metrics(self) -> dict:
+        return {
+            **self.stats,
+            "depth": self.queue.qsize() if self.queue is not None else 0,
+            "capacity": self.maxsize,
+            "workers": len(self.workers),
+            "accepting": self.accepting
+        }
+
+event_queue = EventQueue(EVENT_QUEUE_SIZE, EVENT_QUEUE_WORKERS)
+
+@router.get("/system/event-queue")
+async def get_event_queue_metrics():
+    """Background event queue depth, throughput and overflow counters"""
+    return event_queue.metrics()
+
 @router.get("/notifications", response_model=List[NotificationResponse])
 async def get_notifications(user_id: str, unread_only: bool = False, limit: int = 50):
     """Get notifications for a user"""
@@ -3278,14 +5589,30 @@ def get_date_range(time_filter: str):
     
     return start.strftime("%Y-%m-%d"), end.strftime("%Y-%m-%d")
 
-@router.get("/analytics/attendance-trends")
-async def get_attendance_trends(time_filter: str = "this_month"):
-    """Get attendance trends data for charts"""
-    start_date, end_date = get_date_range(time_filter)
-    
+# Attendance, leave and headcount analytics are computed as $group aggregations so only
+# the grouped counts leave the database; attendance trends and department attendance read
+# the daily rollups rather than attendance. ANALYTICS_USE_AGGREGATION=false switches to the
+# equivalent Python implementations over attendance (kept for testing and comparing results).
+ANALYTICS_USE_AGGREGATION = os.environ.get("ANALYTICS_USE_AGGREGATION", "true").lower() == "true"
+
+def field_or_default(field: str, default):
+    """Expression for dict.get(field, default): the default only when the field is missing"""
+    return {"$cond": [{"$eq": [{"$type": field}, "missing"]}, default, field]}
+
+# record.get("attendance_status", record.get("status", "absent"))
+ATTENDANCE_STATUS_EXPR = {"$cond": [
+    {"$eq": [{"$type": "$attendance_status"}, "missing"]},
+    {"$ifNull": ["$status", "absent"]},
+    "$attendance_status"
+]}
+
+def count_if_status(statuses: list) -> dict:
+    return {"$sum": {"$cond": [{"$in": ["$status_value", statuses]}, 1, 0]}}
+
+async def attendance_trends_python(start_date: str, end_date: str) -> list:
     attendance_records = await db.attendance.find({
         "date": {"$gte": start_date, "$lte": end_date}
-    }, {"_id": 0}).to_list(10000)
+    }, {"_id": 0, "date": 1, "attendance_status": 1, "status": 1}).to_list(None)
     
     # Group by date
     daily_data = defaultdict(lambda: {"present": 0, "absent": 0, "half_day": 0, "total": 0})
@@ -3303,32 +5630,37 @@ async def get_attendance_trends(time_filter: str = "this_month"):
             daily_data[date]["absent"] += 1
     
     # Convert to list sorted by date
-    result = [
+    return [
         {"date": date, **data}
         for date, data in sorted(daily_data.items())
     ]
-    
-    return result
 
-@router.get("/analytics/leave-distribution")
-async def get_leave_distribution(time_filter: str = "this_month"):
-    """Get leave distribution by type"""
+@router.get("/analytics/attendance-trends")
+async def get_attendance_trends(time_filter: str = "this_month"):
+    """Get attendance trends data for charts"""
     start_date, end_date = get_date_range(time_filter)
-    
-    leaves = await db.leaves.find({
-        "from_date": {"$gte": start_date, "$lte": end_date}
-    }, {"_id": 0}).to_list(1000)
-    
-    # Group by leave type
-    type_counts = defaultdict(int)
-    total = 0
-    
-    for leave in leaves:
-        leave_type = leave.get("type", "Other")
-        type_counts[leave_type] += 1
-        total += 1
-    
-    result = [
+    if not ANALYTICS_USE_AGGREGATION:
+        return await attendance_trends_python(start_date, end_date)
+    
+    # One small rollup document per (date, department, location, shift) instead of every person-day
+    await ensure_attendance_rollups_fresh(start_date, end_date)
+    return await db.attendance_daily_rollup.aggregate([
+        {"$match": {"date": {"$gte": start_date, "$lte": end_date}}},
+        {"$group": {
+            "_id": "$date",
+            "present": {"$sum": "$present"},
+            "absent": {"$sum": {"$add": ["$absent", "$leave"]}},
+            "half_day": {"$sum": "$half_day"},
+            "total": {"$sum": "$total"}
+        }},
+        {"$match": {"total": {"$gt": 0}}},
+        {"$sort": {"_id": 1}},
+        {"$project": {"_id": 0, "date": "$_id", "present": 1, "absent": 1, "half_day": 1, "total": 1}}
+    ]).to_list(None)
+
+def leave_distribution_rows(type_counts: dict) -> list:
+    total = sum(type_counts.values())
+    return [
         {
             "type": leave_type,
             "count": count,
@@ -3336,47 +5668,84 @@ async def get_leave_distribution(time_filter: str = "this_month"):
         }
         for leave_type, count in type_counts.items()
     ]
-    
-    return result
 
-@router.get("/analytics/department-attendance")
-async def get_department_attendance(time_filter: str = "this_month"):
-    """Get attendance summary by department"""
+@router.get("/analytics/leave-distribution")
+async def get_leave_distribution(time_filter: str = "this_month"):
+    """Get leave distribution by type"""
     start_date, end_date = get_date_range(time_filter)
     
+    # Any leave overlapping the period, including ones that started before it
+    if not ANALYTICS_USE_AGGREGATION:
+        leaves = await db.leaves.find(
+            leave_overlap_query(start_date, end_date),
+            {"_id": 0, "type": 1}
+        ).to_list(None)
+        type_counts = defaultdict(int)
+        for leave in leaves:
+            type_counts[leave.get("type", "Other")] += 1
+        return leave_distribution_rows(type_counts)
+    
+    groups = await db.leaves.aggregate([
+        {"$match": leave_overlap_query(start_date, end_date)},
+        {"$group": {"_id": field_or_default("$type", "Other"), "count": {"$sum": 1}}},
+        {"$sort": {"count": -1, "_id": 1}}
+    ]).to_list(None)
+    return leave_distribution_rows({group["_id"]: group["count"] for group in groups})
+
+def department_attendance_rows(dept_data: dict) -> list:
+    return [
+        {
+            "department": dept,
+            "present": data["present"],
+            "absent": data["total"] - data["present"],
+            "attendance_rate": round((data["present"] / data["total"]) * 100, 1) if data["total"] > 0 else 0
+        }
+        for dept, data in dept_data.items()
+    ]
+
+async def department_attendance_python(start_date: str, end_date: str) -> list:
     # Get all users with their departments
-    users = await db.users.find({"role": {"$ne": "admin"}}, {"_id": 0}).to_list(1000)
-    user_dept = {u["id"]: u.get("department", "Unknown") for u in users}
+    users = await db.users.find({"role": {"$ne": "admin"}}, {"_id": 0, "id": 1, "department": 1}).to_list(None)
+    user_dept = {u["id"]: rollup_key_value(u.get("department")) for u in users}
     
     attendance_records = await db.attendance.find({
         "date": {"$gte": start_date, "$lte": end_date}
-    }, {"_id": 0}).to_list(10000)
+    }, {"_id": 0, "emp_id": 1, "attendance_status": 1, "status": 1}).to_list(None)
     
     # Group by department
-    dept_data = defaultdict(lambda: {"present": 0, "absent": 0, "total": 0})
+    dept_data = defaultdict(lambda: {"present": 0, "total": 0})
     
     for record in attendance_records:
-        emp_id = record.get("emp_id")
-        dept = user_dept.get(emp_id, "Unknown")
+        dept = user_dept.get(record.get("emp_id"), "Unknown")
         status = record.get("attendance_status", record.get("status", "absent"))
         
         dept_data[dept]["total"] += 1
         if status in ["full_day", "present", "half_day"]:
             dept_data[dept]["present"] += 1
-        else:
-            dept_data[dept]["absent"] += 1
-    
-    result = [
-        {
-            "department": dept,
-            "present": data["present"],
-            "absent": data["absent"],
-            "attendance_rate": round((data["present"] / data["total"]) * 100, 1) if data["total"] > 0 else 0
-        }
-        for dept, data in dept_data.items()
-    ]
     
-    return result
+    return department_attendance_rows(dept_data)
+
+@router.get("/analytics/department-attendance")
+async def get_department_attendance(time_filter: str = "this_month"):
+    """Get attendance summary by department"""
+    start_date, end_date = get_date_range(time_filter)
+    if not ANALYTICS_USE_AGGREGATION:
+        return await department_attendance_python(start_date, end_date)
+    
+    await ensure_attendance_rollups_fresh(start_date, end_date)
+    groups = await db.attendance_daily_rollup.aggregate([
+        {"$match": {"date": {"$gte": start_date, "$lte": end_date}}},
+        {"$group": {
+            "_id": "$department",
+            "present": {"$sum": {"$add": ["$present", "$half_day"]}},
+            "total": {"$sum": "$total"}
+        }},
+        {"$match": {"total": {"$gt": 0}}},
+        {"$sort": {"_id": 1}}
+    ]).to_list(None)
+    return department_attendance_rows({
+        group["_id"]: {"present": group["present"], "total": group["total"]} for group in groups
+    })
 
 @router.get("/analytics/salary-overview")
 async def get_salary_overview(time_filter: str = "this_year"):
@@ -3413,40 +5782,46 @@ async def get_salary_overview(time_filter: str = "this_year"):
 @router.get("/analytics/employee-counts")
 async def get_employee_counts():
     """Get employee counts by role and status"""
-    users = await db.users.find({}, {"_id": 0}).to_list(1000)
-    
-    role_data = defaultdict(lambda: {"count": 0, "active": 0, "inactive": 0})
-    
-    for user in users:
-        role = user.get("role", "employee")
-        status = user.get("status", "active")
-        
-        role_data[role]["count"] += 1
-        if status == "active":
-            role_data[role]["active"] += 1
-        else:
-            role_data[role]["inactive"] += 1
-    
-    result = [
-        {
-            "role": role,
-            "count": data["count"],
-            "active": data["active"],
-            "inactive": data["inactive"]
-        }
-        for role, data in role_data.items()
-    ]
-    
-    return result
+    if not ANALYTICS_USE_AGGREGATION:
+        users = await db.users.find({}, {"_id": 0, "role": 1, "status": 1}).to_list(None)
+        role_data = defaultdict(lambda: {"count": 0, "active": 0, "inactive": 0})
+        for user in users:
+            role = user.get("role", "employee")
+            role_data[role]["count"] += 1
+            if user.get("status", "active") == "active":
+                role_data[role]["active"] += 1
+            else:
+                role_data[role]["inactive"] += 1
+        return [{"role": role, **data} for role, data in role_data.items()]
+    
+    return await db.users.aggregate([
+        {"$group": {
+            "_id": field_or_default("$role", "employee"),
+            "count": {"$sum": 1},
+            "active": {"$sum": {"$cond": [{"$eq": [field_or_default("$status", "active"), "active"]}, 1, 0]}}
+        }},
+        {"$sort": {"_id": 1}},
+        {"$project": {
+            "_id": 0,
+            "role": "$_id",
+            "count": 1,
+            "active": 1,
+            "inactive": {"$subtract": ["$count", "$active"]}
+        }}
+    ]).to_list(None)
 
 @router.get("/analytics/summary")
 async def get_analytics_summary(time_filter: str = "this_month"):
     """Get all analytics data in one call"""
-    attendance_trends = await get_attendance_trends(time_filter)
-    leave_distribution = await get_leave_distribution(time_filter)
-    department_attendance = await get_department_attendance(time_filter)
-    salary_overview = await get_salary_overview(time_filter)
-    employee_counts = await get_employee_counts()
+    (
+        attendance_trends, leave_distribution, department_attendance, salary_overview, employee_counts
+    ) = await asyncio.gather(
+        get_attendance_trends(time_filter),
+        get_leave_distribution(time_filter),
+        get_department_attendance(time_filter),
+        get_salary_overview(time_filter),
+        get_employee_counts()
+    )
     
     return {
         "attendance_trends": attendance_trends,
@@ -4133,32 +6508,19 @@ async def delete_cash_in(entry_id: str):
 @router.post("/cashbook/upload-invoice")
 async def upload_invoice(file: UploadFile = File(...)):
     """Upload invoice PDF (max 10MB)"""
-    contents = await file.read()
-    if len(contents) > 10 * 1024 * 1024:
-        raise HTTPException(status_code=400, detail="File size exceeds 10MB limit")
-    
     if not file.content_type == "application/pdf":
         raise HTTPException(status_code=400, detail="Only PDF files are allowed")
     
-    file_id = generate_id()
-    file_path = f"/app/backend/uploads/invoices/{file_id}.pdf"
-    
-    os.makedirs("/app/backend/uploads/invoices", exist_ok=True)
-    with open(file_path, "wb") as f:
-        f.write(contents)
+    attachment = await store_pdf_attachment(file, "invoice", 10 * 1024 * 1024, "File size exceeds 10MB limit")
+    file_id = attachment["id"]
     
-    return {"file_id": file_id, "url": f"/api/cashbook/invoices/{file_id}"}
+    return {"file_id": file_id, "url": f"/api/cashbook/invoices/{file_id}", "deduplicated": attachment["deduplicated"]}
 
 @router.get("/cashbook/invoices/{file_id}")
-async def get_invoice_pdf(file_id: str):
+async def get_invoice_pdf(file_id: str, request: Request):
     """Download invoice PDF"""
-    from fastapi.responses import FileResponse
-    file_path = f"/app/backend/uploads/invoices/{file_id}.pdf"
-    
-    if not os.path.exists(file_path):
-        raise HTTPException(status_code=404, detail="Invoice not found")
-    
-    return FileResponse(file_path, media_type="application/pdf", filename=f"invoice_{file_id}.pdf")
+    file_path = (await resolve_attachment_paths([file_id], f"{UPLOAD_DIR}/invoices"))[file_id]
+    return await attachment_file_response(request, file_path, f"invoice_{file_id}.pdf", not_found="Invoice not found")
 
 # --- Cash Out (Expenses) ---
 
@@ -4563,6 +6925,11 @@ async def export_invoices_zip(month: Optional[str] = None, year: Optional[int] =
     if not invoices:
         raise HTTPException(status_code=404, detail="No invoices with PDFs found")
     
+    file_paths = await resolve_attachment_paths(
+        [inv["invoice_pdf_url"].split("/")[-1] for inv in invoices if inv.get("invoice_pdf_url")],
+        f"{UPLOAD_DIR}/invoices"
+    )
+    
     # Create ZIP in memory
     zip_buffer = io.BytesIO()
     with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
@@ -4570,7 +6937,7 @@ async def export_invoices_zip(month: Optional[str] = None, year: Optional[int] =
             pdf_url = inv.get("invoice_pdf_url", "")
             if pdf_url:
                 file_id = pdf_url.split("/")[-1]
-                file_path = f"/app/backend/uploads/invoices/{file_id}.pdf"
+                file_path = file_paths[file_id]
                 if os.path.exists(file_path):
                     invoice_name = f"{inv.get('client_name', 'Unknown')}_{inv.get('invoice_number', 'Unknown')}.pdf"
                     invoice_name = invoice_name.replace(" ", "_").replace("/", "_")
@@ -4589,7 +6956,7 @@ async def export_invoices_zip(month: Optional[str] = None, year: Optional[int] =
 
 # --- Auto-Integration Helper Function ---
 
-async def create_auto_cash_out(
+def build_auto_cash_out_doc(
     category: str,
     description: str,
     amount: float,
@@ -4597,22 +6964,16 @@ async def create_auto_cash_out(
     reference_id: str,
     reference_type: str,
     month: str = None,
-    year: int = None
-):
-    """Helper to create auto cash out entry from other modules"""
+    year: int = None,
+    extra: Optional[dict] = None
+) -> dict:
+    """Cash out document for an entry generated by another module (extra: additional fields to store)"""
     # Use provided month/year or extract from date
     if month is None or year is None:
         month, year = get_month_year_from_date(date)
     
-    # Check if entry already exists (prevent duplicates)
-    existing = await db.cash_out.find_one({
-        "reference_id": reference_id,
-        "reference_type": reference_type
-    })
-    if existing:
-        return  # Already exists
-    
-    cash_out_doc = {
+    return {
+        **(extra or {}),
         "id": generate_id(),
         "category": category,
         "description": description,
@@ -4626,8 +6987,77 @@ async def create_auto_cash_out(
         "year": year,
         "is_auto": True
     }
-    
-    await db.cash_out.insert_one(cash_out_doc)
+
+def auto_cash_out_update(fields: dict, replace: bool = False):
+    """
+    Single-trip idempotent write keyed by (reference_id, reference_type), backed by the
+    unique partial index on auto entries. By default an existing entry is left untouched;
+    replace=True overwrites its amount/description/date (e.g. a regenerated payslip).
+    Returns (filter, update) for an upsert.
+    """
+    cash_out_doc = build_auto_cash_out_doc(**fields)
+    key = {
+        "reference_id": cash_out_doc["reference_id"],
+        "reference_type": cash_out_doc["reference_type"],
+        "is_auto": True
+    }
+    if replace:
+        on_insert = {"id": cash_out_doc.pop("id"), "created_at": cash_out_doc.pop("created_at")}
+        cash_out_doc["updated_at"] = get_utc_now_str()
+        update = {"$set": cash_out_doc, "$setOnInsert": on_insert}
+    else:
+        update = {"$setOnInsert": cash_out_doc}
+    return key, update
+
+async def create_auto_cash_out(
+    category: str,
+    description: str,
+    amount: float,
+    date: str,
+    reference_id: str,
+    reference_type: str,
+    month: str = None,
+    year: int = None,
+    replace: bool = False,
+    extra: Optional[dict] = None
+):
+    """Helper to create auto cash out entry from other modules (no-op if the reference already has one)"""
+    key, update = auto_cash_out_update({
+        "category": category,
+        "description": description,
+        "amount": amount,
+        "date": date,
+        "reference_id": reference_id,
+        "reference_type": reference_type,
+        "month": month,
+        "year": year,
+        "extra": extra
+    }, replace)
+    try:
+        await db.cash_out.update_one(key, update, upsert=True)
+    except DuplicateKeyError:
+        # A concurrent upsert inserted it first
+        if replace:
+            await db.cash_out.update_one(key, update)
+
+async def create_auto_cash_outs(entries: list, replace: bool = False) -> int:
+    """
+    Batch form of create_auto_cash_out for payroll runs, backfills and bulk approvals:
+    `entries` are dicts of create_auto_cash_out arguments, written with one bulk_write.
+    Returns the number of new cash out entries.
+    """
+    if not entries:
+        return 0
+    operations = [UpdateOne(*auto_cash_out_update(entry, replace), upsert=True) for entry in entries]
+    try:
+        result = await db.cash_out.bulk_write(operations, ordered=False)
+        return result.upserted_count
+    except BulkWriteError as e:
+        # Duplicate keys only happen when a concurrent writer inserted the same reference
+        other_errors = [err for err in e.details.get("writeErrors", []) if err.get("code") != 11000]
+        if other_errors:
+            raise
+        return e.details.get("nUpserted", 0)
 
 
 
@@ -4777,6 +7207,8 @@ async def create_historical_emi_entries(
     months_list = ["January", "February", "March", "April", "May", "June", 
                    "July", "August", "September", "October", "November", "December"]
     
+    emi_docs = []
+    cash_out_entries = []
     for emi_date in historical_emi_dates:
         # Calculate principal/interest split
         principal_amount, interest_amount = calculate_emi_split(
@@ -4813,19 +7245,19 @@ async def create_historical_emi_entries(
             "year": year
         }
         
-        await db.emi_payments.insert_one(emi_doc)
+        emi_docs.append(emi_doc)
         
-        # Create Cash Out entry
-        await create_auto_cash_out(
-            category="loan_emi",
-            description=f"Loan EMI - {loan_name} ({lender_name}) [Historical]",
-            amount=emi_amount,
-            date=date_str,
-            reference_id=emi_doc["id"],
-            reference_type="emi_payment",
-            month=month_name,
-            year=year
-        )
+        # Cash Out entry for this EMI
+        cash_out_entries.append({
+            "category": "loan_emi",
+            "description": f"Loan EMI - {loan_name} ({lender_name}) [Historical]",
+            "amount": emi_amount,
+            "date": date_str,
+            "reference_id": emi_doc["id"],
+            "reference_type": "emi_payment",
+            "month": month_name,
+            "year": year
+        })
         
         remaining_balance = new_balance
         
@@ -4833,6 +7265,10 @@ async def create_historical_emi_entries(
         if remaining_balance <= 0:
             break
     
+    # All historical EMIs and their cash outs in two writes
+    await db.emi_payments.insert_many(emi_docs)
+    await create_auto_cash_outs(cash_out_entries)
+    
     # Update loan with historical data
     new_status = LoanStatus.CLOSED if remaining_balance <= 0 else LoanStatus.ACTIVE
     
@@ -1,9 +1,9 @@
-from fastapi import FastAPI
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, Request
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
 import os
+import asyncio
 import logging
 from pathlib import Path
 
@@ -19,18 +19,20 @@ db = client[os.environ['DB_NAME']]
 app = FastAPI(title="Audix Solutions Staff Management API")
 
 # Import and include routes
-from routes import router as api_router
+from routes import (
+    router as api_router, ensure_indexes, event_queue, holiday_calendar,
+    auto_absent_scheduler, AUTO_ABSENT_ENABLED, migrate_profile_photos,
+    file_response, resolve_upload_path, upload_cache_control, backfill_attendance_rollups
+)
 
 # Include the router with /api prefix
 app.include_router(api_router, prefix="/api")
 
 # Serve uploaded files
 @app.get("/api/uploads/{file_path:path}")
-async def serve_upload(file_path: str):
-    full_path = f"/app/backend/uploads/{file_path}"
-    if os.path.exists(full_path):
-        return FileResponse(full_path)
-    return {"error": "File not found"}
+async def serve_upload(file_path: str, request: Request):
+    full_path = resolve_upload_path(file_path)
+    return await file_response(request, full_path, cache_control=upload_cache_control(full_path))
 
 app.add_middleware(
     CORSMiddleware,
@@ -51,8 +53,26 @@ logger = logging.getLogger(__name__)
 async def startup():
     # Create uploads directory
     os.makedirs("/app/backend/uploads", exist_ok=True)
+    await ensure_indexes()
+    await holiday_calendar.refresh()
+    event_queue.start()
+    if AUTO_ABSENT_ENABLED:
+        app.state.auto_absent_task = asyncio.create_task(auto_absent_scheduler())
+    # Convert any photos still stored inline as base64 into thumbnail files
+    app.state.photo_migration_task = asyncio.create_task(migrate_profile_photos())
+    # Build the daily attendance rollups once if this database has never had them
+    app.state.rollup_backfill_task = asyncio.create_task(backfill_attendance_rollups())
     logger.info("Server started - Audix Solutions Staff Management API")
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    auto_absent_task = getattr(app.state, "auto_absent_task", None)
+    if auto_absent_task:
+        auto_absent_task.cancel()
+    for task_name in ("photo_migration_task", "rollup_backfill_task"):
+        task = getattr(app.state, task_name, None)
+        if task:
+            task.cancel()
+    # Finish queued notifications/broadcasts before the DB connection goes away
+    await event_queue.drain()
     client.close()
@@ -0,0 +1,82 @@
+"""
+Shared fixtures for the backend tests.
+
+Pure-function tests run anywhere. Tests that take the `db` fixture call the real route
+functions against a local mongod (TEST_MONGO_URL, default mongodb://localhost:27017) in a
+throwaway database. When no mongod is reachable they run against an in-process
+mongomock_motor client instead, so CI without a MongoDB service still runs them; tests
+marked `mongod` use aggregation operators the fake lacks and are skipped there.
+"""
+import asyncio
+import os
+import sys
+from pathlib import Path
+
+import pytest
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+TEST_MONGO_URL = os.environ.get("TEST_MONGO_URL", "mongodb://localhost:27017")
+TEST_DB_NAME = os.environ.get("TEST_DB_NAME", "audix_staff_management_test")
+
+# routes connects and reads its keys at import time, so configure it before any test imports it
+os.environ["MONGO_URL"] = TEST_MONGO_URL
+os.environ["DB_NAME"] = TEST_DB_NAME
+os.environ["QR_SIGNING_KEYS"] = "test1:test-signing-secret,old1:rotated-signing-secret"
+os.environ["AUTO_ABSENT_ENABLED"] = "false"
+if str(BACKEND_DIR) not in sys.path:
+    sys.path.insert(0, str(BACKEND_DIR))
+
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "mongod: needs a real mongod (skipped on the in-process fake)")
+
+
+@pytest.fixture(scope="session")
+def run():
+    """Run a coroutine to completion on one loop for the whole session (Motor binds to it)"""
+    loop = asyncio.new_event_loop()
+    yield loop.run_until_complete
+    if "routes" in sys.modules:
+        loop.run_until_complete(sys.modules["routes"].event_queue.drain())
+    loop.close()
+
+
+@pytest.fixture(scope="session")
+def mongo_available() -> bool:
+    try:
+        MongoClient(TEST_MONGO_URL, serverSelectionTimeoutMS=1000).admin.command("ping")
+    except PyMongoError:
+        return False
+    return True
+
+
+@pytest.fixture(scope="session")
+def mongo_client(mongo_available):
+    """The client routes uses - swapped for an in-process fake when no mongod is reachable"""
+    import routes
+
+    if not mongo_available:
+        from mongomock_motor import AsyncMongoMockClient
+
+        routes.client = AsyncMongoMockClient()
+        routes.db = routes.client[TEST_DB_NAME]
+    return routes.client
+
+
+@pytest.fixture
+def db(request, run, mongo_available, mongo_client):
+    """An empty test database with the app's indexes"""
+    import routes
+
+    if request.node.get_closest_marker("mongod") and not mongo_available:
+        pytest.skip(f"Needs a real mongod at {TEST_MONGO_URL}")
+    run(mongo_client.drop_database(TEST_DB_NAME))
+    run(routes.ensure_indexes())
+    run(routes.holiday_calendar.refresh())
+    routes.qr_revocations.refreshed_at = None
+    yield routes.db
+    # Let queued background work finish before the next test drops the database
+    if routes.event_queue.queue is not None:
+        run(routes.event_queue.queue.join())
@@ -0,0 +1,191 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import routes
+from routes import ATTENDANCE_ROLLUP_KEY, attendance_rollup_deltas, classify_queued_delta
+
+ROLLUP_FIELDS = ("present", "half_day", "absent", "leave", "total", "duty_amount", "conveyance_amount")
+
+
+def iso(seconds_from_now: float = 0) -> str:
+    return (datetime.now(timezone.utc) + timedelta(seconds=seconds_from_now)).isoformat()
+
+
+def attendance(emp_id: str, date: str, status: str, location: str = "Office", duty: float = 100,
+               conveyance: float = 50, shift_type: str = "day") -> dict:
+    return {
+        "id": f"{emp_id}-{date}",
+        "emp_id": emp_id,
+        "date": date,
+        "attendance_status": status,
+        "location": location,
+        "shift_type": shift_type,
+        "daily_duty_amount": duty,
+        "conveyance_amount": conveyance
+    }
+
+
+# --- Pure functions ---
+
+def test_status_change_moves_one_count_between_buckets():
+    old = attendance("EMP001", "2025-03-10", "full_day")
+    new = {**old, "attendance_status": "half_day", "daily_duty_amount": 50}
+
+    deltas = attendance_rollup_deltas([(old, new)], {"EMP001": "Sales"})
+
+    assert dict(deltas) == {
+        ("2025-03-10", "Sales", "Office", "day"): {"present": -1, "half_day": 1, "total": 0, "duty_amount": -50, "conveyance_amount": 0}
+    }
+
+
+def test_location_change_moves_the_record_between_rollups():
+    old = attendance("EMP001", "2025-03-10", "full_day")
+    new = {**old, "location": "Site"}
+
+    deltas = attendance_rollup_deltas([(old, new)], {"EMP001": "Sales"})
+
+    assert deltas[("2025-03-10", "Sales", "Office", "day")]["total"] == -1
+    assert deltas[("2025-03-10", "Sales", "Site", "day")]["total"] == 1
+
+
+def test_unknown_employees_and_missing_keys_roll_up_as_unknown():
+    record = {**attendance("ADMIN001", "2025-03-10", "absent"), "location": None, "shift_type": None}
+
+    deltas = attendance_rollup_deltas([(None, record)], {})
+
+    assert list(deltas) == [("2025-03-10", "Unknown", "Unknown", "Unknown")]
+
+
+def test_delta_without_a_rebuild_is_applied():
+    assert classify_queued_delta(iso(), None, None) == "apply"
+
+
+def test_delta_queued_before_the_rebuild_started_is_skipped():
+    assert classify_queued_delta(iso(-60), iso(-10), iso(-5)) == "skip"
+    assert classify_queued_delta(iso(-60), iso(-10), None) == "skip"
+
+
+def test_delta_queued_during_or_just_after_a_rebuild_marks_it_stale():
+    assert classify_queued_delta(iso(-5), iso(-10), None) == "stale"
+    assert classify_queued_delta(iso(-8), iso(-10), iso(-9)) == "stale"
+    # A rebuild still running over an older finished one
+    assert classify_queued_delta(iso(), iso(-10), iso(-3600)) == "stale"
+
+
+def test_delta_queued_well_after_the_rebuild_finished_is_applied():
+    assert classify_queued_delta(iso(), iso(-60), iso(-50)) == "apply"
+
+
+# --- Against MongoDB ---
+
+def rollup_snapshot(run, db) -> dict:
+    """Non-empty rollups by key - incremental updates can leave zero-count documents behind"""
+    docs = run(db.attendance_daily_rollup.find({}, {"_id": 0}).to_list(None))
+    return {
+        tuple(doc[field] for field in ATTENDANCE_ROLLUP_KEY): {
+            field: round(doc.get(field, 0), 2) for field in ROLLUP_FIELDS
+        }
+        for doc in docs
+        if doc.get("total")
+    }
+
+
+def write_changes(run, db, changes: list, queued_at: str):
+    """Apply (old, new) pairs to attendance and hand the same pairs to the rollup deltas"""
+    for old, new in changes:
+        if new is None:
+            run(db.attendance.delete_one({"emp_id": old["emp_id"], "date": old["date"]}))
+        else:
+            run(db.attendance.replace_one({"emp_id": new["emp_id"], "date": new["date"]}, dict(new), upsert=True))
+    run(routes.apply_attendance_rollup_changes(changes, queued_at))
+
+
+def seed_users(run, db):
+    run(db.users.insert_many([
+        {"id": emp_id, "name": emp_id, "email": f"{emp_id.lower()}@example.com", "role": role, "department": department}
+        for emp_id, role, department in (
+            ("EMP001", "employee", "Sales"),
+            ("EMP002", "employee", None),
+            ("EMP003", "teamlead", "Operations"),
+            ("ADMIN001", "admin", "Management")
+        )
+    ]))
+
+
+@pytest.mark.mongod
+def test_incremental_rollups_match_a_rebuild(run, db):
+    seed_users(run, db)
+    emp1 = attendance("EMP001", "2025-03-10", "full_day")
+    emp2 = attendance("EMP002", "2025-03-10", "half_day", duty=50, conveyance=25.5)
+    emp3 = attendance("EMP003", "2025-03-10", "absent", duty=0, conveyance=0, shift_type="night")
+    admin = attendance("ADMIN001", "2025-03-10", "full_day")
+    leave = attendance("EMP001", "2025-03-11", "leave", conveyance=0)
+
+    write_changes(run, db, [(None, emp1), (None, emp2), (None, emp3), (None, admin), (None, leave)], iso())
+    moved = {**emp1, "attendance_status": "half_day", "location": "Site", "daily_duty_amount": 50}
+    write_changes(run, db, [(emp1, moved)], iso())
+    present = {**emp3, "attendance_status": "full_day", "daily_duty_amount": 120.25}
+    write_changes(run, db, [(emp3, present), (leave, None)], iso())
+    incremental = rollup_snapshot(run, db)
+
+    run(routes.rebuild_attendance_rollups())
+
+    assert incremental == rollup_snapshot(run, db)
+    assert incremental[("2025-03-10", "Unknown", "Office", "day")]["total"] == 2  # EMP002 and the admin
+    assert ("2025-03-11", "Sales", "Office", "day") not in incremental
+
+
+@pytest.mark.mongod
+def test_deltas_after_a_rebuild_are_neither_lost_nor_counted_twice(run, db):
+    seed_users(run, db)
+    emp1 = attendance("EMP001", "2025-03-10", "full_day")
+    emp2 = attendance("EMP002", "2025-03-10", "full_day")
+    write_changes(run, db, [(None, emp1)], iso())
+    run(routes.rebuild_attendance_rollups())
+
+    # Written before the rebuild started but applied after it - already counted
+    run(db.attendance.insert_one(dict(emp2)))
+    run(routes.rebuild_attendance_rollups())
+    run(routes.apply_attendance_rollup_changes([(None, emp2)], iso(-3600)))
+    assert rollup_snapshot(run, db)[("2025-03-10", "Unknown", "Office", "day")]["total"] == 1
+
+    # Written well after the rebuild - applied on top of it
+    half = {**emp1, "attendance_status": "half_day"}
+    write_changes(run, db, [(emp1, half)], iso(3600))
+    after = rollup_snapshot(run, db)
+    assert after[("2025-03-10", "Sales", "Office", "day")]["half_day"] == 1
+
+    run(routes.rebuild_attendance_rollups())
+    assert after == rollup_snapshot(run, db)
+
+
+@pytest.mark.mongod
+def test_delta_racing_a_rebuild_marks_the_date_stale(run, db):
+    seed_users(run, db)
+    emp1 = attendance("EMP001", "2025-03-10", "full_day")
+    run(db.attendance.insert_one(dict(emp1)))
+    run(routes.rebuild_attendance_rollups())
+
+    half = {**emp1, "attendance_status": "half_day"}
+    run(db.attendance.replace_one({"id": emp1["id"]}, dict(half)))
+    run(routes.apply_attendance_rollup_changes([(emp1, half)], iso()))
+
+    assert run(db.attendance_rollup_stale.distinct("date")) == ["2025-03-10"]
+    run(routes.ensure_attendance_rollups_fresh("2025-03-01", "2025-03-31"))
+    assert rollup_snapshot(run, db)[("2025-03-10", "Sales", "Office", "day")]["half_day"] == 1
+    assert run(db.attendance_rollup_stale.count_documents({})) == 0
+
+
+@pytest.mark.mongod
+def test_department_change_rebuilds_the_employees_dates(run, db):
+    seed_users(run, db)
+    emp1 = attendance("EMP001", "2025-03-10", "full_day")
+    write_changes(run, db, [(None, emp1)], iso())
+
+    run(routes.update_user("EMP001", {"department": "Operations"}))
+    run(routes.ensure_attendance_rollups_fresh("2025-03-01", "2025-03-31"))
+
+    snapshot = rollup_snapshot(run, db)
+    assert ("2025-03-10", "Sales", "Office", "day") not in snapshot
+    assert snapshot[("2025-03-10", "Operations", "Office", "day")]["total"] == 1
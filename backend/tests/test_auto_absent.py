@@ -0,0 +1,54 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from fastapi import HTTPException
+
+import routes
+
+YESTERDAY = (datetime.now(timezone.utc) - timedelta(days=1)).strftime("%Y-%m-%d")
+
+
+def add_employees(run, db, *emp_ids):
+    run(db.users.insert_many([
+        {"id": emp_id, "name": emp_id, "role": "employee", "status": "active", "joining_date": "2020-01-01"}
+        for emp_id in emp_ids
+    ]))
+
+
+@pytest.mark.parametrize("days_ahead", [0, 1])
+def test_today_and_future_dates_are_rejected(run, days_ahead):
+    date = (datetime.now(timezone.utc) + timedelta(days=days_ahead)).strftime("%Y-%m-%d")
+    with pytest.raises(HTTPException) as error:
+        run(routes.run_auto_absent(date))
+    assert error.value.status_code == 400
+
+
+def test_rerun_inserts_nothing_and_keeps_existing_records(run, db):
+    add_employees(run, db, "EMP001", "EMP002", "EMP003", "EMP004")
+    run(db.attendance.insert_one({"id": "ATT1", "emp_id": "EMP001", "date": YESTERDAY, "attendance_status": "full_day"}))
+    run(db.leaves.insert_one({
+        "id": "LV1", "emp_id": "EMP002", "from_date": YESTERDAY, "to_date": YESTERDAY, "status": "approved"
+    }))
+
+    first = run(routes.run_auto_absent(YESTERDAY))
+    second = run(routes.run_auto_absent(YESTERDAY))
+
+    assert first["inserted"] == 2
+    assert second["inserted"] == 0
+    records = run(db.attendance.find({"date": YESTERDAY}, {"_id": 0}).to_list(None))
+    assert sorted((r["emp_id"], r["attendance_status"]) for r in records) == [
+        ("EMP001", "full_day"), ("EMP003", "absent"), ("EMP004", "absent")
+    ]
+    job = run(db.job_runs.find_one({"job": "auto_absent", "date": YESTERDAY}))
+    assert job["status"] == "completed"
+
+
+def test_holidays_are_skipped(run, db):
+    add_employees(run, db, "EMP001")
+    run(db.holidays.insert_one({"id": "H1", "date": YESTERDAY, "name": "Founders Day"}))
+    run(routes.holiday_calendar.refresh())
+
+    result = run(routes.run_auto_absent(YESTERDAY))
+
+    assert result["holiday"] == "Founders Day"
+    assert run(db.attendance.count_documents({})) == 0
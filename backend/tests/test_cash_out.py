@@ -0,0 +1,64 @@
+import asyncio
+
+import routes
+
+
+def cash_out_fields(reference_id: str, amount: float = 500) -> dict:
+    return {
+        "category": "bills",
+        "description": f"Bill {reference_id}",
+        "amount": amount,
+        "date": "2025-03-10",
+        "reference_id": reference_id,
+        "reference_type": "bill"
+    }
+
+
+def test_repeated_auto_cash_out_keeps_one_entry(run, db):
+    run(routes.create_auto_cash_out(**cash_out_fields("BILL1")))
+    run(routes.create_auto_cash_out(**cash_out_fields("BILL1", amount=900)))
+
+    entries = run(db.cash_out.find({"reference_id": "BILL1"}, {"_id": 0}).to_list(None))
+    assert len(entries) == 1
+    assert entries[0]["amount"] == 500
+    assert entries[0]["is_auto"] is True
+
+
+def test_concurrent_auto_cash_outs_keep_one_entry(run, db):
+    async def race():
+        await asyncio.gather(*(routes.create_auto_cash_out(**cash_out_fields("BILL1")) for _ in range(10)))
+
+    run(race())
+    assert run(db.cash_out.count_documents({"reference_id": "BILL1", "reference_type": "bill"})) == 1
+
+
+def test_replace_overwrites_the_existing_entry(run, db):
+    run(routes.create_auto_cash_out(**cash_out_fields("BILL1")))
+    original = run(db.cash_out.find_one({"reference_id": "BILL1"}))
+
+    run(routes.create_auto_cash_out(**cash_out_fields("BILL1", amount=900), replace=True))
+
+    entries = run(db.cash_out.find({"reference_id": "BILL1"}).to_list(None))
+    assert len(entries) == 1
+    assert entries[0]["amount"] == 900
+    assert entries[0]["id"] == original["id"]
+    assert entries[0]["created_at"] == original["created_at"]
+
+
+def test_batch_counts_only_new_entries(run, db):
+    run(routes.create_auto_cash_out(**cash_out_fields("BILL1")))
+
+    created = run(routes.create_auto_cash_outs([
+        cash_out_fields("BILL1"), cash_out_fields("BILL2"), cash_out_fields("BILL2"), cash_out_fields("BILL3")
+    ]))
+
+    assert created == 2
+    assert sorted(run(db.cash_out.distinct("reference_id"))) == ["BILL1", "BILL2", "BILL3"]
+    assert run(db.cash_out.count_documents({})) == 3
+
+
+def test_same_reference_id_of_another_type_is_separate(run, db):
+    run(routes.create_auto_cash_out(**cash_out_fields("REF1")))
+    run(routes.create_auto_cash_out(**{**cash_out_fields("REF1"), "reference_type": "audit_expense"}))
+
+    assert run(db.cash_out.count_documents({"reference_id": "REF1"})) == 2
@@ -0,0 +1,21 @@
+import os
+
+import routes
+
+
+def test_clear_all_data_drops_uploads_and_stored_files(run, db, tmp_path, monkeypatch):
+    monkeypatch.setattr(routes, "ATTACHMENT_STORE_DIR", str(tmp_path / "cas"))
+    sha256 = "ab" * 32
+    blob_path = routes.attachment_blob_path(sha256)
+    os.makedirs(os.path.dirname(blob_path))
+    with open(blob_path, "wb") as blob:
+        blob.write(b"%PDF-1.4")
+    run(db.attachments.insert_one({"id": "UP1", "sha256": sha256, "size": 8, "kind": "bill"}))
+    run(db.attachment_blobs.insert_one({"sha256": sha256, "size": 8, "refcount": 1}))
+
+    run(routes.clear_all_data())
+
+    assert run(db.attachments.count_documents({})) == 0
+    assert run(db.attachment_blobs.count_documents({})) == 0
+    assert not os.path.exists(blob_path)
+    assert run(db.users.distinct("id")) == ["ADMIN001"]
@@ -0,0 +1,17 @@
+import routes
+
+
+def test_date_only_and_timestamped_items_merge_in_submission_order(run, db):
+    run(db.leaves.insert_one({"id": "LV1", "emp_id": "EMP001", "status": "pending", "applied_on": "2025-03-10"}))
+    run(db.bills.insert_one({"id": "BL1", "emp_id": "EMP001", "status": "pending", "submitted_on": "2025-03-09"}))
+    run(db.advances.insert_many([
+        {"id": "AD1", "emp_id": "EMP001", "status": "pending", "requested_on": "2025-03-10T09:00:00+00:00"},
+        {"id": "AD2", "emp_id": "EMP001", "status": "pending", "requested_on": "2025-03-09T23:00:00+00:00"}
+    ]))
+
+    first = run(routes.get_approval_inbox(role="admin", page=1, page_size=2))
+    second = run(routes.get_approval_inbox(role="admin", page=2, page_size=2))
+
+    assert [item["id"] for item in first["items"] + second["items"]] == ["AD1", "LV1", "AD2", "BL1"]
+    assert first["total"] == 4 and first["has_more"] and not second["has_more"]
+    assert "sort_key" not in first["items"][0]
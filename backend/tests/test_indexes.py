@@ -0,0 +1,36 @@
+import pytest
+
+import routes
+
+
+def test_duplicate_attendance_keeps_the_most_complete_record(run, db):
+    run(db.attendance.drop_indexes())
+    run(db.attendance.insert_many([
+        {"id": "A1", "emp_id": "EMP001", "date": "2025-03-10", "attendance_status": "absent"},
+        {"id": "A2", "emp_id": "EMP001", "date": "2025-03-10", "attendance_status": "full_day",
+         "punch_in": "2025-03-10T04:30:00+00:00", "punch_out": "2025-03-10T13:30:00+00:00"},
+        {"id": "A3", "emp_id": "EMP002", "date": "2025-03-10", "attendance_status": "full_day"}
+    ]))
+    run(db.attendance.create_index([("emp_id", 1), ("date", 1)]))
+
+    run(routes.ensure_indexes())
+
+    assert sorted(run(db.attendance.distinct("id"))) == ["A2", "A3"]
+    assert run(db.attendance_duplicates.distinct("id")) == ["A1"]
+    unique = [info for info in run(db.attendance.index_information()).values() if info.get("unique")]
+    assert [info["key"] for info in unique] == [[("emp_id", 1), ("date", 1)]]
+
+
+@pytest.mark.mongod  # mongomock ignores partialFilterExpression
+def test_duplicate_auto_cash_out_keeps_the_first_entry(run, db):
+    run(db.cash_out.drop_indexes())
+    run(db.cash_out.insert_many([
+        {"id": "C2", "reference_id": "BILL1", "reference_type": "bill", "is_auto": True, "created_at": "2025-03-10T10:00:00"},
+        {"id": "C1", "reference_id": "BILL1", "reference_type": "bill", "is_auto": True, "created_at": "2025-03-10T09:00:00"},
+        {"id": "M1", "reference_id": "BILL1", "reference_type": "bill", "is_auto": False, "created_at": "2025-03-10T08:00:00"}
+    ]))
+
+    run(routes.ensure_indexes())
+
+    assert sorted(run(db.cash_out.distinct("id"))) == ["C1", "M1"]
+    assert run(db.cash_out_duplicates.distinct("id")) == ["C2"]
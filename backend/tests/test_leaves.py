@@ -0,0 +1,90 @@
+import pytest
+from fastapi import HTTPException
+
+import routes
+from models import LeaveCreate
+
+
+def leave_request(from_date: str, to_date: str, emp_id: str = "EMP001") -> LeaveCreate:
+    return LeaveCreate(
+        emp_id=emp_id, emp_name="Test Employee", type="casual",
+        from_date=from_date, to_date=to_date, reason="Personal"
+    )
+
+
+@pytest.mark.parametrize("from_date, to_date", [
+    ("2025-03-10", "2025-03-12"),  # same range
+    ("2025-03-08", "2025-03-10"),  # ends on the first day
+    ("2025-03-12", "2025-03-15"),  # starts on the last day
+    ("2025-03-11", "2025-03-11"),  # inside
+    ("2025-03-01", "2025-03-31")   # around
+])
+def test_overlapping_leave_is_rejected(run, db, from_date, to_date):
+    run(routes.create_leave(leave_request("2025-03-10", "2025-03-12")))
+
+    with pytest.raises(HTTPException) as error:
+        run(routes.create_leave(leave_request(from_date, to_date)))
+    assert error.value.status_code == 400
+    assert "Overlaps an existing pending leave" in error.value.detail
+    assert run(db.leaves.count_documents({})) == 1
+
+
+def test_adjacent_and_other_employees_leaves_are_accepted(run, db):
+    run(routes.create_leave(leave_request("2025-03-10", "2025-03-12")))
+    run(routes.create_leave(leave_request("2025-03-13", "2025-03-14")))
+    run(routes.create_leave(leave_request("2025-03-10", "2025-03-12", emp_id="EMP002")))
+
+    assert run(db.leaves.count_documents({})) == 3
+
+
+def test_rejected_leave_does_not_block_a_new_request(run, db):
+    leave = run(routes.create_leave(leave_request("2025-03-10", "2025-03-12")))
+    run(db.leaves.update_one({"id": leave.id}, {"$set": {"status": "rejected"}}))
+
+    run(routes.create_leave(leave_request("2025-03-11", "2025-03-11")))
+    assert run(db.leaves.count_documents({"status": "pending"})) == 1
+
+
+def test_leave_days_exclude_holidays(run, db):
+    run(db.holidays.insert_one({"id": "H1", "date": "2025-03-11", "name": "Holi"}))
+    run(routes.holiday_calendar.refresh())
+
+    leave = run(routes.create_leave(leave_request("2025-03-10", "2025-03-12")))
+    assert leave.days == 2
+
+
+def test_weekends_are_counted_and_client_days_ignored(run, db):
+    # 2025-03-08 and 2025-03-09 are a Saturday and a Sunday
+    request = leave_request("2025-03-07", "2025-03-10").model_copy(update={"days": 1})
+
+    leave = run(routes.create_leave(request))
+    assert leave.days == 4
+
+
+def test_range_of_only_holidays_is_rejected(run, db):
+    run(db.holidays.insert_one({"id": "H1", "date": "2025-03-14", "name": "Holi"}))
+    run(routes.holiday_calendar.refresh())
+
+    with pytest.raises(HTTPException) as error:
+        run(routes.create_leave(leave_request("2025-03-14", "2025-03-14")))
+    assert error.value.status_code == 400
+    assert run(db.leaves.count_documents({})) == 0
+
+
+def test_startup_drops_old_format_balances_and_keeps_rebuild_placeholders(run, db):
+    run(db.leave_balances.insert_many([
+        {"emp_id": "EMP001", "year": 2025, "total_leave": 5, "used_leave": 1},
+        {"emp_id": "EMP002", "year": 2025, "rebuild_started": "2025-03-10T00:00:00+00:00"},
+        {"emp_id": "EMP003", "year": 2025, "months": {}, "used_from_requests": 0}
+    ]))
+
+    run(routes.ensure_indexes())
+
+    assert sorted(run(db.leave_balances.distinct("emp_id"))) == ["EMP002", "EMP003"]
+
+
+def test_balance_update_rejects_a_days_adjustment(run, db):
+    with pytest.raises(HTTPException) as error:
+        run(routes.update_leave_balance("EMP001", days=2, year=2025))
+    assert error.value.status_code == 400
+    assert run(db.leave_balances.count_documents({})) == 0
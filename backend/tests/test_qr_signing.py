@@ -0,0 +1,142 @@
+import json
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from fastapi import HTTPException
+
+import routes
+from models import AttendanceCreate, QRCodeCreate
+
+
+def signed_payload(run, **overrides) -> dict:
+    payload = {
+        "id": "QR000001",
+        "location": "Office",
+        "conveyance": 100,
+        "date": datetime.now(timezone.utc).strftime("%Y-%m-%d"),
+        "created_by": "TL001",
+        "shift_type": "day",
+        "shift_start": "10:00",
+        "shift_end": "19:00",
+        "exp": int(time.time()) + 3600,
+        **overrides
+    }
+    return run(routes.sign_qr_payload(payload))
+
+
+@pytest.fixture
+def no_revocations():
+    """Skip the revocation list refresh so signature checks never touch the DB"""
+    routes.qr_revocations.revoked_ids = set()
+    routes.qr_revocations.refreshed_at = datetime.now(timezone.utc)
+    yield
+    routes.qr_revocations.refreshed_at = None
+
+
+def test_signed_payload_verifies(run, no_revocations):
+    qr_info = signed_payload(run)
+    assert qr_info["kid"] == "test1"
+    run(routes.verify_signed_qr(qr_info))
+
+
+def test_payload_signed_with_rotated_key_verifies(run, no_revocations):
+    qr_info = {**signed_payload(run), "kid": "old1"}
+    qr_info["sig"] = routes.compute_qr_signature(qr_info, b"rotated-signing-secret")
+    run(routes.verify_signed_qr(qr_info))
+
+
+def test_rotated_key_signature_under_the_current_key_id_is_rejected(run, no_revocations):
+    qr_info = signed_payload(run)
+    qr_info["sig"] = routes.compute_qr_signature(qr_info, b"rotated-signing-secret")
+    with pytest.raises(HTTPException) as error:
+        run(routes.verify_signed_qr(qr_info))
+    assert "Invalid QR code" in error.value.detail
+
+
+def test_code_is_valid_until_the_night_shift_grace_after_its_date():
+    expiry = routes.get_qr_expiry("2025-03-10")
+    assert expiry == datetime(2025, 3, 11, routes.QR_NIGHT_SHIFT_GRACE_HOURS, tzinfo=timezone.utc)
+
+
+def test_short_lived_code_expires_after_its_ttl():
+    before = datetime.now(timezone.utc)
+    expiry = routes.get_qr_expiry("2025-03-10", ttl_minutes=5)
+    assert before + timedelta(minutes=5) <= expiry <= datetime.now(timezone.utc) + timedelta(minutes=5)
+
+
+def test_created_code_signs_its_expiry(run, db, no_revocations):
+    today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    qr = run(routes.create_qr_code(QRCodeCreate(
+        location="Office", conveyance_amount=100, date=today, created_by="TL001", ttl_minutes=5
+    )))
+    qr_info = json.loads(qr.qr_data)
+
+    assert qr_info["kid"] == "test1"
+    assert 0 < qr_info["exp"] - time.time() <= 5 * 60
+    run(routes.verify_signed_qr(qr_info))
+
+
+@pytest.mark.parametrize("field, value", [
+    ("location", "Elsewhere"),
+    ("conveyance", 10000),
+    ("shift_start", "06:00"),
+    ("exp", int(time.time()) + 86400 * 365)
+])
+def test_tampered_payload_is_rejected(run, no_revocations, field, value):
+    qr_info = {**signed_payload(run), field: value}
+    with pytest.raises(HTTPException) as error:
+        run(routes.verify_signed_qr(qr_info))
+    assert error.value.status_code == 400
+    assert "Invalid QR code" in error.value.detail
+
+
+def test_unknown_key_id_is_rejected(run, no_revocations):
+    qr_info = {**signed_payload(run), "kid": "retired"}
+    with pytest.raises(HTTPException) as error:
+        run(routes.verify_signed_qr(qr_info))
+    assert "Invalid QR code" in error.value.detail
+
+
+@pytest.mark.parametrize("exp", [int(time.time()) - 1, None, "soon"])
+def test_expired_or_malformed_expiry_is_rejected(run, no_revocations, exp):
+    qr_info = signed_payload(run, exp=exp)
+    with pytest.raises(HTTPException) as error:
+        run(routes.verify_signed_qr(qr_info))
+    assert error.value.status_code == 400
+    assert "expired" in error.value.detail
+
+
+def test_revoked_code_is_rejected(run, no_revocations):
+    qr_info = signed_payload(run)
+    routes.qr_revocations.add(qr_info["id"])
+    with pytest.raises(HTTPException) as error:
+        run(routes.verify_signed_qr(qr_info))
+    assert "expired" in error.value.detail
+
+
+def test_signed_code_with_signature_stripped_is_rejected(run, db):
+    today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    qr = run(routes.create_qr_code(QRCodeCreate(
+        location="Office", conveyance_amount=100, date=today, created_by="TL001"
+    )))
+    unsigned = {k: v for k, v in json.loads(qr.qr_data).items() if k not in ("sig", "kid")}
+    unsigned["shift_type"] = "night"
+
+    with pytest.raises(HTTPException) as error:
+        run(routes.punch_in(AttendanceCreate(qr_data=json.dumps(unsigned)), "EMP001"))
+    assert error.value.status_code == 400
+    assert run(db.attendance.count_documents({})) == 0
+
+
+def test_legacy_code_takes_shift_from_the_stored_code(run, db):
+    today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    run(db.qr_codes.insert_one({
+        "id": "LEGACY01", "location": "Office", "conveyance_amount": 50, "date": today,
+        "created_by": "TL001", "shift_type": "day", "shift_start": "00:00", "shift_end": "23:59",
+        "is_active": True
+    }))
+    payload = {"id": "LEGACY01", "shift_type": "night", "shift_start": "23:00", "shift_end": "07:00"}
+
+    attendance = run(routes.punch_in(AttendanceCreate(qr_data=json.dumps(payload)), "EMP001"))
+    assert (attendance.shift_type, attendance.shift_start, attendance.shift_end) == ("day", "00:00", "23:59")
@@ -1,6 +1,6 @@
 import React, { useState, useEffect, useRef } from 'react';
 import { useAuth } from '../context/AuthContext';
-import { profileAPI, leaveBalanceAPI, advanceAPI } from '../services/api';
+import { profileAPI, leaveBalanceAPI, advanceAPI, mediaUrl } from '../services/api';
 import { Card, CardContent, CardHeader, CardTitle } from '../components/ui/card';
 import { Button } from '../components/ui/button';
 import { Input } from '../components/ui/input';
@@ -89,7 +89,7 @@ const Profile = () => {
     
     try {
       const result = await profileAPI.uploadPhoto(user.id, file);
-      updateUser({ ...user, photo: result.photo });
+      updateUser({ ...user, photo: result.photo, photo_thumbnails: result.photo_thumbnails });
       toast.success('Photo updated successfully!');
     } catch (error) {
       toast.error(error.message || 'Failed to upload photo');
@@ -161,7 +161,7 @@ const Profile = () => {
               <div className="relative">
                 <div className="w-32 h-32 rounded-full overflow-hidden bg-gradient-to-br from-blue-400 to-blue-600 flex items-center justify-center text-white text-4xl font-bold">
                   {user?.photo ? (
-                    <img src={user.photo} alt={user.name} className="w-full h-full object-cover" />
+                    <img src={mediaUrl(user.photo)} alt={user.name} className="w-full h-full object-cover" />
                   ) : (
                     user?.name?.split(' ').map(n => n[0]).join('') || 'U'
                   )}
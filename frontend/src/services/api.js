@@ -25,6 +25,9 @@ async function apiCall(endpoint, options = {}) {
   return response.json();
 }
 
+// Uploaded media (photos, attachments) is referenced by /api/... paths on the backend
+export const mediaUrl = (path) => (path && path.startsWith('/api/') ? `${API_URL}${path}` : path);
+
 // Auth API
 export const authAPI = {
   login: (userId, password) => 
@@ -54,6 +57,11 @@ export const usersAPI = {
       body: JSON.stringify(updates),
     }),
   getTeamMembers: (teamLeadId) => apiCall(`/users/team/${teamLeadId}`),
+  // Team roll-ups: members with today's punch state / month totals in one request
+  getTeamToday: (teamLeadId, date) =>
+    apiCall(`/teams/${teamLeadId}/today${date ? `?date=${date}` : ''}`),
+  getTeamMonth: (teamLeadId, month, year) =>
+    apiCall(`/teams/${teamLeadId}/month?month=${month}&year=${year}`),
 };
 
 // QR Code API
@@ -112,6 +120,18 @@ export const attendanceAPI = {
   },
   getMonthly: (empId, month, year) => 
     apiCall(`/attendance/${empId}/monthly?month=${month}&year=${year}`),
+  // Compact month grid: one status code string per employee
+  getMatrix: (month, year, teamLeadId) => {
+    const params = new URLSearchParams({ month, year });
+    if (teamLeadId) params.append('team_lead_id', teamLeadId);
+    return apiCall(`/attendance/matrix?${params}`);
+  },
+  rebuildRollups: (fromDate, toDate) => {
+    const params = new URLSearchParams();
+    if (fromDate) params.append('from_date', fromDate);
+    if (toDate) params.append('to_date', toDate);
+    return apiCall(`/attendance/rollups/rebuild?${params}`, { method: 'POST' });
+  },
 };
 
 // Leave API
@@ -132,6 +152,14 @@ export const leaveAPI = {
     if (year) params.append('year', year);
     return apiCall(`/leave-balance/${empId}?${params}`);
   },
+  // Per-day who-is-on-leave for a date range (optionally one team or department)
+  getCalendar: (fromDate, toDate, { teamLeadId, department, includePending } = {}) => {
+    const params = new URLSearchParams({ from_date: fromDate, to_date: toDate });
+    if (teamLeadId) params.append('team_lead_id', teamLeadId);
+    if (department) params.append('department', department);
+    if (includePending) params.append('include_pending', 'true');
+    return apiCall(`/leaves/calendar?${params}`);
+  },
   approve: (leaveId, approvedBy) => 
     apiCall(`/leaves/${leaveId}/approve?approved_by=${approvedBy}`, { method: 'PUT' }),
   reject: (leaveId, rejectedBy) => 
@@ -211,6 +239,9 @@ export const payslipAPI = {
   settle: (payslipId) => 
     apiCall(`/payslips/${payslipId}/settle`, { method: 'PUT' }),
   download: (payslipId) => `${API_URL}/api/payslips/${payslipId}/download`,
+  // Payslips vs salary cash-out rows for a period
+  reconcile: (month, year) => 
+    apiCall(`/payroll/reconciliation?month=${encodeURIComponent(month)}&year=${year}`),
 };
 
 // Holiday API
@@ -258,6 +289,7 @@ export const profileAPI = {
     
     return response.json();
   },
+  migratePhotos: () => apiCall('/users/photos/migrate', { method: 'POST' }),
 };
 
 // Leave Balance API
@@ -266,6 +298,13 @@ export const leaveBalanceAPI = {
     const params = year ? `?year=${year}` : '';
     return apiCall(`/leave-balance/${empId}${params}`);
   },
+  // All employees' balances for a year in one request
+  getReport: (year, department) => {
+    const params = new URLSearchParams();
+    if (year) params.append('year', year);
+    if (department) params.append('department', department);
+    return apiCall(`/leave-balance?${params}`);
+  },
 };
 
 // Salary Advance API
@@ -326,6 +365,12 @@ export const bulkAPI = {
       method: 'POST',
       body: JSON.stringify({ ids, rejected_by: rejectedBy, reason }),
     }),
+  // amounts: optional { [expenseId]: partialAmount }
+  approveAuditExpenses: (ids, approvedBy, amounts) => 
+    apiCall('/audit-expenses/bulk-approve', {
+      method: 'POST',
+      body: JSON.stringify({ ids, approved_by: approvedBy, amounts }),
+    }),
 };
 
 // Audit Expense API
@@ -375,6 +420,16 @@ export const auditExpenseAPI = {
   getSummary: (empId) => apiCall(`/audit-expenses/summary/${empId}`),
 };
 
+// Approval Inbox API
+export const inboxAPI = {
+  get: (role, userId, { types, page = 1, pageSize = 20 } = {}) => {
+    const params = new URLSearchParams({ role, page, page_size: pageSize });
+    if (userId) params.append('user_id', userId);
+    if (types) params.append('types', Array.isArray(types) ? types.join(',') : types);
+    return apiCall(`/inbox?${params}`);
+  },
+};
+
 // Notification API
 export const notificationAPI = {
   getAll: (userId, unreadOnly = false, limit = 50) => {
@@ -414,6 +469,12 @@ export const exportAPI = {
     return `${API_URL}/api/export/attendance?${params}`;
   },
   employees: () => `${API_URL}/api/export/employees`,
+  leaveBalances: (year, department) => {
+    const params = new URLSearchParams({ format: 'csv' });
+    if (year) params.append('year', year);
+    if (department) params.append('department', department);
+    return `${API_URL}/api/leave-balance?${params}`;
+  },
   leaves: (month, year, status, empId) => {
     const params = new URLSearchParams();
     if (month) params.append('month', month);
@@ -572,6 +633,16 @@ export const cashbookAPI = {
   },
 };
 
+// Attachment store API
+export const attachmentAPI = {
+  collectGarbage: (graceHours, dryRun = false) => {
+    const params = new URLSearchParams();
+    if (graceHours !== undefined) params.append('grace_hours', graceHours);
+    if (dryRun) params.append('dry_run', 'true');
+    return apiCall(`/attachments/gc?${params}`, { method: 'POST' });
+  },
+};
+
 // Loan / EMI API
 export const loanAPI = {
   // Loans